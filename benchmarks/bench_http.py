@@ -0,0 +1,145 @@
+"""
+Benchmark of connection reuse for the boarding pass REST calls over TLS.
+
+Runs the boarding pass analysis (one POST and the status GETs) for each
+passenger against a local HTTPS fake of Form Recognizer, once opening a new
+connection per request as the module-level requests functions do and once
+with the pooled HttpClient. Prints latency per passenger, the number of
+TCP/TLS connections and the time saved as JSON.
+
+    python -m benchmarks.bench_http --n-passengers 100 --concurrency 4
+"""
+
+import argparse
+import json
+import logging
+import os
+import ssl
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from benchmarks.fake_formrecognizer import FakeFormRecognizerServer
+from src.utils_data import get_boardingpass
+from src.utils_http import HttpClient
+
+
+class PerRequestHttp:
+    "Client without a session, every request opens a new connection"
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return requests.get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return requests.post(url, **kwargs)
+
+
+def self_signed_context(directory: str) -> ssl.SSLContext:
+    "Server context with a self-signed certificate for 127.0.0.1, trusted by requests"
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=127.0.0.1",
+            "-addext",
+            "subjectAltName=IP:127.0.0.1",
+            "-keyout",
+            key,
+            "-out",
+            cert,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    os.environ["REQUESTS_CA_BUNDLE"] = cert
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+
+    return context
+
+
+def percentiles(latencies: list) -> dict:
+    return {
+        "p50": float(np.percentile(latencies, 50)),
+        "p99": float(np.percentile(latencies, 99)),
+        "mean": float(np.mean(latencies)),
+    }
+
+
+def bench(
+    server: FakeFormRecognizerServer, http, n_passengers: int, concurrency: int
+) -> dict:
+    server.n_get, server.n_connections = 0, 0
+
+    def run(_):
+        start = time.perf_counter()
+        dict_boardingpass = get_boardingpass(
+            b"%PDF-fake",
+            apikey="fake",
+            endpoint=server.endpoint,
+            model_id="fake-model",
+            http=http,
+        )
+        assert dict_boardingpass is not None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(run, range(n_passengers)))
+
+    return {
+        **percentiles(latencies),
+        "total_seconds": time.perf_counter() - start,
+        "requests": n_passengers + server.n_get,
+        "connections": server.n_connections,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-passengers", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--median-seconds", type=float, default=0.05)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        server = FakeFormRecognizerServer(
+            median_seconds=args.median_seconds,
+            retry_after=args.median_seconds / 2,
+            ssl_context=self_signed_context(directory),
+        ).start()
+
+        per_request = bench(
+            server, PerRequestHttp(), args.n_passengers, args.concurrency
+        )
+        with HttpClient(pool_size=args.concurrency) as http:
+            pooled = bench(server, http, args.n_passengers, args.concurrency)
+
+    report = {
+        "n_passengers": args.n_passengers,
+        "concurrency": args.concurrency,
+        "per_request": per_request,
+        "pooled": pooled,
+        "saved_seconds_per_passenger": per_request["mean"] - pooled["mean"],
+    }
+    print(json.dumps(report, indent=2))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Benchmark of memory held per in-flight passenger while uploading images.
+
+Each passenger loads boarding pass, ID and lighter image and streams them
+into uploads, the ID image twice (Form Recognizer and Face). All passengers
+are held in flight at the same time, as with a concurrency limit of
+--in-flight. Compares reading files into bytes plus a BytesIO copy per
+upload with memory-mapped images streamed through image_stream. Each mode
+runs in a fresh process, RSS is split into anonymous memory and mapped file
+pages (page cache, reclaimable) and reported per passenger as JSON.
+
+    python -m benchmarks.bench_image_memory --in-flight 16 --image-mb 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+from io import BytesIO
+
+from src.utils_data import load_img
+from src.utils_image import image_stream
+
+UPLOAD_CHUNK = 64 * 1024
+FILES = ["boarding.pdf", "id.jpg", "lighter.jpg"]
+UPLOADS = ["boarding.pdf", "id.jpg", "id.jpg", "lighter.jpg"]
+
+
+def rss() -> dict:
+    "Anonymous and file backed resident memory in bytes from /proc"
+    with open("/proc/self/status") as f:
+        fields = dict(line.split(":", 1) for line in f)
+
+    return {key: int(fields[key].split()[0]) * 1024 for key in ["RssAnon", "RssFile"]}
+
+
+def upload(stream) -> int:
+    "Reads stream in chunks like an HTTP client sending the body"
+    n = 0
+    while chunk := stream.read(UPLOAD_CHUNK):
+        n += len(chunk)
+    return n
+
+
+def copy_passenger(directory: str) -> list:
+    images = {}
+    for filename in FILES:
+        with open(os.path.join(directory, filename), "rb") as f:
+            images[filename] = f.read()
+    # each SDK call wrapped its input in a BytesIO
+    streams = [BytesIO(images[filename]) for filename in UPLOADS]
+    for stream in streams:
+        upload(stream)
+    return [images, streams]
+
+
+def mapped_passenger(directory: str) -> list:
+    images = {f: load_img(os.path.join(directory, f)) for f in FILES}
+    streams = [image_stream(images[filename]) for filename in UPLOADS]
+    for stream in streams:
+        upload(stream)
+    return [images, streams]
+
+
+def run(mode: str, directories: list, queue: multiprocessing.Queue):
+    load = {"copy": copy_passenger, "mapped": mapped_passenger}[mode]
+    before = rss()
+    in_flight = [load(directory) for directory in directories]
+    after = rss()
+    queue.put({k: (after[k] - before[k]) / len(in_flight) for k in before})
+    del in_flight
+
+
+def measure(mode: str, directories: list) -> dict:
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=run, args=(mode, directories, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return {f"{k}_mb_per_passenger": round(v / 1024**2, 2) for k, v in result.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--in-flight", type=int, default=16)
+    parser.add_argument("--image-mb", type=float, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        directories = []
+        for i in range(args.in_flight):
+            directory = os.path.join(root, f"passenger_{i}")
+            os.makedirs(directory)
+            for filename in FILES:
+                with open(os.path.join(directory, filename), "wb") as f:
+                    f.write(os.urandom(int(args.image_mb * 1024**2)))
+            directories.append(directory)
+
+        report = {
+            "in_flight": args.in_flight,
+            "input_mb_per_passenger": args.image_mb * len(FILES),
+            "copy": measure("copy", directories),
+            "mapped": measure("mapped", directories),
+        }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of the instrumentation overhead.
+
+Times empty spans and counter increments, from one thread and from several
+threads sharing the registry, and prints the cost per call in microseconds
+as JSON. Compare with the latency of the stages that are timed, which are
+milliseconds for local work and seconds for remote calls.
+
+    python -m benchmarks.bench_metrics --n-calls 200000 --n-threads 8
+"""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.utils_metrics import Metrics
+
+
+def per_call_us(func, n_calls: int, n_threads: int) -> float:
+    "Wall time per call in microseconds with n_threads calling concurrently"
+
+    def run(_):
+        for _ in range(n_calls // n_threads):
+            func()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(run, range(n_threads)))
+
+    return round((time.perf_counter() - start) / n_calls * 1e6, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-calls", type=int, default=200000)
+    parser.add_argument("--n-threads", type=int, default=8)
+    args = parser.parse_args()
+
+    registry = Metrics()
+
+    def span():
+        with registry.span("bench"):
+            pass
+
+    def inc():
+        registry.inc("kiosk_polls_total", operation="bench")
+
+    report = {
+        "n_calls": args.n_calls,
+        "baseline_us": {
+            str(n): per_call_us(lambda: None, args.n_calls, n)
+            for n in [1, args.n_threads]
+        },
+        "span_us": {
+            str(n): per_call_us(span, args.n_calls, n) for n in [1, args.n_threads]
+        },
+        "inc_us": {
+            str(n): per_call_us(inc, args.n_calls, n) for n in [1, args.n_threads]
+        },
+    }
+    start = time.perf_counter()
+    registry.render()
+    report["render_ms"] = round((time.perf_counter() - start) * 1e3, 3)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
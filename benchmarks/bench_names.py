@@ -0,0 +1,114 @@
+"""
+Benchmark of fuzzy name lookups in the flight manifest.
+
+Builds the synthetic manifest of --n-flights flights configured under
+data.synthetic, misreads the names of --n-queries of its passengers the way
+OCR does (a letter dropped, replaced or doubled, a lost space, a middle
+name, first and last name swapped) and looks them up with match_name. Prints
+the lookup latency, how often the passenger is the best or among the
+--top-k candidates, and how often find_passenger accepts the right or a
+wrong passenger with the date of birth at --min-score as JSON.
+
+    python -m benchmarks.bench_names --n-flights 1000 --n-queries 5000
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from src.utils_manifest import ManifestStore
+from src.utils_synthetic import generate_manifest
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def misread(name: str, rng: np.random.Generator) -> str:
+    "name with one OCR-like error"
+    i = int(rng.integers(1, len(name) - 1))
+    kind = rng.integers(0, 6)
+    if kind == 0:
+        return name[:i] + name[i + 1 :]
+    if kind == 1:
+        return name[:i] + rng.choice(list(LETTERS)) + name[i + 1 :]
+    if kind == 2:
+        return name[:i] + name[i] + name[i:]
+    if kind == 3:
+        return name.replace(" ", "", 1)
+    first_name, _, last_name = name.partition(" ")
+    if kind == 4:
+        return f"{first_name} {rng.choice(['Marie', 'James', 'Lee'])} {last_name}"
+    return f"{last_name} {first_name}"
+
+
+def percentiles(seconds: list) -> dict:
+    ms = np.array(seconds) * 1000
+    return {f"p{q}": round(float(np.percentile(ms, q)), 4) for q in [50, 95, 99]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-flights", type=int, default=1000)
+    parser.add_argument("--n-queries", type=int, default=2000)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--min-score", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    with open("config.yaml") as f:
+        config = yaml.safe_load(f)
+    config["data"]["synthetic"]["n_flights"] = args.n_flights
+    manifest = pd.concat(generate_manifest(config), ignore_index=True)
+
+    start = time.perf_counter()
+    store = ManifestStore(manifest, min_name_score=args.min_score)
+    seconds_index = time.perf_counter() - start
+
+    rng = np.random.default_rng(args.seed)
+    sample = manifest.iloc[rng.choice(len(manifest), args.n_queries, replace=False)]
+    seconds_exact, seconds_fuzzy = [], []
+    top_1 = top_k = accepted = wrong = 0
+    for label, row in sample.iterrows():
+        name = misread(row["name"], rng)
+        start = time.perf_counter()
+        store.find_name(row["name"])
+        seconds_exact.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        matches = store.match_name(name, row["birthdate"], top_k=args.top_k)
+        seconds_fuzzy.append(time.perf_counter() - start)
+        labels = [match.label for match in matches]
+        top_1 += labels[:1] == [label]
+        top_k += label in labels
+
+        # a misread name may be another passenger's name
+        passenger = store.find_passenger(name, row["birthdate"])
+        accepted += passenger == [label]
+        wrong += bool(passenger) and passenger != [label]
+
+    print(
+        json.dumps(
+            {
+                "n_rows": len(manifest),
+                "n_names": int(store.name_keys.nunique()),
+                "n_queries": args.n_queries,
+                "seconds_index": round(seconds_index, 3),
+                "ms_exact": percentiles(seconds_exact),
+                "ms_fuzzy": percentiles(seconds_fuzzy),
+                "top_1": round(top_1 / args.n_queries, 4),
+                f"top_{args.top_k}": round(top_k / args.n_queries, 4),
+                "accepted": round(accepted / args.n_queries, 4),
+                "accepted_wrong": round(wrong / args.n_queries, 4),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark of validation partitioned by flight against the in-process store.
+
+Builds a manifest of --n-flights flights, validates --n-passengers of its
+passengers with pipeline_validate on one ManifestStore and then through a
+PartitionedManifest with --workers processes, --concurrency passengers in
+flight. Checks that both set the same flags and prints both throughputs as
+JSON. Names booked on several flights are only validated on the flight of
+the boarding pass by the partitions, so their flags may differ. Throughput
+of the partitions grows with the cores available to them: on a single core
+they only add the round trip to the worker, which is why get_manifest
+falls back to the store there. Compare on a machine with several cores.
+
+    python -m benchmarks.bench_partition --workers 4 --n-passengers 20000
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from benchmarks.bench_validate_batch import make_extracted
+from benchmarks.bench_validate_batch import make_manifest
+from src.utils_manifest import ManifestStore
+from src.utils_manifest import compact_manifest
+from src.utils_partition import PartitionedManifest
+from src.utils_validate import pipeline_validate
+
+FLAGS = ["valid_dob", "valid_name", "valid_boardingpass", "valid_person"]
+
+
+def detection_results(extracted, rng: np.random.Generator) -> list:
+    "ID, boarding pass, face and lighter results per passenger"
+    results = []
+    for row in extracted.to_dict(orient="records"):
+        dict_boardingpass = {
+            k[len("bp_") :]: v for k, v in row.items() if k.startswith("bp_")
+        }
+        dict_face = {"face_is_identical": rng.random() < 0.9, "confidence": 0.9}
+        dict_lighter = {"probabilities_topn": {"lighter": [rng.random() * 0.3]}}
+        results.append((row, dict_boardingpass, dict_face, dict_lighter))
+
+    return results
+
+
+async def validate_partitioned(partitions, results, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(result):
+        async with semaphore:
+            return await partitions.validate(*result)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[bounded(r) for r in results])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-rows", type=int, default=100_000)
+    parser.add_argument("--n-flights", type=int, default=200)
+    parser.add_argument("--n-passengers", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+
+    # workers take over the level, logging.disable would not reach them
+    logging.getLogger().setLevel(logging.ERROR)
+    rng = np.random.default_rng(args.seed)
+    manifest = make_manifest(args.n_rows, args.n_flights, rng)
+    # make_extracted perturbs arrays it shares with the manifest
+    extracted = make_extracted(manifest.copy(), rng)
+    manifest = compact_manifest(manifest)
+    sample = rng.choice(len(manifest), args.n_passengers, replace=False)
+    results = detection_results(extracted.iloc[sample], rng)
+
+    store = ManifestStore(manifest.copy())
+    start = time.perf_counter()
+    for result in results:
+        pipeline_validate(store, *result)
+    seconds_store = time.perf_counter() - start
+
+    with PartitionedManifest(manifest, n_partitions=args.workers) as partitions:
+        seconds_partitioned = asyncio.run(
+            validate_partitioned(partitions, results, args.concurrency)
+        )
+        partitioned = asyncio.run(partitions.rows()).sort_index()
+
+    mismatches = {
+        flag: int((store.df[flag] != partitioned[flag]).sum()) for flag in FLAGS
+    }
+    print(
+        json.dumps(
+            {
+                "n_rows": args.n_rows,
+                "n_passengers": args.n_passengers,
+                "workers": args.workers,
+                "cpu_count": os.cpu_count(),
+                "per_second_store": round(args.n_passengers / seconds_store, 1),
+                "per_second_partitioned": round(
+                    args.n_passengers / seconds_partitioned, 1
+                ),
+                "valid": {flag: int(store.df[flag].sum()) for flag in FLAGS},
+                "mismatches": mismatches,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""
+End-to-end benchmark of the passenger pipeline against local fakes.
+
+Builds the kiosk clients like main.py, but on in-process fakes of Form
+Recognizer (identity documents), Face and Custom Vision and on the local
+REST fake of the custom boarding pass model. Generates a manifest and the
+documents of --n-passengers, runs them with --concurrency passengers in
+flight and prints throughput, passenger latency percentiles, per stage
+latencies and the calls per fake service as JSON. Needs no Azure keys.
+
+A share --text-layer-rate of boarding passes is printed to PDF with a text
+layer and read locally, the others are left to the fake custom model. A
+share --barcode-rate of ID cards carries an AAMVA PDF417 barcode and is not
+sent to the fake Form Recognizer. Lighter and face detections run in the
+micro-batches of kiosk.batching unless --no-batching is given, service calls
+take tokens of kiosk.rate_limits unless --no-rate-limits is given.
+
+    python -m benchmarks.bench_pipeline --n-passengers 200 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import contextlib
+import copy
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+import pandas as pd
+from PIL import Image
+
+from benchmarks.fake_formrecognizer import FIELDS_MARKER
+from benchmarks.fake_formrecognizer import FakeFormRecognizerServer
+from benchmarks.fake_formrecognizer import fake_boardingpass
+from benchmarks.fake_services import FakeCustomVisionPredictor
+from benchmarks.fake_services import FakeCustomVisionTrainer
+from benchmarks.fake_services import FakeFaceClient
+from benchmarks.fake_services import FakeFormRecognizerClient
+from benchmarks.fake_services import ServiceProfile
+from benchmarks.fake_services import SyntheticImages
+from main import build_clients
+from src.utils_data import load_config
+from src.utils_http import get_http_client
+from src.utils_manifest import ManifestStore
+from src.utils_manifest import compact_manifest
+from src.utils_metrics import metrics
+from src.utils_partition import PartitionedManifest
+from src.utils_pipeline import run_passengers
+from src.utils_sink import get_sink
+from src.utils_synthetic import aamva_text
+from src.utils_synthetic import barcode_image
+from src.utils_synthetic import boardingpass_pdf
+
+FIRST_NAMES = ["Anna", "Ben", "Clara", "David", "Emma", "Felix", "Greta", "Hugo"]
+FIRST_NAMES += ["Ida", "Jonas", "Katja", "Lukas", "Mia", "Noah", "Olga", "Paul"]
+LAST_NAMES = ["Adler", "Becker", "Claus", "Dietrich", "Engel", "Fischer", "Graf"]
+LAST_NAMES += ["Hahn", "Imhof", "Jung", "Keller", "Lang", "Maier", "Neumann"]
+FLIGHT = {
+    "flight_number": "LH-398",
+    "flight_date": "2022-01-15",
+    "flight_time": "11:00",
+    "origin": "Frankfurt",
+    "destination": "Salzburg",
+    "gate": "3A",
+}
+
+
+def passenger_identity(i: int) -> dict:
+    "Unique name, date of birth and seat of synthetic passenger i"
+    first = FIRST_NAMES[i % len(FIRST_NAMES)]
+    last = LAST_NAMES[(i // len(FIRST_NAMES)) % len(LAST_NAMES)]
+    repeat = i // (len(FIRST_NAMES) * len(LAST_NAMES))
+    if repeat:
+        # middle initials keep names unique beyond the name combinations
+        first += " " + "".join(
+            chr(ord("A") + (repeat - 1) // 26**k % 26) for k in range(2)
+        )
+    rng = random.Random(i)
+
+    return {
+        "first_name": first,
+        "last_name": last,
+        "dob": date(rng.randint(1940, 2004), rng.randint(1, 12), rng.randint(1, 28)),
+        "seat": f"{i // 6 + 1}{'ABCDEF'[i % 6]}",
+    }
+
+
+def make_manifest(passengers: dict) -> pd.DataFrame:
+    "Flight manifest as read by get_flight_manifest"
+    return compact_manifest(
+        pd.DataFrame(
+            [
+                {
+                    **FLIGHT,
+                    "flight_date": pd.Timestamp(FLIGHT["flight_date"]),
+                    "name": f"{p['first_name']} {p['last_name']}",
+                    "sex": "F",
+                    "birthdate": pd.Timestamp(p["dob"]),
+                    "seat": p["seat"],
+                    "valid_dob": False,
+                    "valid_person": False,
+                    "valid_luggage": False,
+                    "valid_name": False,
+                    "valid_boardingpass": False,
+                }
+                for p in passengers.values()
+            ]
+        )
+    )
+
+
+def boardingpass_fields(passenger: dict) -> dict:
+    "Fields of the custom boarding pass model matching the manifest"
+    airline, flight_number = FLIGHT["flight_number"].split("-")
+    return {
+        "name": f"{passenger['first_name']} {passenger['last_name']}",
+        "seat": passenger["seat"],
+        "airline": airline,
+        "flight_number": flight_number,
+        "origin": FLIGHT["origin"],
+        "destination": FLIGHT["destination"],
+        "date": datetime.strptime(FLIGHT["flight_date"], "%Y-%m-%d").strftime("%d.%m"),
+        "flight_boarding": (
+            datetime.strptime(FLIGHT["flight_time"], "%H:%M") - timedelta(minutes=30)
+        ).strftime("%H:%M"),
+    }
+
+
+def printed_boardingpass(i: int, passenger: dict) -> bytes:
+    "Boarding pass PDF with text layer, its fields appended for the fake model"
+    document = boardingpass_pdf(
+        {
+            **FLIGHT,
+            "name": f"{passenger['first_name']} {passenger['last_name']}",
+            "seat": passenger["seat"],
+        },
+        ticket=f"ETK-{i:012d}C",
+    )
+
+    return (
+        document + FIELDS_MARKER + json.dumps(boardingpass_fields(passenger)).encode()
+    )
+
+
+def add_id_barcode(filepath: str, i: int, passenger: dict) -> None:
+    "Pastes the AAMVA PDF417 of passenger on the ID image, keeping its size"
+    barcode = barcode_image(
+        aamva_text(
+            {
+                "name": f"{passenger['first_name']} {passenger['last_name']}",
+                "birthdate": passenger["dob"],
+                "sex": "F",
+            },
+            license_number=f"D{i:07d}",
+        ),
+        scale=1,
+    )
+    with Image.open(filepath) as img:
+        card = img.convert("RGB")
+    card.paste(barcode.convert("RGB"), (0, 0))
+    card.save(filepath, "JPEG", quality=95)
+
+
+def make_documents(
+    directory: str,
+    images: SyntheticImages,
+    passengers: dict,
+    n_thumbs: int,
+    lighter_rate: float,
+    mismatch_rate: float,
+    text_layer_rate: float = 0.0,
+    barcode_rate: float = 0.0,
+    seed: int = 11,
+) -> list:
+    """Writes boarding pass, ID, luggage image and video thumbnails per passenger.
+
+    A share mismatch_rate of passengers shows someone else in the video,
+    a share lighter_rate carries a lighter, a share text_layer_rate has a
+    boarding pass with text layer and a share barcode_rate an ID card with
+    barcode.
+    """
+    rng = random.Random(seed)
+    # own generators, so that the other draws do not depend on these rates
+    rng_text = random.Random(seed + 1)
+    rng_barcode = random.Random(seed + 2)
+    documents = []
+    for i, passenger in passengers.items():
+        prefix = os.path.join(directory, f"{i:06d}")
+        paths = {
+            "boarding": f"{prefix}_boarding.pdf",
+            "id": f"{prefix}_id.jpg",
+            "lighter": f"{prefix}_lighter.jpg",
+            "thumbs": [f"{prefix}_thumb{k}.jpg" for k in range(n_thumbs)],
+        }
+        with open(paths["boarding"], "wb") as f:
+            if rng_text.random() < text_layer_rate:
+                f.write(printed_boardingpass(i, passenger))
+            else:
+                f.write(fake_boardingpass(boardingpass_fields(passenger)))
+        images.write(paths["id"], seed=i, person=i)
+        if rng_barcode.random() < barcode_rate:
+            add_id_barcode(paths["id"], i, passenger)
+        images.write(paths["lighter"], seed=i, lighter=rng.random() < lighter_rate)
+        in_video = -1 if rng.random() < mismatch_rate else i
+        for k, thumb in enumerate(paths["thumbs"]):
+            images.write(thumb, seed=i * n_thumbs + k, person=in_video)
+        documents.append(paths)
+
+    return documents
+
+
+def bench_config(
+    directory: str, preprocess: bool, batching: bool = True, rate_limits: bool = True
+) -> dict:
+    "config.yaml with results and cache kept out of data/"
+    config = copy.deepcopy(load_config())
+    kiosk = config["kiosk"]
+    kiosk["lighter_detector"]["backend"] = "azure"
+    kiosk["sink"]["directory"] = os.path.join(directory, "validated")
+    kiosk["cache"]["directory"] = None
+    kiosk["preprocess"]["enabled"] = preprocess
+    kiosk["batching"]["enabled"] = batching
+    kiosk["rate_limits"]["enabled"] = rate_limits
+
+    return config
+
+
+async def run(clients, store, documents, concurrency: int, sink) -> tuple:
+    start = time.perf_counter()
+    results = await run_passengers(
+        clients, store, documents, concurrency=concurrency, sink=sink
+    )
+    seconds = time.perf_counter() - start
+    rows = await store.rows() if isinstance(store, PartitionedManifest) else store.df
+
+    return results, seconds, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-passengers", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--n-thumbs", type=int, default=3)
+    parser.add_argument("--id-seconds", type=float, default=1.5)
+    parser.add_argument("--analyze-seconds", type=float, default=0.8)
+    parser.add_argument("--face-seconds", type=float, default=0.15)
+    parser.add_argument("--vision-seconds", type=float, default=0.2)
+    parser.add_argument("--sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--lighter-rate", type=float, default=0.1)
+    parser.add_argument("--mismatch-rate", type=float, default=0.1)
+    parser.add_argument("--text-layer-rate", type=float, default=0.0)
+    parser.add_argument("--barcode-rate", type=float, default=0.0)
+    parser.add_argument("--preprocess", action="store_true")
+    parser.add_argument("--no-batching", action="store_true")
+    parser.add_argument("--no-rate-limits", action="store_true")
+    parser.add_argument("--partitions", type=int, default=0, help="worker processes")
+    parser.add_argument("--output", help="write the report to this file as well")
+    args = parser.parse_args()
+
+    # main.py configures INFO logging on import
+    logging.getLogger().setLevel(logging.WARNING)
+    metrics.reset()
+
+    def profile(median_seconds: float, seed: int) -> ServiceProfile:
+        return ServiceProfile(median_seconds, args.sigma, args.error_rate, seed=seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = bench_config(
+            directory, args.preprocess, not args.no_batching, not args.no_rate_limits
+        )
+        images = SyntheticImages()
+        passengers = {i: passenger_identity(i) for i in range(args.n_passengers)}
+        documents = make_documents(
+            directory,
+            images,
+            passengers,
+            args.n_thumbs,
+            args.lighter_rate,
+            args.mismatch_rate,
+            args.text_layer_rate,
+            args.barcode_rate,
+        )
+
+        server = FakeFormRecognizerServer(
+            median_seconds=args.analyze_seconds,
+            sigma=args.sigma,
+            error_rate=args.error_rate,
+        ).start()
+        form_recognizer_client = FakeFormRecognizerClient(
+            images, passengers, profile(args.id_seconds, seed=1)
+        )
+        face_client = FakeFaceClient(images, profile(args.face_seconds, seed=2))
+        trainer = FakeCustomVisionTrainer(ServiceProfile(0.0))
+        predictor = FakeCustomVisionPredictor(
+            images, profile(args.vision_seconds, seed=3)
+        )
+        http = get_http_client(config)
+        clients = build_clients(
+            config,
+            form_recognizer_client,
+            face_client,
+            trainer,
+            predictor,
+            http=http,
+            form_recognizer_key="fake",
+            form_recognizer_endpoint=server.endpoint,
+            form_recognizer_model_id="fake-model",
+            customvision_project_name="lighter-detection",
+            customvision_publish_name="fake",
+        )
+        manifest = make_manifest(passengers)
+        if clients.rate_limiter is not None:
+            clients.rate_limiter.update_departures(manifest)
+        store = (
+            PartitionedManifest(manifest, args.partitions)
+            if args.partitions
+            else ManifestStore(manifest)
+        )
+
+        # passenger messages would interleave with the report
+        with get_sink(config) as sink, open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                results, seconds, rows = asyncio.run(
+                    run(clients, store, documents, args.concurrency, sink)
+                )
+
+        clients.lighter_detector.close()
+        http.close()
+        server.shutdown()
+        if clients.preprocessor is not None:
+            clients.preprocessor.close()
+        if clients.barcodes is not None:
+            clients.barcodes.close()
+        if args.partitions:
+            store.close()
+
+    stages = metrics.quantiles()
+    reader = clients.boardingpass_reader
+    remote_seconds = {
+        document: stages.get(stage, {}).get("mean")
+        for document, stage in [("id", "id_ocr"), ("boardingpass", "boardingpass")]
+    }
+    report = {
+        "n_passengers": args.n_passengers,
+        "concurrency": args.concurrency,
+        "partitions": args.partitions,
+        "wall_seconds": round(seconds, 3),
+        "throughput_per_second": round(args.n_passengers / seconds, 3),
+        "failed": sum(isinstance(r, Exception) for r in results),
+        "boarding_allowed": int(rows.filter(like="valid").sum(axis=1).ge(3).sum()),
+        "passenger_seconds": stages.pop("passenger", None),
+        "boardingpass_local": (
+            reader.stats(remote_seconds["boardingpass"]) if reader else None
+        ),
+        "barcodes": (
+            clients.barcodes.stats(remote_seconds) if clients.barcodes else None
+        ),
+        "batches": {
+            batcher.name: batcher.stats()
+            for batcher in [
+                getattr(clients.lighter_detector, "batcher", None),
+                getattr(clients.face_registry, "batcher", None),
+            ]
+            if batcher is not None
+        },
+        "ratelimit_wait_seconds": metrics.quantiles("kiosk_ratelimit_wait_seconds"),
+        "stage_seconds": stages,
+        "services": {
+            "form_recognizer_id": form_recognizer_client.profile.stats(),
+            "form_recognizer_analyze": {
+                "calls": {"get": server.n_get},
+                "errors": {"get": server.n_errors},
+            },
+            "face": face_client.profile.stats(),
+            "custom_vision": predictor.profile.stats(),
+        },
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
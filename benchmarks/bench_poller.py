@@ -0,0 +1,122 @@
+"""
+Benchmark of boarding pass polling against a local fake Form Recognizer.
+
+Compares the former fixed-sleep loop (sleep 2s before every GET) with the
+adaptive poller and prints p50/p99 latency per document and the number of
+GET requests as JSON.
+
+    python -m benchmarks.bench_poller --n-documents 50
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from requests import get
+
+from benchmarks.fake_formrecognizer import FakeFormRecognizerServer
+from src.utils_data import get_url_boardingpass
+from src.utils_data import get_dict_boardingpass_async
+
+
+def fixed_sleep_boardingpass(
+    get_url: str, apikey: str, n_retries: int = 4, sleep_seconds: int = 2
+) -> dict:
+    "Polling as done before the adaptive poller, without quit()"
+    for i in range(n_retries):
+        time.sleep(sleep_seconds)
+        resp_get = get(url=get_url, headers={"Ocp-Apim-Subscription-Key": apikey})
+        result = resp_get.json()
+        if result.get("status") == "succeeded":
+            return result
+    return None
+
+
+def percentiles(latencies: list) -> dict:
+    return {
+        "p50": float(np.percentile(latencies, 50)),
+        "p99": float(np.percentile(latencies, 99)),
+        "max": float(np.max(latencies)),
+    }
+
+
+def submit(server: FakeFormRecognizerServer, n_documents: int) -> list:
+    return [
+        (
+            time.perf_counter(),
+            get_url_boardingpass(
+                b"%PDF-fake",
+                apikey="fake",
+                endpoint=server.endpoint,
+                model_id="fake-model",
+            ),
+        )
+        for _ in range(n_documents)
+    ]
+
+
+def bench_fixed_sleep(server: FakeFormRecognizerServer, n_documents: int) -> dict:
+    server.n_get = 0
+    submitted = submit(server, n_documents)
+
+    def run(item):
+        start, get_url = item
+        fixed_sleep_boardingpass(get_url, apikey="fake")
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=n_documents) as executor:
+        latencies = list(executor.map(run, submitted))
+
+    return {**percentiles(latencies), "n_get": server.n_get}
+
+
+def bench_adaptive(server: FakeFormRecognizerServer, n_documents: int) -> dict:
+    "Polls all operations from one event loop, latency is taken per document"
+    server.n_get = 0
+    submitted = submit(server, n_documents)
+    latencies = []
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=32))
+
+        async def one(start, get_url):
+            await get_dict_boardingpass_async(get_url, apikey="fake")
+            latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*[one(start, get_url) for start, get_url in submitted])
+
+    asyncio.run(run())
+
+    return {**percentiles(latencies), "n_get": server.n_get}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-documents", type=int, default=50)
+    parser.add_argument("--median-seconds", type=float, default=0.8)
+    parser.add_argument("--retry-after", type=float, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    server = FakeFormRecognizerServer(
+        median_seconds=args.median_seconds, retry_after=args.retry_after
+    ).start()
+
+    report = {
+        "n_documents": args.n_documents,
+        "median_analysis_seconds": args.median_seconds,
+        "fixed_sleep": bench_fixed_sleep(server, args.n_documents),
+        "adaptive": bench_adaptive(server, args.n_documents),
+    }
+    print(json.dumps(report, indent=2))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark of client-side preprocessing per service.
+
+Generates camera-sized photos (some with a rotated EXIF orientation) and
+small video thumbnails, runs them through the Preprocessor with the profiles
+of config.yaml and prints per stage the bytes before and after, the
+preprocessing time and the end-to-end latency per image including the
+upload at --uplink-mbps, with and without preprocessing, as JSON. The
+upload time is modeled from the payload size, the preprocessing is measured.
+
+    python -m benchmarks.bench_preprocess --n-images 8 --uplink-mbps 10
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from src.utils_data import load_config
+from src.utils_preprocess import PreprocessProfile
+from src.utils_preprocess import Preprocessor
+from benchmarks.bench_poller import percentiles
+
+# stage name, profile, image size of the kiosk camera
+STAGES = [
+    ("id_ocr", "id", (4032, 3024)),
+    ("id_face", "face", (4032, 3024)),
+    ("lighter", "lighter", (4032, 3024)),
+    ("thumbnail", "face", (320, 240)),
+]
+
+
+def make_photo(filepath: str, size: tuple, seed: int, rotated: bool = False):
+    "Smooth gradients with sensor noise, saved like a phone camera JPEG"
+    rng = np.random.default_rng(seed)
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack(
+        [
+            128
+            + 100
+            * np.sin(x / (width / rng.uniform(2, 6)) + c)
+            * np.cos(y / (height / rng.uniform(2, 6)))
+            for c in range(3)
+        ],
+        axis=-1,
+    )
+    noise = rng.normal(0, 6, size=base.shape)
+    img = Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+    exif = Image.Exif()
+    if rotated:
+        exif[0x0112] = 6
+    img.save(filepath, "JPEG", quality=95, exif=exif.tobytes())
+
+
+async def run_stage(preprocessor, profile_name: str, filepaths: list) -> list:
+    "Seconds per image, one image at a time"
+    seconds = []
+    for filepath in filepaths:
+        start = time.perf_counter()
+        await preprocessor.preprocess(profile_name, filepath)
+        seconds.append(time.perf_counter() - start)
+
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-images", type=int, default=8)
+    parser.add_argument("--uplink-mbps", type=float, default=10.0)
+    parser.add_argument("--max-workers", type=int, default=2)
+    args = parser.parse_args()
+
+    profiles = {
+        name: PreprocessProfile(**profile)
+        for name, profile in load_config()["kiosk"]["preprocess"]["profiles"].items()
+    }
+    bytes_per_second = args.uplink_mbps * 1e6 / 8
+    report = {"n_images": args.n_images, "uplink_mbps": args.uplink_mbps}
+
+    with tempfile.TemporaryDirectory() as directory, Preprocessor(
+        profiles, max_workers=args.max_workers
+    ) as preprocessor:
+        # start the workers before measuring
+        warmup = os.path.join(directory, "warmup.jpg")
+        make_photo(warmup, (64, 48), seed=0)
+        asyncio.run(run_stage(preprocessor, "face", [warmup] * args.max_workers))
+        for stage, profile_name, size in STAGES:
+            filepaths = []
+            for i in range(args.n_images):
+                filepath = os.path.join(directory, f"{stage}_{i}.jpg")
+                make_photo(filepath, size, seed=i, rotated=i % 2 == 1)
+                filepaths.append(filepath)
+
+            counters_before = dict(preprocessor.counters[profile_name])
+            seconds = asyncio.run(run_stage(preprocessor, profile_name, filepaths))
+            counters = preprocessor.counters[profile_name]
+            bytes_in = counters["bytes_in"] - counters_before["bytes_in"]
+            bytes_out = counters["bytes_out"] - counters_before["bytes_out"]
+
+            upload_before = bytes_in / args.n_images / bytes_per_second
+            upload_after = bytes_out / args.n_images / bytes_per_second
+            report[stage] = {
+                "kb_in_per_image": round(bytes_in / args.n_images / 1024, 1),
+                "kb_out_per_image": round(bytes_out / args.n_images / 1024, 1),
+                "bytes_saved": bytes_in - bytes_out,
+                "preprocess_seconds": percentiles(seconds),
+                "latency_before_seconds": upload_before,
+                "latency_after_seconds": float(np.mean(seconds)) + upload_after,
+            }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Benchmark of the rate limiter against a fake service enforcing its quota.
+
+--n-passengers passengers of flights departing within the next two hours
+make --calls-per-passenger calls each, --concurrency of them at a time, to a
+fake service answering HTTP 429 with Retry-After above --quota calls per
+second. Runs them with every call sent right away, failing the passenger
+on 429 as the boarding pass POST did, through a limiter serving calls in
+arrival order and through one serving them by departure. Prints failures,
+429 responses and the time until the passengers departing first and the
+others are done as JSON. Limited calls wait up to --max-wait seconds for
+one of --burst tokens saved up.
+
+    python -m benchmarks.bench_ratelimit --n-passengers 200 --quota 10
+"""
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+from src.utils_ratelimit import DEADLINE
+from src.utils_ratelimit import Deadline
+from src.utils_ratelimit import RateLimiter
+from src.utils_ratelimit import TokenBucket
+
+
+class FakeThrottled(Exception):
+    "HTTP 429 of the fake service, with the response like msrest errors"
+
+    def __init__(self, retry_after: float):
+        super().__init__("Too many requests")
+        self.response = SimpleNamespace(
+            status_code=429, headers={"Retry-After": str(retry_after)}
+        )
+
+
+class FakeQuotaService:
+    "Answers calls after a lognormal latency, 429 above quota calls per second"
+
+    def __init__(self, quota: float, median_seconds: float, seed: int = 11):
+        self.quota = quota
+        self.median_seconds = median_seconds
+        self.random = random.Random(seed)
+        self.calls = self.throttled = 0
+        self._window = []
+        self._lock = threading.Lock()
+
+    def call(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._window = [t for t in self._window if now - t < 1.0]
+            if len(self._window) >= self.quota:
+                self.throttled += 1
+                retry_after = round(1.0 - (now - self._window[0]), 2)
+                raise FakeThrottled(max(0.01, retry_after))
+            self._window.append(now)
+            self.calls += 1
+            latency = self.median_seconds * self.random.lognormvariate(0, 0.5)
+        time.sleep(latency)
+
+
+def run(args, limiter: RateLimiter = None, by_departure: bool = True) -> dict:
+    service = FakeQuotaService(args.quota, args.call_seconds)
+    rng = np.random.default_rng(args.seed)
+    start = time.monotonic()
+    departures = start + rng.uniform(0, 7200, args.n_passengers)
+
+    def passenger(departure: float):
+        DEADLINE.set(Deadline(departure if by_departure else float("inf")))
+        try:
+            for _ in range(args.calls_per_passenger):
+                if limiter is None:
+                    service.call()
+                else:
+                    limiter.call("service", service.call)
+        except Exception:
+            return None
+        return time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        done = list(executor.map(passenger, departures))
+
+    # the quarter of passengers departing first
+    first = departures <= np.quantile(departures, 0.25)
+    seconds = np.array([np.nan if d is None else d for d in done])
+
+    def percentiles(values: np.ndarray) -> dict:
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return None
+        return {f"p{q}": round(float(np.percentile(values, q)), 3) for q in [50, 95]}
+
+    return {
+        "failed": int(np.isnan(seconds).sum()),
+        "throttled": service.throttled,
+        "wall_seconds": round(time.monotonic() - start, 3),
+        "seconds_departing_first": percentiles(seconds[first]),
+        "seconds_others": percentiles(seconds[~first]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-passengers", type=int, default=200)
+    parser.add_argument("--calls-per-passenger", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--quota", type=float, default=10, help="calls per second")
+    parser.add_argument("--burst", type=float, default=1)
+    parser.add_argument("--max-wait", type=float, default=120)
+    parser.add_argument("--call-seconds", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    def limiter() -> RateLimiter:
+        return RateLimiter(
+            {"service": TokenBucket("service", args.quota, args.burst)},
+            max_wait=args.max_wait,
+        )
+
+    print(
+        json.dumps(
+            {
+                "unlimited": run(args),
+                "arrival_order": run(args, limiter(), by_departure=False),
+                "by_departure": run(args, limiter()),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Benchmark of batched manifest revalidation against the scalar validators.
+
+Builds a synthetic manifest and extracted ID/boarding pass fields with a
+share of perturbed rows, checks that validate_manifest_batch agrees with
+validate_name_dob and validate_boardingpass on every row and prints both
+timings as JSON.
+
+    python -m benchmarks.bench_validate_batch --n-rows 100000
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.utils_manifest import ManifestStore
+from src.utils_validate import validate_boardingpass
+from src.utils_validate import validate_manifest_batch
+from src.utils_validate import validate_name_dob
+
+
+def make_manifest(n_rows: int, n_flights: int, rng: np.random.Generator):
+    flights = np.array([f"LH-{100 + i}" for i in range(n_flights)])
+    flight_idx = rng.integers(0, n_flights, n_rows)
+    # some names occur twice to exercise the multiple-match path
+    names = np.array([f"Passenger {i}" for i in range(n_rows)], dtype=object)
+    dup = rng.random(n_rows) < 0.01
+    names[dup] = names[rng.integers(0, n_rows, dup.sum())]
+
+    return pd.DataFrame(
+        {
+            "flight_number": flights[flight_idx],
+            "flight_date": pd.Timestamp("2022-01-15")
+            + pd.to_timedelta(flight_idx % 7, unit="D"),
+            "flight_time": np.array(["06:15", "11:00", "18:45", "00:20"])[
+                flight_idx % 4
+            ],
+            "origin": "Frankfurt",
+            "destination": np.array(["Salzburg", "Vienna", "Rome"])[flight_idx % 3],
+            "name": names,
+            "sex": "F",
+            "birthdate": pd.Timestamp("1950-01-01")
+            + pd.to_timedelta(rng.integers(0, 20000, n_rows), unit="D"),
+            "seat": [
+                f"{r}{c}"
+                for r, c in zip(rng.integers(1, 40, n_rows), "ABCDEF" * n_rows)
+            ],
+            "valid_dob": False,
+            "valid_person": False,
+            "valid_luggage": False,
+            "valid_name": False,
+            "valid_boardingpass": False,
+        }
+    )
+
+
+def make_extracted(manifest: pd.DataFrame, rng: np.random.Generator) -> pd.DataFrame:
+    n_rows = len(manifest)
+    airline, number = (
+        manifest["flight_number"].str.split("-", n=1, expand=True).T.to_numpy()
+    )
+    extracted = pd.DataFrame(
+        {
+            "full_name": manifest["name"].to_numpy(),
+            "dob": manifest["birthdate"].dt.date.to_numpy(),
+            "bp_name": manifest["name"].to_numpy(),
+            "bp_seat": manifest["seat"].to_numpy(),
+            "bp_airline": airline,
+            "bp_flight_number": number,
+            "bp_origin": manifest["origin"].to_numpy(),
+            "bp_destination": manifest["destination"].to_numpy(),
+            "bp_date": manifest["flight_date"].dt.strftime("%d.%m").to_numpy(),
+            "bp_flight_boarding": (
+                pd.to_datetime(manifest["flight_time"], format="%H:%M")
+                - pd.Timedelta(minutes=30)
+            )
+            .dt.strftime("%H:%M")
+            .to_numpy(),
+        }
+    )
+    # perturb a share of the fields
+    for column, value in [
+        ("full_name", "Nobody Known"),
+        ("dob", pd.Timestamp("2000-01-01").date()),
+        ("bp_seat", "99Z"),
+        ("bp_date", "01.01"),
+        ("bp_flight_boarding", "12:34"),
+        ("bp_name", "Jane O'Brien"),
+    ]:
+        extracted.loc[rng.random(n_rows) < 0.02, column] = value
+
+    return extracted
+
+
+def validate_scalar(extracted: pd.DataFrame, store: ManifestStore) -> pd.DataFrame:
+    valid_name_dob, valid_boardingpass = [], []
+    for row in extracted.to_dict(orient="records"):
+        dict_boardingpass = {
+            k[len("bp_") :]: v for k, v in row.items() if k.startswith("bp_")
+        }
+        valid_name_dob.append(validate_name_dob(row, store))
+        valid_boardingpass.append(validate_boardingpass(dict_boardingpass, store))
+
+    return pd.DataFrame(
+        {"valid_name": valid_name_dob, "valid_boardingpass": valid_boardingpass},
+        index=extracted.index,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-rows", type=int, default=100_000)
+    parser.add_argument("--n-flights", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--min-name-score", type=float, default=None)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    rng = np.random.default_rng(args.seed)
+    manifest = make_manifest(args.n_rows, args.n_flights, rng)
+    extracted = make_extracted(manifest, rng)
+    store = ManifestStore(manifest, min_name_score=args.min_name_score)
+
+    start = time.perf_counter()
+    scalar = validate_scalar(extracted, store)
+    seconds_scalar = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = validate_manifest_batch(extracted, store)
+    seconds_batch = time.perf_counter() - start
+
+    mismatches = {
+        column: int((scalar[column] != batch[column]).sum())
+        for column in ["valid_name", "valid_boardingpass"]
+    }
+
+    print(
+        json.dumps(
+            {
+                "n_rows": args.n_rows,
+                "seconds_scalar": seconds_scalar,
+                "seconds_batch": seconds_batch,
+                "speedup": seconds_scalar / seconds_batch,
+                "valid_boardingpass": int(batch["valid_boardingpass"].sum()),
+                "mismatches": mismatches,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
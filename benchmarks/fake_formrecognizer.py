@@ -0,0 +1,175 @@
+"""
+Local fake of the Form Recognizer v2.1 custom model REST API.
+
+POST .../custom/models/{model_id}/analyze returns 202 with an
+operation-location, GET on that location reports "running" until the
+simulated analysis time has passed and "succeeded" afterwards. Serves HTTPS
+if an ssl context is given.
+
+A document may carry its own fields as JSON after the FIELDS_MARKER line,
+see `fake_boardingpass`, otherwise the fixed BOARDINGPASS_FIELDS are returned.
+"""
+
+import json
+import random
+import ssl
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+BOARDINGPASS_FIELDS = {
+    "name": "Kevin Lee",
+    "seat": "4A",
+    "airline": "LH",
+    "flight_number": "398",
+    "origin": "Frankfurt",
+    "destination": "Salzburg",
+    "date": "15.01",
+    "flight_boarding": "10:30",
+}
+FIELDS_MARKER = b"%fake-fields\n"
+
+
+def fake_boardingpass(fields: dict) -> bytes:
+    "PDF-like document whose analysis returns fields"
+    return b"%PDF-1.4\n" + FIELDS_MARKER + json.dumps(fields).encode()
+
+
+def document_fields(body: bytes):
+    "Fields embedded by fake_boardingpass, None for other documents"
+    _, marker, data = body.partition(FIELDS_MARKER)
+    return json.loads(data) if marker else None
+
+
+class FakeFormRecognizerServer(ThreadingHTTPServer):
+    """Threaded HTTP server simulating analyze operations.
+
+    Analysis time is lognormal with median `median_seconds`, a GET on a
+    running operation answers with Retry-After `retry_after` if set. A share
+    `error_rate` of GETs fails with 503. n_connections counts accepted TCP
+    connections.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        median_seconds: float = 0.8,
+        sigma: float = 0.5,
+        retry_after: float = None,
+        fields: dict = None,
+        seed: int = 11,
+        ssl_context: ssl.SSLContext = None,
+        error_rate: float = 0.0,
+    ):
+        super().__init__(("127.0.0.1", 0), FakeFormRecognizerHandler)
+        if ssl_context is not None:
+            # handshake in the handler thread, not in the accept loop
+            self.socket = ssl_context.wrap_socket(
+                self.socket, server_side=True, do_handshake_on_connect=False
+            )
+        self.scheme = "http" if ssl_context is None else "https"
+        self.median_seconds = median_seconds
+        self.sigma = sigma
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.fields = fields or BOARDINGPASS_FIELDS
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.n_get = 0
+        self.n_errors = 0
+        self.n_connections = 0
+
+    @property
+    def endpoint(self) -> str:
+        return f"{self.scheme}://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "FakeFormRecognizerServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.n_connections += 1
+        super().process_request(request, client_address)
+
+    def new_operation(self, fields: dict = None) -> str:
+        with self.lock:
+            duration = self.median_seconds * self.random.lognormvariate(0, self.sigma)
+            operation_id = str(uuid.uuid4())
+            self.operations[operation_id] = (time.monotonic() + duration, fields)
+
+        return operation_id
+
+    def fails(self) -> bool:
+        "Draws whether the current request fails"
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+            self.n_errors += failed
+        return failed
+
+    def analyze_result(self, fields: dict = None) -> dict:
+        return {
+            "status": "succeeded",
+            "analyzeResult": {
+                "documentResults": [
+                    {
+                        "fields": {
+                            k: {"type": "string", "valueString": v}
+                            for k, v in (fields or self.fields).items()
+                        }
+                    }
+                ]
+            },
+        }
+
+
+class FakeFormRecognizerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.split("?")[0].endswith("/analyze"):
+            return self._send_json(404, {"error": {"code": "NotFound"}})
+        operation_id = self.server.new_operation(document_fields(body))
+        model_path = self.path.split("?")[0]
+        self.send_response(202)
+        self.send_header(
+            "Operation-Location",
+            f"{self.server.endpoint}{model_path}Results/{operation_id}",
+        )
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        operation_id = self.path.rstrip("/").split("/")[-1]
+        with self.server.lock:
+            self.server.n_get += 1
+            ready_at, fields = self.server.operations.get(operation_id, (None, None))
+        if ready_at is None:
+            return self._send_json(404, {"error": {"code": "NotFound"}})
+        if self.server.fails():
+            return self._send_json(503, {"error": {"code": "ServiceUnavailable"}})
+        if time.monotonic() < ready_at:
+            headers = {}
+            if self.server.retry_after is not None:
+                headers["Retry-After"] = str(self.server.retry_after)
+            return self._send_json(200, {"status": "running"}, headers)
+
+        return self._send_json(200, self.server.analyze_result(fields))
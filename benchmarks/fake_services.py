@@ -0,0 +1,231 @@
+"""
+In-process fakes of the Azure SDK clients used by the kiosk.
+
+FakeFormRecognizerClient (identity documents), FakeFaceClient (detect,
+verify) and FakeCustomVisionTrainer/-Predictor (projects, tags, iterations,
+detect_image) answer with the SDK's attributes after a simulated latency
+and fail with a configurable error rate. Together with the REST fake in
+`benchmarks.fake_formrecognizer` they replace every remote call of main.py.
+
+What an image shows is looked up by its pixel size in a SyntheticImages
+registry. Sizes survive the memory mapping and the re-encoding of the
+preprocessing stage, which changes the bytes but keeps images below the
+profile's max_side as they are.
+"""
+
+import itertools
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# smallest side of generated images and size codes per row, keeps every
+# image below the smallest preprocessing max_side (1024)
+MIN_SIDE = 256
+CODES_PER_ROW = 512
+
+
+class FakeServiceError(Exception):
+    "Injected failure of a fake service call"
+
+
+class ServiceProfile:
+    """Latency and error distribution of a fake service.
+
+    Latency is lognormal with median `median_seconds` and shape `sigma`, a
+    share `error_rate` of calls raises FakeServiceError after the latency.
+    """
+
+    def __init__(
+        self,
+        median_seconds: float = 0.1,
+        sigma: float = 0.5,
+        error_rate: float = 0.0,
+        seed: int = 11,
+    ):
+        self.median_seconds = median_seconds
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+
+    def call(self, operation: str) -> None:
+        "Waits for one simulated call of operation, raises if it fails"
+        with self.lock:
+            latency = self.median_seconds * self.random.lognormvariate(0, self.sigma)
+            failed = self.random.random() < self.error_rate
+            self.calls[operation] += 1
+            self.errors[operation] += failed
+        time.sleep(latency)
+        if failed:
+            raise FakeServiceError(f"Injected failure of {operation}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"calls": dict(self.calls), "errors": dict(self.errors)}
+
+
+class SyntheticImages:
+    """What each generated image shows, keyed by its pixel size.
+
+    An entry is a dict, e.g. {"person": 3} for a face of passenger 3 or
+    {"lighter": True} for a luggage image.
+    """
+
+    def __init__(self):
+        self._codes = itertools.count()
+        self._contents: Dict[Tuple[int, int], dict] = {}
+        self._lock = threading.Lock()
+
+    def new_size(self, **content) -> Tuple[int, int]:
+        "Unused image size registered for content"
+        with self._lock:
+            code = next(self._codes)
+            size = (MIN_SIDE + code % CODES_PER_ROW, MIN_SIDE + code // CODES_PER_ROW)
+            self._contents[size] = content
+        return size
+
+    def write(self, filepath: str, seed: int = 0, **content) -> None:
+        "Writes a noise JPEG of a new size, sharp enough to pass frame_quality"
+        size = self.new_size(**content)
+        tile = np.random.default_rng(seed).integers(0, 256, (64, 64), dtype=np.uint8)
+        Image.fromarray(tile).resize(size, Image.NEAREST).convert("RGB").save(
+            filepath, "JPEG", quality=80
+        )
+
+    def content(self, stream) -> dict:
+        "Content of an uploaded image stream, empty for unknown images"
+        with Image.open(stream) as img:
+            return self._contents.get(img.size, {})
+
+
+class FakeFormRecognizerClient:
+    "FormRecognizerClient for prebuilt identity documents"
+
+    def __init__(
+        self, images: SyntheticImages, passengers: Dict[int, dict], profile=None
+    ):
+        self.images = images
+        self.passengers = passengers
+        self.profile = profile or ServiceProfile(median_seconds=1.5)
+
+    def begin_recognize_identity_documents(self, stream):
+        self.profile.call("identity_documents")
+        person = self.images.content(stream).get("person")
+        documents = []
+        if person is not None:
+            passenger = self.passengers[person]
+            fields = {
+                "FirstName": passenger["first_name"],
+                "LastName": passenger["last_name"],
+                "DateOfBirth": passenger["dob"],
+            }
+            documents.append(
+                SimpleNamespace(
+                    fields={
+                        k: SimpleNamespace(value=v, confidence=0.99)
+                        for k, v in fields.items()
+                    }
+                )
+            )
+
+        return SimpleNamespace(result=lambda: documents)
+
+
+class FakeFaceOperations:
+    "face operations of FaceClient, face ids refer to the detected person"
+
+    def __init__(self, images: SyntheticImages, profile: ServiceProfile):
+        self.images = images
+        self.profile = profile
+        self._faces: Dict[str, Optional[int]] = {}
+        self._lock = threading.Lock()
+
+    def detect_with_stream(self, image, detection_model: str = "detection_01"):
+        self.profile.call("detect")
+        person = self.images.content(image).get("person")
+        if person is None:
+            return []
+        face_id = str(uuid.uuid4())
+        with self._lock:
+            self._faces[face_id] = person
+        return [SimpleNamespace(face_id=face_id)]
+
+    def verify_face_to_face(self, face_id1: str, face_id2: str):
+        self.profile.call("verify")
+        with self._lock:
+            identical = self._faces.get(face_id1) == self._faces.get(face_id2)
+        return SimpleNamespace(
+            is_identical=identical, confidence=0.92 if identical else 0.08
+        )
+
+
+class FakeFaceClient:
+    def __init__(self, images: SyntheticImages, profile: ServiceProfile = None):
+        self.profile = profile or ServiceProfile(median_seconds=0.15)
+        self.face = FakeFaceOperations(images, self.profile)
+
+
+class FakeCustomVisionTrainer:
+    "CustomVisionTrainingClient with one project and a published iteration"
+
+    def __init__(self, profile: ServiceProfile = None, publish_name: str = "fake"):
+        self.profile = profile or ServiceProfile(median_seconds=0.1)
+        self.projects = []
+        self.tags = [SimpleNamespace(id="tag-lighter", name="lighter")]
+        self.iterations = [
+            SimpleNamespace(
+                id="iteration-1", name="Iteration 1", publish_name=publish_name
+            )
+        ]
+
+    def get_projects(self):
+        self.profile.call("get_projects")
+        return list(self.projects)
+
+    def get_domains(self):
+        self.profile.call("get_domains")
+        return [SimpleNamespace(id="domain-od", type="ObjectDetection", name="General")]
+
+    def create_project(self, name: str, domain_id: str = None):
+        self.profile.call("create_project")
+        project = SimpleNamespace(id=str(uuid.uuid4()), name=name)
+        self.projects.append(project)
+        return project
+
+    def get_tags(self, project_id: str):
+        self.profile.call("get_tags")
+        return list(self.tags)
+
+    def get_iterations(self, project_id: str):
+        self.profile.call("get_iterations")
+        return list(self.iterations)
+
+
+class FakeCustomVisionPredictor:
+    "CustomVisionPredictionClient, lighter probability follows the image content"
+
+    def __init__(self, images: SyntheticImages, profile: ServiceProfile = None):
+        self.images = images
+        self.profile = profile or ServiceProfile(median_seconds=0.2)
+
+    def detect_image(self, project_id: str, published_name: str, image_data):
+        self.profile.call("detect_image")
+        lighter = self.images.content(image_data).get("lighter", False)
+        return SimpleNamespace(
+            predictions=[
+                SimpleNamespace(
+                    tag_name="lighter",
+                    probability=0.87 if lighter else 0.03,
+                    bounding_box=None,
+                )
+            ]
+        )
@@ -0,0 +1,87 @@
+"""
+Writes a synthetic manifest and passenger documents for load tests.
+
+Generates the flights configured under data.synthetic in config.yaml, or
+--n-flights of them, writes the manifest chunk by chunk to --output and
+ID cards and boarding passes of the first --n-documents passengers to
+--documents, with barcodes if --barcodes is given. Prints rows, time and
+peak memory as JSON.
+
+    python -m benchmarks.generate_load --n-flights 20000 --n-documents 100
+"""
+
+import argparse
+import copy
+import json
+import logging
+import time
+
+from src.utils_data import load_config
+from src.utils_image import rss_bytes
+from src.utils_synthetic import generate_manifest
+from src.utils_synthetic import write_documents
+from src.utils_synthetic import write_manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-flights", type=int)
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--output", default="data/raw/flight_manifest_synthetic.csv")
+    parser.add_argument("--n-documents", type=int, default=0)
+    parser.add_argument("--documents", default="data/raw/synthetic")
+    parser.add_argument("--photo", help="face image pasted on the ID cards")
+    parser.add_argument("--barcodes", action="store_true", help="PDF417 on documents")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    config = copy.deepcopy(load_config())
+    if args.n_flights:
+        config["data"]["synthetic"]["n_flights"] = args.n_flights
+    seed = config["data"]["faker"]["seed"]
+
+    peak = rss_bytes()
+    start = time.perf_counter()
+    first = None
+
+    def chunks():
+        nonlocal first, peak
+        for chunk in generate_manifest(config, chunk_size=args.chunk_size):
+            if first is None:
+                first = chunk.head(args.n_documents)
+            peak = max(peak, rss_bytes())
+            yield chunk
+
+    n_rows = write_manifest(args.output, chunks())
+    seconds_manifest = time.perf_counter() - start
+
+    start = time.perf_counter()
+    documents = []
+    if args.n_documents and first is not None:
+        airport_codes = None
+        if args.barcodes:
+            airports = config["kiosk"]["barcode"]["airports"]
+            airport_codes = {city: code for code, city in airports.items()}
+        documents = write_documents(
+            args.documents, first, seed, photo=args.photo, airport_codes=airport_codes
+        )
+    seconds_documents = time.perf_counter() - start
+
+    print(
+        json.dumps(
+            {
+                "n_flights": config["data"]["synthetic"]["n_flights"],
+                "n_passengers": n_rows,
+                "seconds_manifest": round(seconds_manifest, 2),
+                "passengers_per_second": round(n_rows / seconds_manifest),
+                "peak_rss_mb": round(peak / 1024**2, 1),
+                "n_documents": len(documents),
+                "seconds_documents": round(seconds_documents, 2),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -18,17 +18,33 @@ from azure.cognitiveservices.vision.customvision.prediction import (
     CustomVisionPredictionClient,
 )
 from msrest.authentication import ApiKeyCredentials
+import argparse
 import os
+import asyncio
 from glob import glob
-from src.utils_data import load_img
-from src.utils_data import get_id_details
-from src.utils_data import get_flight_manifest
-from src.utils_data import get_url_boardingpass
-from src.utils_data import get_dict_boardingpass
-from src.utils_data import compare_faces
-from src.utils_lighterdetection import pipeline_prediction_lighterdetection
-from src.utils_validate import pipeline_validate
-from src.utils_validate import message_to_passenger
+from src.utils_data import load_config
+from src.utils_manifest import get_manifest_source
+from src.utils_partition import PartitionedManifest
+from src.utils_partition import get_manifest
+from src.utils_cache import get_cache
+from src.utils_http import HttpClient
+from src.utils_http import get_http_client
+from src.utils_image import ImageCache
+from src.utils_image import MemoryBudget
+from src.utils_preprocess import get_preprocessor
+from src.utils_ratelimit import RateLimitedClient
+from src.utils_ratelimit import get_rate_limiter
+from src.utils_resilience import get_resilience
+from src.utils_boardingpass import get_boardingpass_reader
+from src.utils_barcode import get_barcode_decoder
+from src.utils_sink import get_sink
+from src.utils_metrics import get_metrics_exporter
+from src.utils_face import get_face_registry
+from src.utils_lighterdetection import LighterModel
+from src.utils_lighterdetection import get_lighter_detector
+from src.utils_pipeline import KioskClients
+from src.utils_pipeline import run_passengers
+from src.utils_service import serve
 import logging
 
 logging.basicConfig(
@@ -37,8 +53,112 @@ logging.basicConfig(
 )
 
 
-def main():
+def file_key(filepath: str, prefix: str) -> str:
+    "Passenger key of a file named <prefix><key>.<ext>"
+    return os.path.splitext(os.path.basename(filepath))[0][len(prefix) :]
+
+
+def collect_passengers() -> list:
+    """Pairs boarding pass and ID of each passenger in data/raw by file key.
+
+    boarding_<key>.pdf belongs to id_<key>.jpg. Lighter test images are a
+    separate set and assigned in sorted order.
+    """
+    images_lighter = sorted(
+        glob(os.path.join("data/raw/lighter_test_images", "lighter_test_set_*.jpg"))
+    )
+    images_boarding = {
+        file_key(p, "boarding_"): p
+        for p in glob(os.path.join("data/raw", "boarding_*.pdf"))
+    }
+    images_id = {
+        file_key(p, "id_"): p for p in glob(os.path.join("data/raw", "id_*.jpg"))
+    }
+    images_thumb = sorted(glob(os.path.join("data/video/thumbnail", "ps-*.jpg")))
+
+    unpaired = set(images_boarding) ^ set(images_id)
+    if unpaired:
+        logging.warning(f"Skip passengers without boarding pass or ID: {unpaired}")
+    keys = sorted(set(images_boarding) & set(images_id))
+
+    return [
+        {
+            "boarding": images_boarding[key],
+            "id": images_id[key],
+            "lighter": images_lighter[i],
+            "thumbs": images_thumb,
+        }
+        for i, key in enumerate(keys[: len(images_lighter)])
+    ]
+
+
+def build_clients(
+    config: dict,
+    form_recognizer_client,
+    face_client,
+    trainer,
+    predictor,
+    http: HttpClient,
+    form_recognizer_key: str,
+    form_recognizer_endpoint: str,
+    form_recognizer_model_id: str,
+    customvision_project_name: str,
+    customvision_publish_name: str,
+) -> KioskClients:
+    """Wires authenticated service clients into the kiosk's shared clients.
+
+    Cache, lighter detector, face registry, image memory, preprocessing,
+    circuit breakers, micro-batching, rate limits, the local boarding pass
+    reader and barcode decoding follow config, so benchmarks can pass fake
+    service clients.
+    """
+    cache = get_cache(config)
+
+    # every call of the cognitive services takes a token of its rate limit
+    rate_limiter = get_rate_limiter(config)
+    if rate_limiter is not None:
+        form_recognizer_client = RateLimitedClient(
+            form_recognizer_client, rate_limiter, "form_recognizer"
+        )
+        face_client = RateLimitedClient(
+            face_client, rate_limiter, "face", groups=["face"]
+        )
+        predictor = RateLimitedClient(predictor, rate_limiter, "custom_vision")
+
+    # resolve lighter model once, pick up newly published iterations
+    lighter_model = None
+    if config["kiosk"]["lighter_detector"]["backend"] == "azure":
+        lighter_model = LighterModel(
+            trainer, customvision_project_name, customvision_publish_name
+        )
+        lighter_model.start_refresh(config["kiosk"]["lighter_model_refresh"])
+    lighter_detector = get_lighter_detector(
+        config, predictor=predictor, model=lighter_model, cache=cache
+    )
+
+    return KioskClients(
+        form_recognizer_client=form_recognizer_client,
+        face_client=face_client,
+        lighter_detector=lighter_detector,
+        form_recognizer_key=form_recognizer_key,
+        form_recognizer_endpoint=form_recognizer_endpoint,
+        form_recognizer_model_id=form_recognizer_model_id,
+        cache=cache,
+        face_registry=get_face_registry(config, face_client, cache=cache),
+        http=http,
+        images=ImageCache(config["kiosk"]["memory"]["image_cache_mb"] * 1024**2),
+        memory=MemoryBudget(config["kiosk"]["memory"]["max_inflight_mb"] * 1024**2),
+        preprocessor=get_preprocessor(config),
+        resilience=get_resilience(config),
+        boardingpass_reader=get_boardingpass_reader(config),
+        barcodes=get_barcode_decoder(config),
+        rate_limiter=rate_limiter,
+    )
+
+
+def main(service_mode: bool = False):
     load_dotenv()
+    config = load_config()
 
     AZURE_FORM_RECOGNIZER_ENDPOINT = os.getenv("AZURE_FORM_RECOGNIZER_ENDPOINT")
     AZURE_FORM_RECOGNIZER_KEY = os.getenv("AZURE_FORM_RECOGNIZER_KEY")
@@ -56,10 +176,14 @@ def main():
     AZURE_CUSTOMVISION_PROJECTNAME = os.getenv("AZURE_CUSTOMVISION_PROJECTNAME")
     AZURE_CUSTOMVISION_PUBLISHNAME = os.getenv("AZURE_CUSTOMVISION_PUBLISHNAME")
 
+    # one pooled keep-alive session for all service calls
+    http = get_http_client(config)
+
     # auth clients
     form_recognizer_client = FormRecognizerClient(
         AZURE_FORM_RECOGNIZER_ENDPOINT,
         AzureKeyCredential(AZURE_FORM_RECOGNIZER_KEY),
+        transport=http.azure_transport(),
     )
 
     # vi = VideoIndexer(
@@ -83,61 +207,68 @@ def main():
     predictor = CustomVisionPredictionClient(
         AZURE_CUSTOMVISION_ENDPOINT, prediction_credentials
     )
+    for client in [face_client, trainer, predictor]:
+        http.configure_msrest(client)
 
     # load reference data
-    flight_manifest = get_flight_manifest()
-    images_lighter = glob(
-        os.path.join("data/raw/lighter_test_images", "lighter_test_set_*.jpg")
+    manifest_source = get_manifest_source(config)
+    manifest = manifest_source.load()
+    flight_manifest = get_manifest(config, manifest)
+    clients = build_clients(
+        config,
+        form_recognizer_client,
+        face_client,
+        trainer,
+        predictor,
+        http=http,
+        form_recognizer_key=AZURE_FORM_RECOGNIZER_KEY,
+        form_recognizer_endpoint=AZURE_FORM_RECOGNIZER_ENDPOINT,
+        form_recognizer_model_id=AZURE_FORM_RECOGNIZER_MODEL_ID,
+        customvision_project_name=AZURE_CUSTOMVISION_PROJECTNAME,
+        customvision_publish_name=AZURE_CUSTOMVISION_PUBLISHNAME,
     )
-    images_boarding = glob(os.path.join("data/raw", "boarding_*.pdf"))
-    images_id = glob(os.path.join("data/raw", "id_*.jpg"))
-    images_thumb = glob(os.path.join("data/video/thumbnail", "ps-*.jpg"))
-
-    for i in range(len(images_boarding)):
-        img_boarding = load_img(images_boarding[i])
-        img_id = load_img(images_id[i])
-        img_lighter = load_img(images_lighter[i])
-        img_thumb = load_img(images_thumb[0])
-
-        # ID
-        dict_id = get_id_details(form_recognizer_client, img_id)
-
-        # boarding pass
-        get_url = get_url_boardingpass(
-            img_boarding,
-            apikey=AZURE_FORM_RECOGNIZER_KEY,
-            endpoint=AZURE_FORM_RECOGNIZER_ENDPOINT,
-            model_id=AZURE_FORM_RECOGNIZER_MODEL_ID,
-        )
-        dict_boardingpass = get_dict_boardingpass(
-            get_url, apikey=AZURE_FORM_RECOGNIZER_KEY
-        )
+    if clients.rate_limiter is not None:
+        clients.rate_limiter.update_departures(manifest)
 
-        # video
-        dict_face = compare_faces(
-            face_client, img_reference=img_id, img_compare=img_thumb
-        )
+    with get_metrics_exporter(config), get_sink(config) as sink:
+        if service_mode:
+            asyncio.run(
+                serve(
+                    clients,
+                    flight_manifest,
+                    config["kiosk"]["service"],
+                    concurrency=config["kiosk"]["concurrency"],
+                    sink=sink,
+                    manifest_source=manifest_source,
+                )
+            )
+        else:
+            asyncio.run(
+                run_passengers(
+                    clients,
+                    flight_manifest,
+                    collect_passengers(),
+                    concurrency=config["kiosk"]["concurrency"],
+                    sink=sink,
+                )
+            )
 
-        # lighter detection
-        dict_lighter = pipeline_prediction_lighterdetection(
-            trainer,
-            predictor,
-            AZURE_CUSTOMVISION_PROJECTNAME,
-            AZURE_CUSTOMVISION_PUBLISHNAME,
-            img_lighter,
-        )
-
-        # validate
-        passenger_manifest = pipeline_validate(
-            flight_manifest,
-            dict_id,
-            dict_boardingpass,
-            dict_face,
-            dict_lighter,
-        )
-
-        message_to_passenger(passenger_manifest)
+    logging.info(f"Result cache: {clients.cache.stats()}")
+    clients.lighter_detector.close()
+    http.close()
+    if clients.preprocessor is not None:
+        clients.preprocessor.close()
+    if clients.barcodes is not None:
+        clients.barcodes.close()
+    if isinstance(flight_manifest, PartitionedManifest):
+        flight_manifest.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Passenger boarding kiosk")
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="process passenger submissions from the inbox until interrupted",
+    )
+    main(service_mode=parser.parse_args().serve)
@@ -0,0 +1,280 @@
+"""
+Boarding pass and ID card barcodes decoded in the kiosk.
+
+Boarding passes carry an IATA BCBP barcode (PDF417, Aztec or QR code) with
+name, flight, route, date and seat, US and Canadian ID cards a PDF417 block in
+the AAMVA format with name and date of birth. Decoding takes milliseconds
+where OCR takes seconds, so worker processes decode the documents before the
+Form Recognizer calls, which are only made for documents without a barcode.
+
+BCBP has no boarding time, it is taken from the text layer of the pass.
+Airports are IATA codes in BCBP and cities in the manifest, codes missing in
+kiosk.barcode.airports leave the pass to the custom model.
+"""
+
+import asyncio
+import io
+import logging
+import multiprocessing
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from typing import Dict, Iterator, Optional, Tuple
+
+from PIL import Image
+from src.utils_boardingpass import BOARDING_TIME
+from src.utils_boardingpass import pdf_text
+from src.utils_boardingpass import pypdf
+from src.utils_metrics import metrics
+
+try:
+    import zxingcpp
+except ImportError:
+    zxingcpp = None
+
+DOCUMENTS = ["id", "boardingpass"]
+# fields the checks need from each document
+REQUIRED = {
+    "id": ["first_name", "last_name", "full_name", "dob"],
+    "boardingpass": [
+        "name",
+        "seat",
+        "airline",
+        "flight_number",
+        "origin",
+        "destination",
+        "date",
+        "flight_boarding",
+    ],
+}
+# mandatory items of a BCBP leg, IATA Resolution 792
+BCBP = re.compile(
+    r"M(?P<legs>[1-9])(?P<name>.{20})[E ](?P<pnr>.{7})"
+    r"(?P<origin>[A-Z]{3})(?P<destination>[A-Z]{3})(?P<airline>[A-Z0-9 ]{3})"
+    r"(?P<flight_number>[0-9]{4}[A-Z ])(?P<day>[0-9]{3})(?P<compartment>[A-Z])"
+    r"(?P<seat>[0-9]{3}[A-Z])"
+)
+NAME_TITLES = {"MR", "MRS", "MS", "MISS", "MSTR", "DR"}
+# element IDs at the start of AAMVA lines, the header runs into the first one
+AAMVA_ELEMENT = re.compile(r"D[A-Z]{2}")
+AAMVA_SUBFILE = re.compile(r"(?:DL|ID)(D[A-Z]{2}.*)$")
+
+
+def flight_day(day_of_year: int, today: date) -> date:
+    "Date of a BCBP day of year, in the year that puts it closest to today"
+    candidates = [
+        date(year, 1, 1) + timedelta(days=day_of_year - 1)
+        for year in [today.year - 1, today.year, today.year + 1]
+    ]
+    return min(candidates, key=lambda d: abs(d - today))
+
+
+def parse_bcbp(text: str, airports: Dict[str, str], today: date) -> Optional[dict]:
+    """Boarding pass fields of the first leg of a BCBP barcode, None for others.
+
+    Fields that cannot be read reliably are left out: a name filling all 20
+    characters may be truncated, unknown airport codes have no city.
+    """
+    match = BCBP.match(text)
+    if match is None:
+        return None
+
+    fields = {
+        "seat": match["seat"].lstrip("0"),
+        "airline": match["airline"].strip(),
+        "flight_number": match["flight_number"].strip().lstrip("0"),
+        "date": flight_day(int(match["day"]), today).strftime("%d.%m"),
+    }
+    last_name, _, first_names = match["name"].rstrip().partition("/")
+    words = first_names.split()
+    if len(words) > 1 and words[-1] in NAME_TITLES:
+        words = words[:-1]
+    if not match["name"].endswith(" ") or not words:
+        logging.info(f"Name on boarding pass barcode may be truncated: {match['name']}")
+    else:
+        fields["name"] = " ".join(words + [last_name]).title()
+    for key in ["origin", "destination"]:
+        if match[key] in airports:
+            fields[key] = airports[match[key]]
+
+    return fields
+
+
+def aamva_elements(text: str) -> Dict[str, str]:
+    "Data elements of an AAMVA barcode by their three letter IDs"
+    elements = {}
+    for line in re.split(r"[\n\r\x1e]+", text):
+        if line.startswith(("ANSI ", "AAMVA")):
+            subfile = AAMVA_SUBFILE.search(line)
+            line = subfile.group(1) if subfile else ""
+        if AAMVA_ELEMENT.match(line):
+            elements.setdefault(line[:3], line[3:].strip())
+
+    return elements
+
+
+def parse_aamva(text: str) -> Optional[dict]:
+    """ID details of an AAMVA driver license or ID card barcode, None for others.
+
+    Truncated names are left out.
+    """
+    if not text.startswith("@") or not re.search(r"ANSI |AAMVA", text[:32]):
+        return None
+
+    elements = aamva_elements(text)
+    fields = {}
+    # first name is DAC since version 2, given names in DCT before
+    first_name = elements.get("DAC") or elements.get("DCT", "").split(",")[0]
+    last_name = elements.get("DCS", "")
+    truncated = "T" in [elements.get("DDE"), elements.get("DDF")]
+    if first_name and last_name and not truncated:
+        fields["first_name"] = first_name.title()
+        fields["last_name"] = last_name.title()
+        fields["full_name"] = f"{fields['first_name']} {fields['last_name']}"
+    # dates are MMDDCCYY in the US and CCYYMMDD in Canada
+    date_format = "%Y%m%d" if elements.get("DCG") == "CAN" else "%m%d%Y"
+    try:
+        fields["dob"] = datetime.strptime(elements.get("DBB", ""), date_format).date()
+    except ValueError:
+        logging.info(f"No date of birth in ID barcode: {elements.get('DBB')}")
+
+    return fields
+
+
+def barcode_images(data: bytes) -> Iterator[Image.Image]:
+    "Images that may show a barcode, the embedded images of a PDF's first page"
+    if not data.startswith(b"%PDF-"):
+        yield Image.open(io.BytesIO(data))
+    elif pypdf is not None:
+        for image in pypdf.PdfReader(io.BytesIO(data)).pages[0].images:
+            yield image.image
+
+
+def _init_worker(log_level: int) -> None:
+    # spawned workers do not inherit the level set in the kiosk process
+    logging.getLogger().setLevel(log_level)
+
+
+def decode_file(
+    filepath: str, document: str, airports: Dict[str, str], today: date
+) -> Tuple[Optional[dict], str]:
+    """Fields of document from its barcode and the outcome, run in a worker.
+
+    Outcome is "hit" with all fields the checks need, otherwise "none"
+    without barcode, "unsupported" for other barcodes, "incomplete" if
+    fields are missing or "error" if the file cannot be read, with None.
+    """
+    boarding = set()
+    try:
+        with open(filepath, "rb") as f:
+            data = f.read()
+        # raw bytes, text shows control characters differently across versions
+        texts = [
+            barcode.bytes.decode("latin-1")
+            for image in barcode_images(data)
+            for barcode in zxingcpp.read_barcodes(image.convert("L"))
+        ]
+        parsed = [
+            parse_aamva(text) if document == "id" else parse_bcbp(text, airports, today)
+            for text in texts
+        ]
+        if document == "boardingpass" and parsed:
+            boarding = set(BOARDING_TIME.findall(pdf_text(data)))
+    except Exception:
+        return None, "error"
+
+    fields = next((p for p in parsed if p is not None), None)
+    if fields is None:
+        return None, "unsupported" if parsed else "none"
+    if len(boarding) == 1:
+        fields["flight_boarding"] = boarding.pop()
+    if not all(key in fields for key in REQUIRED[document]):
+        return None, "incomplete"
+
+    return fields, "hit"
+
+
+class BarcodeDecoder:
+    """Process pool decoding the barcodes of ID cards and boarding passes.
+
+    Keeps per document counters of documents, hits and the time spent,
+    including waiting for a worker.
+    """
+
+    def __init__(self, airports: Dict[str, str], max_workers: int = 2):
+        if zxingcpp is None:
+            raise ImportError("BarcodeDecoder requires zxing-cpp")
+
+        self.airports = airports
+        # spawn, the kiosk process runs threads that must not be forked
+        self._pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(logging.getLogger().getEffectiveLevel(),),
+        )
+        # workers import the decoders while the kiosk starts up
+        for _ in range(max_workers):
+            self._pool.submit(decode_file, "", "id", airports, date.today())
+        self.counters = {
+            document: {"documents": 0, "hits": 0, "seconds": 0.0}
+            for document in DOCUMENTS
+        }
+
+    def __enter__(self) -> "BarcodeDecoder":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    async def decode(self, document: str, filepath: str) -> Optional[dict]:
+        "Fields of the id or boardingpass at filepath, None without usable barcode"
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        fields, outcome = await loop.run_in_executor(
+            self._pool, decode_file, filepath, document, self.airports, date.today()
+        )
+        if fields is None:
+            logging.info(f"No {document} details from barcode ({outcome}).")
+
+        counters = self.counters[document]
+        counters["documents"] += 1
+        counters["hits"] += fields is not None
+        counters["seconds"] += time.perf_counter() - start
+        metrics.inc("kiosk_barcodes_total", document=document, result=outcome)
+
+        return fields
+
+    def stats(self, remote_seconds: Dict[str, float] = None) -> dict:
+        """Counters per document with the hit ratio and, given the mean latency
+        of the remote call per document, the seconds saved by the barcodes"""
+        stats = {}
+        for document, c in self.counters.items():
+            hit_ratio = c["hits"] / c["documents"] if c["documents"] else None
+            stats[document] = {
+                **c,
+                "seconds": round(c["seconds"], 4),
+                "hit_ratio": None if hit_ratio is None else round(hit_ratio, 4),
+            }
+            if (remote_seconds or {}).get(document) is not None:
+                saved = c["hits"] * remote_seconds[document] - c["seconds"]
+                stats[document]["seconds_saved"] = round(saved, 3)
+
+        return stats
+
+
+def get_barcode_decoder(config: dict) -> Optional[BarcodeDecoder]:
+    "Creates the decoder configured under kiosk.barcode, None if disabled"
+    barcode_config = config["kiosk"]["barcode"]
+    if not barcode_config["enabled"]:
+        return None
+
+    return BarcodeDecoder(
+        barcode_config["airports"], max_workers=barcode_config["max_workers"]
+    )
@@ -0,0 +1,208 @@
+"""
+Micro-batching of detection calls across passengers.
+
+At peak boarding many passengers need a lighter or face detection within
+the same few milliseconds. A MicroBatcher collects the items submitted by
+their threads for up to `max_wait` seconds or `max_batch` items and hands
+them to one dispatch call, which sends them to a batch endpoint or as a
+burst over a persistent thread pool. While `max_in_flight` batches are
+running new items keep collecting, so batches grow with the load.
+
+Every submitter gets the result of its own item back as soon as it is
+ready, an item that fails raises in its own submitter only.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from src.utils_metrics import metrics
+
+# contexts of the submitters of the items a batch is dispatched for
+ITEM_CONTEXTS = contextvars.ContextVar("item_contexts", default=None)
+
+
+def burst(executor: ThreadPoolExecutor, func: Callable, items: list) -> List[Future]:
+    """Futures of func applied to items, sent at once. Each item runs in the
+    context of its submitter within a batch, in the caller's otherwise"""
+    contexts = ITEM_CONTEXTS.get()
+    if contexts is None or len(contexts) != len(items):
+        contexts = [contextvars.copy_context()] * len(items)
+
+    return [
+        executor.submit(context.copy().run, func, item)
+        for item, context in zip(items, contexts)
+    ]
+
+
+def resolve(future: Future, result) -> None:
+    "Sets the outcome of future from a result, an exception or another future"
+    if isinstance(result, Future):
+        result.add_done_callback(
+            lambda done: resolve(future, done.exception() or done.result())
+        )
+    elif isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+class MicroBatcher:
+    """Collects items of concurrent threads into batches for dispatch.
+
+    dispatch takes a list of items and returns one result per item, an
+    exception instance for an item that failed or a Future of the result.
+    Futures resolve their submitters one by one, so a burst of requests is
+    not held back by its slowest one. A batch is dispatched once it holds
+    max_batch items or max_wait seconds after its first item, at most
+    max_in_flight batches at a time. dispatch finds the contexts of the
+    items' submitters in ITEM_CONTEXTS, e.g. for the rate limits.
+    """
+
+    def __init__(
+        self,
+        dispatch: Callable[[list], list],
+        max_batch: int = 16,
+        max_wait: float = 0.005,
+        max_in_flight: int = 4,
+        name: str = "batch",
+    ):
+        self.dispatch = dispatch
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.name = name
+        self.counters = {"batches": 0, "items": 0, "full": 0}
+        self._lock = threading.Lock()
+        self._pending = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self._slots = threading.Semaphore(max(1, max_in_flight))
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_in_flight), thread_name_prefix=name
+        )
+        self._collector = threading.Thread(
+            target=self._collect, name=f"{name}-collector", daemon=True
+        )
+        self._collector.start()
+
+    def __enter__(self) -> "MicroBatcher":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        "Dispatches the items already submitted and stops"
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._collector.join()
+        self._executor.shutdown()
+
+    def submit(self, item) -> Future:
+        "Future of the result of item"
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError(f"{self.name} batcher is closed")
+            self._pending.append(
+                (time.monotonic(), item, future, contextvars.copy_context())
+            )
+            self._condition.notify()
+
+        return future
+
+    def __call__(self, item):
+        "Result of item, blocks until its batch is dispatched"
+        return self.submit(item).result()
+
+    def map(self, items: list) -> list:
+        "Results of items, which may be spread over several batches"
+        return [future.result() for future in [self.submit(item) for item in items]]
+
+    def _collect(self):
+        while True:
+            # items collect while all batches in flight are running
+            self._slots.acquire()
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    self._slots.release()
+                    return
+                deadline = self._pending[0][0] + self.max_wait
+                while len(self._pending) < self.max_batch and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch: list):
+        items = [item for _, item, _, _ in batch]
+        # e.g. the rate limits serve every item by its own passenger
+        token = ITEM_CONTEXTS.set([context for _, _, _, context in batch])
+        try:
+            with metrics.span(f"batch_{self.name}"):
+                results = list(self.dispatch(items))
+            if len(results) != len(items):
+                raise ValueError(f"{len(results)} results for {len(items)} items")
+        except Exception as e:
+            logging.warning(f"Batch of {len(items)} {self.name} items failed: {e!r}")
+            results = [e] * len(items)
+        finally:
+            ITEM_CONTEXTS.reset(token)
+            self._slots.release()
+
+        for (_, _, future, _), result in zip(batch, results):
+            resolve(future, result)
+
+        with self._lock:
+            self.counters["batches"] += 1
+            self.counters["items"] += len(items)
+            self.counters["full"] += len(items) == self.max_batch
+        metrics.inc("kiosk_batches_total", batcher=self.name)
+        metrics.inc("kiosk_batch_items_total", len(items), batcher=self.name)
+
+    def stats(self) -> dict:
+        "Counters with the mean batch size"
+        batches = self.counters["batches"]
+        return {
+            **self.counters,
+            "mean_size": (
+                round(self.counters["items"] / batches, 2) if batches else None
+            ),
+        }
+
+
+def burst_size(config: dict, kind: str, default: int = 4) -> int:
+    """Parallel requests that send all batches of kind in flight at once,
+    default without batching"""
+    batching_config = config["kiosk"]["batching"]
+    if not batching_config["enabled"]:
+        return default
+
+    options = batching_config[kind]
+    return max(default, options["max_batch"] * options["max_in_flight"])
+
+
+def get_batcher(config: dict, kind: str, dispatch: Callable) -> Optional[MicroBatcher]:
+    "Creates the batcher configured under kiosk.batching for kind, None if disabled"
+    batching_config = config["kiosk"]["batching"]
+    if not batching_config["enabled"]:
+        return None
+
+    options = batching_config[kind]
+    return MicroBatcher(
+        dispatch,
+        max_batch=options["max_batch"],
+        max_wait=options["max_wait_ms"] / 1000,
+        max_in_flight=options["max_in_flight"],
+        name=kind,
+    )
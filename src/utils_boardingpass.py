@@ -0,0 +1,148 @@
+"""
+Boarding passes read from the PDF text layer in the kiosk process.
+
+Boarding passes printed to PDF carry their text, so the fields of the custom
+Form Recognizer model can be parsed locally in milliseconds instead of one
+analyze operation per passenger. The text is matched against the layout of
+the pass, whose stub repeats route, seat, date and boarding time. Scans
+without text layer and passes whose copies disagree are left to the model.
+"""
+
+import logging
+import re
+import threading
+import time
+from typing import Optional, Tuple
+
+from src.utils_image import ImageBuffer
+from src.utils_image import image_stream
+from src.utils_metrics import metrics
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+else:
+    # pypdf warns for every malformed pass it repairs, in the kiosk and in
+    # the barcode workers, files it cannot read still raise in pdf_text
+    logging.getLogger("pypdf").setLevel(logging.ERROR)
+
+# header row of the pass, then name, carrier and flight number below it
+PASSENGER = re.compile(
+    r"Class Passenger Name (?P<name>[^\d:]+?) "
+    r"(?P<airline>[A-Z][A-Z0-9]) (?P<flight_number>\d{1,4}) "
+)
+# route on the stub, then on the pass followed by date, baggage and seat
+STUB_ROUTE = re.compile(r"\bFrom (?P<origin>[^:]+?) To (?P<destination>[^:]+?) From:")
+ROUTE = re.compile(
+    r"From: (?P<origin>.+?) Date Baggage Seat Seat Date "
+    r"To: (?P<destination>.+?) (?P<date>(?:0[1-9]|[12]\d|3[01])\.(?:0[1-9]|1[0-2])) "
+    r"\S+ (?P<seat>\d{1,3}[A-Z]) (?P<stub_seat>\S+) (?P<stub_date>\S+)"
+)
+BOARDING_TIME = re.compile(r"\b(?:[01]\d|2[0-3]):[0-5]\d\b")
+
+
+def pdf_text(document: ImageBuffer) -> str:
+    "Text layer of the first page with whitespace collapsed, empty for scans"
+    if bytes(document[:5]) != b"%PDF-":
+        # photographed or scanned passes
+        return ""
+
+    page = pypdf.PdfReader(image_stream(document)).pages[0]
+    return " ".join(page.extract_text().split())
+
+
+def parse_boardingpass(text: str) -> Tuple[Optional[dict], str]:
+    """Fields of the custom model from the text of a pass and the outcome.
+
+    Outcome is "hit" with all fields, otherwise "unparsed" if the layout is
+    not found or "inconsistent" if pass and stub disagree, with None.
+    """
+    passenger = PASSENGER.search(text)
+    stub = STUB_ROUTE.search(text)
+    route = ROUTE.search(text)
+    boarding = set(BOARDING_TIME.findall(text))
+    if not (passenger and stub and route and boarding):
+        return None, "unparsed"
+
+    if (
+        stub.group("origin", "destination") != route.group("origin", "destination")
+        or route["seat"] != route["stub_seat"]
+        or route["date"] != route["stub_date"]
+        or len(boarding) > 1
+    ):
+        return None, "inconsistent"
+
+    return {
+        **passenger.groupdict(),
+        "seat": route["seat"],
+        "origin": route["origin"],
+        "destination": route["destination"],
+        "date": route["date"],
+        "flight_boarding": boarding.pop(),
+    }, "hit"
+
+
+class BoardingPassReader:
+    """Local boarding pass reader in front of the custom model.
+
+    Counts documents per outcome and the time spent reading them, so the
+    share of passes that never reach the model can be reported.
+    """
+
+    def __init__(self):
+        if pypdf is None:
+            raise ImportError("BoardingPassReader requires pypdf")
+
+        self.counters = {"documents": 0, "hits": 0, "seconds": 0.0}
+        # passes are read in executor threads
+        self._lock = threading.Lock()
+
+    def read(self, document: ImageBuffer) -> Optional[dict]:
+        "Fields of the boarding pass, None if the custom model has to read it"
+        start = time.perf_counter()
+        fields = None
+        try:
+            text = pdf_text(document)
+        except Exception as e:
+            # images and damaged files raise in the PDF parser
+            logging.info(f"No PDF text layer in boarding pass: {e}")
+            outcome = "error"
+        else:
+            if text:
+                fields, outcome = parse_boardingpass(text)
+            else:
+                outcome = "no_text"
+        if fields is None:
+            logging.info(f"Boarding pass not read locally ({outcome}), ask the model.")
+
+        with self._lock:
+            self.counters["documents"] += 1
+            self.counters["hits"] += fields is not None
+            self.counters["seconds"] += time.perf_counter() - start
+        metrics.inc("kiosk_boardingpass_local_total", result=outcome)
+
+        return fields
+
+    def stats(self, remote_seconds: float = None) -> dict:
+        """Counters with the hit ratio and, given the mean latency of the
+        custom model, the seconds saved by the passes read locally"""
+        documents, hits = self.counters["documents"], self.counters["hits"]
+        stats = {
+            **self.counters,
+            "seconds": round(self.counters["seconds"], 4),
+            "hit_ratio": round(hits / documents, 4) if documents else None,
+        }
+        if remote_seconds is not None:
+            saved = hits * remote_seconds - self.counters["seconds"]
+            stats["seconds_saved"] = round(saved, 3)
+
+        return stats
+
+
+def get_boardingpass_reader(config: dict) -> Optional[BoardingPassReader]:
+    "Creates the reader configured under kiosk.boardingpass, None if disabled"
+    if not config["kiosk"]["boardingpass"]["local"]:
+        return None
+
+    return BoardingPassReader()
@@ -0,0 +1,227 @@
+"""
+Content-addressed cache for cognitive service results.
+
+Results are keyed by a hash of the input bytes plus the model identifiers,
+kept in an in-memory LRU and optionally in an on-disk tier. Both tiers are
+bounded in size and entries expire after a TTL. Results with personal data,
+the fields of ID cards and boarding passes, are pickled unencrypted and are
+only written to disk if `persist_pii` is set.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+# marks a cache miss, None is a valid cached value
+MISSING = object()
+
+
+def cache_key(namespace: str, *parts) -> str:
+    "sha256 over namespace and parts, buffers are hashed in place, others by repr"
+    digest = hashlib.sha256(namespace.encode())
+    for part in parts:
+        data = (
+            memoryview(part).cast("B")
+            if isinstance(part, (bytes, bytearray, memoryview))
+            else repr(part).encode()
+        )
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Two-tier LRU cache with TTL and hit/miss counters.
+
+    The memory tier holds at most `max_entries` results. The disk tier is
+    used if `directory` is set and holds at most `max_disk_bytes`, oldest
+    entries are evicted first. Values set with pii are kept in memory only
+    unless `persist_pii` is set. Failed calls returning None are not cached.
+    """
+
+    def __init__(
+        self,
+        directory: str = None,
+        max_entries: int = 1024,
+        max_disk_bytes: int = 512 * 1024**2,
+        ttl: float = 6 * 3600,
+        persist_pii: bool = False,
+    ):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.persist_pii = persist_pii
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "evictions": 0,
+        }
+        self._disk_bytes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_bytes = sum(
+                entry.stat().st_size for entry in self._disk_entries()
+            )
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    def stats(self) -> dict:
+        "Hit/miss counters and current sizes"
+        return {
+            **self.counters,
+            "entries": len(self._memory),
+            "disk_bytes": self._disk_bytes,
+        }
+
+    def get(self, key: str):
+        "Cached value of key or MISSING"
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.counters["hits"] += 1
+                    self.counters["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+        value = self._get_disk(key, now)
+        with self._lock:
+            if value is MISSING:
+                self.counters["misses"] += 1
+            else:
+                self.counters["hits"] += 1
+                self.counters["disk_hits"] += 1
+
+        return value
+
+    def set(self, key: str, value, ttl: float = None, pii: bool = False) -> None:
+        "Stores value under key in both tiers, personal data on disk if allowed"
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._set_memory(key, expires_at, value)
+        if self.persist_pii or not pii:
+            self._set_disk(key, expires_at, value)
+
+    def get_or_call(
+        self, key: str, func: Callable, ttl: float = None, pii: bool = False
+    ):
+        "Returns cached value of key, otherwise calls func and caches its result"
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+
+        value = func()
+        if value is not None:
+            self.set(key, value, ttl=ttl, pii=pii)
+
+        return value
+
+    def _set_memory(self, key: str, expires_at: float, value):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.pkl")
+
+    def _disk_entries(self):
+        for subdir in os.scandir(self.directory):
+            if subdir.is_dir():
+                yield from (e for e in os.scandir(subdir.path) if e.is_file())
+
+    def _get_disk(self, key: str, now: float):
+        if not self.directory:
+            return MISSING
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                expires_at, value = pickle.load(f)
+        except FileNotFoundError:
+            return MISSING
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            logging.warning(f"Drop unreadable cache entry {path}: {e}")
+            self._remove_disk(path)
+            return MISSING
+
+        if expires_at <= now:
+            self._remove_disk(path)
+            return MISSING
+
+        # refresh mtime so that eviction drops least recently used entries
+        os.utime(path)
+        with self._lock:
+            self._set_memory(key, expires_at, value)
+
+        return value
+
+    def _set_disk(self, key: str, expires_at: float, value):
+        if not self.directory:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            data = pickle.dumps((expires_at, value), protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logging.warning(f"Result for {key} is not cached on disk: {e}")
+            return
+
+        # write to a temp file and rename so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        previous = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_bytes += len(data) - previous
+            evict = self._disk_bytes > self.max_disk_bytes
+        if evict:
+            self._evict_disk()
+
+    def _remove_disk(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes -= size
+
+    def _evict_disk(self):
+        "Removes least recently used disk entries down to 90% of the limit"
+        entries = sorted(self._disk_entries(), key=lambda e: e.stat().st_mtime)
+        for entry in entries:
+            if self._disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            self._remove_disk(entry.path)
+            self.counters["evictions"] += 1
+
+
+def get_cache(config: dict) -> ResultCache:
+    "Creates the result cache configured under kiosk.cache in config.yaml"
+    cache_config = config["kiosk"]["cache"]
+
+    return ResultCache(
+        directory=cache_config.get("directory"),
+        max_entries=cache_config["max_entries"],
+        max_disk_bytes=cache_config["max_disk_mb"] * 1024**2,
+        ttl=cache_config["ttl"],
+        persist_pii=cache_config.get("persist_pii", False),
+    )
@@ -1,13 +1,33 @@
-import json
-from requests import get, post
+import asyncio
+import contextvars
 import logging
 import yaml
-import time
-from io import BytesIO
+import requests
+from functools import partial
+from typing import Union
 import pandas as pd
 import numpy as np
 from faker import Faker
 from azure.ai.formrecognizer import FormRecognizerClient
+from src.utils_cache import MISSING
+from src.utils_cache import ResultCache
+from src.utils_cache import cache_key
+from src.utils_http import HttpClient
+from src.utils_http import default_http_client
+from src.utils_image import ImageBuffer
+from src.utils_image import ImageStream
+from src.utils_image import image_stream
+from src.utils_image import map_image
+from src.utils_manifest import ManifestSource
+from src.utils_metrics import metrics
+from src.utils_poller import OperationTimeout
+from src.utils_ratelimit import DEFAULT_RETRY_AFTER
+from src.utils_ratelimit import RateLimiter
+from src.utils_resilience import ServiceError
+from src.utils_poller import parse_retry_after
+from src.utils_poller import poll
+from src.utils_poller import poll_async
+from src.utils_poller import poll_many
 
 
 def load_config(filepath: str = "config.yaml") -> dict:
@@ -69,31 +89,44 @@ def get_data():
     return df
 
 
-def load_img(filepath: str, as_BufferedReader: bool = False) -> bytes:
-    "Returns image as byte array"
+def load_img(
+    filepath: str, as_BufferedReader: bool = False
+) -> Union[memoryview, ImageStream]:
+    "Returns image as memory-mapped buffer, or as open stream over it"
 
     logging.info(f"Loading {filepath}")
 
-    with open(filepath, "rb") as image_file:
-        if as_BufferedReader:
-            return image_file
-        else:
-            return image_file.read()
+    image = map_image(filepath)
+    if as_BufferedReader:
+        return image_stream(image)
+
+    return image
 
 
 def get_flight_manifest(
-    filepath: str = "data/raw/flight_manifest.csv",
+    filepath: str = "data/raw/flight_manifest.csv", cache_path: str = None
 ) -> pd.DataFrame:
-    return pd.read_csv(filepath, parse_dates=["flight_date", "birthdate"])
+    "Compact flight manifest, reused from cache_path while the file is unchanged"
+    return ManifestSource(filepath, cache_path).load()
 
 
 def get_id_details(
     form_recognizer_client: FormRecognizerClient,
-    input_img: bytes,
+    input_img: ImageBuffer,
     verbose: bool = False,
+    cache: ResultCache = None,
 ) -> dict:
     "Gets text from"
-    poller = form_recognizer_client.begin_recognize_identity_documents(input_img)
+    if cache is not None:
+        return cache.get_or_call(
+            cache_key("id_details", "prebuilt:idDocument", input_img),
+            lambda: get_id_details(form_recognizer_client, input_img, verbose),
+            pii=True,
+        )
+
+    poller = form_recognizer_client.begin_recognize_identity_documents(
+        image_stream(input_img)
+    )
     id_documents = poller.result()
 
     for idx, id_document in enumerate(id_documents):
@@ -165,9 +198,18 @@ def get_id_details(
 
 
 def get_url_boardingpass(
-    input_img: bytes, apikey: str, endpoint: str, model_id: str
+    input_img: ImageBuffer,
+    apikey: str,
+    endpoint: str,
+    model_id: str,
+    http: HttpClient = None,
+    limiter: RateLimiter = None,
 ) -> dict:
-    "Returns dataframe of boarding pass tags"
+    """Submits boarding pass to the custom model, returns the operation URL.
+
+    With limiter the POST takes a form_recognizer token and is repeated
+    after Retry-After while the service answers 429.
+    """
 
     if apikey is None:
         raise ValueError("apikey missing")
@@ -187,51 +229,224 @@ def get_url_boardingpass(
         "Ocp-Apim-Subscription-Key": apikey,
     }
 
-    try:
-        resp = post(url=post_url, data=input_img, headers=headers, params=params)
-        if resp.status_code != 202:
-            logging.error("POST analyze failed:\n%s" % json.dumps(resp.json()))
-            quit()
-        logging.info("POST analyze succeeded:\n%s" % resp.headers)
+    http = http or default_http_client()
 
-        return resp.headers["operation-location"]
+    def post() -> requests.Response:
+        resp = http.post(
+            url=post_url, data=image_stream(input_img), headers=headers, params=params
+        )
+        if resp.status_code == 429:
+            raise requests.HTTPError("POST analyze throttled", response=resp)
+        return resp
 
-    except Exception as e:
+    try:
+        resp = post() if limiter is None else limiter.call("form_recognizer", post)
+    except requests.RequestException as e:
         logging.error("POST analyze failed:\n%s" % str(e))
-        quit()
+        raise ServiceError(f"POST analyze failed: {e}") from e
+
+    if resp.status_code != 202:
+        logging.error("POST analyze failed:\n%s" % resp.text)
+        raise ServiceError(f"POST analyze returned {resp.status_code}")
+    logging.info("POST analyze succeeded:\n%s" % resp.headers)
+
+    return resp.headers["operation-location"]
+
+
+def fetch_analyze_result(
+    get_url: str, apikey: str, http: HttpClient = None, limiter: RateLimiter = None
+) -> tuple:
+    "GETs analyze operation once, returns (json or None, Retry-After seconds)"
+    if limiter is not None:
+        limiter.acquire("form_recognizer_get")
+    resp_get = (http or default_http_client()).get(
+        url=get_url,
+        headers={"Ocp-Apim-Subscription-Key": apikey},
+    )
+    retry_after = parse_retry_after(resp_get.headers.get("Retry-After"))
+
+    if resp_get.status_code == 429 and limiter is not None:
+        # polls of all passengers wait, not only this one
+        limiter.throttled("form_recognizer_get", retry_after or DEFAULT_RETRY_AFTER)
+    if resp_get.status_code != 200:
+        logging.warning(f"GET analyze returned {resp_get.status_code}. Retry.")
+        metrics.inc("kiosk_retries_total", operation="boardingpass_poll")
+        return None, retry_after
+
+    return resp_get.json(), retry_after
+
+
+def analyze_is_done(result: dict) -> bool:
+    "Analyze operation reached a final state"
+    return result is not None and result.get("status") in ["succeeded", "failed"]
+
+
+def get_boardingpass_fields(result: dict) -> dict:
+    "Returns boarding pass tags from a finished analyze operation"
+    if result.get("status") != "succeeded":
+        logging.error(f"Analyze operation failed: {result.get('error')}")
+        raise ServiceError(f"Analyze operation failed: {result.get('error')}")
+
+    dict_values = {
+        k: v["valueString"]
+        for k, v in result.get("analyzeResult")
+        .get("documentResults")[0]
+        .get("fields")
+        .items()
+    }
+
+    logging.info("SUCCESS. Return boardingpass details as dict.")
+
+    return dict_values
 
 
 def get_dict_boardingpass(
-    get_url: str, apikey: str, n_retries: int = 4, sleep_seconds: int = 2
+    get_url: str,
+    apikey: str,
+    deadline: float = 30.0,
+    http: HttpClient = None,
+    limiter: RateLimiter = None,
 ) -> dict:
-    "Returns dataframe of boarding pass tags"
-    for i in range(n_retries):
-        try:
-            time.sleep(sleep_seconds)
-            resp_get = get(
-                url=get_url,
-                headers={"Ocp-Apim-Subscription-Key": apikey},
+    """Returns dict of boarding pass tags, raises ServiceError if analysis
+    fails and OperationTimeout if it is not done after deadline seconds"""
+    try:
+        with metrics.span("boardingpass_poll"):
+            result = poll(
+                lambda: fetch_analyze_result(get_url, apikey, http, limiter),
+                analyze_is_done,
+                deadline=deadline,
+                name="boardingpass",
             )
+    except OperationTimeout:
+        logging.error(f"Boarding pass analysis not done after {deadline}s.")
+        raise
 
-            dict_values = {
-                k: v["valueString"]
-                for k, v in resp_get.json()
-                .get("analyzeResult")
-                .get("documentResults")[0]
-                .get("fields")
-                .items()
-            }
+    return get_boardingpass_fields(result)
 
-            logging.info("SUCCESS. Return boardingpass details as dict.")
 
-            return dict_values
-        except AttributeError:
-            logging.error(f"GET returned None. Retry {n_retries-i} times.")
+async def get_dict_boardingpass_async(
+    get_url: str,
+    apikey: str,
+    deadline: float = 30.0,
+    http: HttpClient = None,
+    limiter: RateLimiter = None,
+) -> dict:
+    "Same as get_dict_boardingpass without blocking the event loop while waiting"
+    try:
+        with metrics.span("boardingpass_poll"):
+            result = await poll_async(
+                lambda: fetch_analyze_result(get_url, apikey, http, limiter),
+                analyze_is_done,
+                deadline=deadline,
+                name="boardingpass",
+            )
+    except OperationTimeout:
+        logging.error(f"Boarding pass analysis not done after {deadline}s.")
+        raise
+
+    return get_boardingpass_fields(result)
+
+
+async def get_dicts_boardingpass(
+    get_urls: list,
+    apikey: str,
+    deadline: float = 30.0,
+    http: HttpClient = None,
+    limiter: RateLimiter = None,
+) -> list:
+    "Polls many analyze operations in one event loop, None for failed ones"
+    results = await poll_many(
+        [
+            partial(fetch_analyze_result, get_url, apikey, http, limiter)
+            for get_url in get_urls
+        ],
+        analyze_is_done,
+        deadline=deadline,
+        name="boardingpass",
+    )
+
+    return [
+        (
+            None
+            if isinstance(result, Exception) or result.get("status") != "succeeded"
+            else get_boardingpass_fields(result)
+        )
+        for result in results
+    ]
+
+
+def get_boardingpass(
+    input_img: ImageBuffer,
+    apikey: str,
+    endpoint: str,
+    model_id: str,
+    cache: ResultCache = None,
+    http: HttpClient = None,
+    limiter: RateLimiter = None,
+) -> dict:
+    "Analyzes boarding pass with custom model and returns its tags as dict"
+    if cache is not None:
+        return cache.get_or_call(
+            cache_key("boardingpass", model_id, input_img),
+            lambda: get_boardingpass(
+                input_img, apikey, endpoint, model_id, http=http, limiter=limiter
+            ),
+            pii=True,
+        )
 
-            if i == n_retries - 1:
-                quit()
-            else:
-                continue
+    with metrics.span("boardingpass_submit"):
+        get_url = get_url_boardingpass(
+            input_img,
+            apikey=apikey,
+            endpoint=endpoint,
+            model_id=model_id,
+            http=http,
+            limiter=limiter,
+        )
+
+    return get_dict_boardingpass(get_url, apikey=apikey, http=http, limiter=limiter)
+
+
+async def get_boardingpass_async(
+    input_img: ImageBuffer,
+    apikey: str,
+    endpoint: str,
+    model_id: str,
+    cache: ResultCache = None,
+    http: HttpClient = None,
+    limiter: RateLimiter = None,
+) -> dict:
+    "Same as get_boardingpass, waits for the analysis without blocking the loop"
+    if cache is not None:
+        key = cache_key("boardingpass", model_id, input_img)
+        if (dict_boardingpass := cache.get(key)) is not MISSING:
+            return dict_boardingpass
+        dict_boardingpass = await get_boardingpass_async(
+            input_img, apikey, endpoint, model_id, http=http, limiter=limiter
+        )
+        if dict_boardingpass is not None:
+            cache.set(key, dict_boardingpass, pii=True)
+        return dict_boardingpass
+
+    loop = asyncio.get_running_loop()
+    with metrics.span("boardingpass_submit"):
+        get_url = await loop.run_in_executor(
+            None,
+            contextvars.copy_context().run,
+            partial(
+                get_url_boardingpass,
+                input_img,
+                apikey=apikey,
+                endpoint=endpoint,
+                model_id=model_id,
+                http=http,
+                limiter=limiter,
+            ),
+        )
+
+    return await get_dict_boardingpass_async(
+        get_url, apikey=apikey, http=http, limiter=limiter
+    )
 
 
 def get_thumbnails_from_video(vi_client, video_info: dict) -> list:
@@ -247,17 +462,27 @@ def get_thumbnails_from_video(vi_client, video_info: dict) -> list:
     return images
 
 
-def compare_faces(face_client, img_reference: bytes, img_compare: bytes) -> dict:
+def compare_faces(
+    face_client,
+    img_reference: ImageBuffer,
+    img_compare: ImageBuffer,
+    cache: ResultCache = None,
+) -> dict:
+    if cache is not None:
+        return cache.get_or_call(
+            cache_key("compare_faces", "detection_03", img_reference, img_compare),
+            lambda: compare_faces(face_client, img_reference, img_compare),
+        )
 
     face_reference = face_client.face.detect_with_stream(
-        BytesIO(img_reference), detection_model="detection_03"
+        image_stream(img_reference), detection_model="detection_03"
     )
 
     face_compare = face_client.face.detect_with_stream(
-        BytesIO(img_compare), detection_model="detection_03"
+        image_stream(img_compare), detection_model="detection_03"
     )
 
-    if face_reference is None or face_compare is None:
+    if not face_reference or not face_compare:
         logging.warning("No face detected in reference or compare image")
         return None
     else:
@@ -0,0 +1,367 @@
+"""
+Face verification with a registry of reference faces.
+
+The reference face on the ID card is detected once per passenger and its
+face id is reused until it expires on the service side, so comparing
+against video thumbnails only detects the thumbnails.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+from PIL import Image
+from PIL import UnidentifiedImageError
+
+from src.utils_batch import MicroBatcher
+from src.utils_batch import burst
+from src.utils_batch import burst_size
+from src.utils_batch import get_batcher
+from src.utils_cache import ResultCache
+from src.utils_cache import cache_key
+from src.utils_image import ImageBuffer
+from src.utils_image import image_stream
+from src.utils_validate import validate_face
+
+# Face API deletes detected face ids 24 hours after detection
+FACE_ID_TTL = 24 * 3600
+
+
+def detect_face_id(
+    face_client, image: ImageBuffer, detection_model: str = "detection_03"
+) -> Optional[str]:
+    "Face id of the first face detected in image, None if there is none"
+    faces = face_client.face.detect_with_stream(
+        image_stream(image), detection_model=detection_model
+    )
+    if not faces:
+        logging.warning("No face detected in image")
+        return None
+
+    return faces[0].face_id
+
+
+class FaceRegistry:
+    """Reference face ids per passenger, detected once and reused.
+
+    Passengers are keyed by the hash of their ID image unless a key is
+    given. Face ids are dropped `expiry_margin` seconds before the service
+    expires them and detected again on next use, expired ones are pruned
+    with their locks whenever a face is stored. With a batcher, whose
+    dispatch is detect_face_ids, detections of concurrent passengers are
+    sent together.
+    """
+
+    def __init__(
+        self,
+        face_client,
+        detection_model: str = "detection_03",
+        expiry_margin: float = 3600,
+        max_workers: int = 4,
+        cache: ResultCache = None,
+    ):
+        self.face_client = face_client
+        self.detection_model = detection_model
+        self.ttl = FACE_ID_TTL - expiry_margin
+        self.max_workers = max_workers
+        self.cache = cache
+        self.batcher: MicroBatcher = None
+        # detections of a batch, threads keep their connections alive
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="face_detect"
+        )
+        self._faces = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def __len__(self) -> int:
+        return len(self._faces)
+
+    def _key_lock(self, passenger_key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(passenger_key, threading.Lock())
+
+    def _prune(self, now: float) -> None:
+        "Drops expired faces and the idle locks of passengers without a face"
+        for passenger_key in [k for k, (_, t) in self._faces.items() if t <= now]:
+            del self._faces[passenger_key]
+        for passenger_key, lock in list(self._key_locks.items()):
+            if passenger_key not in self._faces and not lock.locked():
+                del self._key_locks[passenger_key]
+
+    def detect_face_ids(self, images: List[ImageBuffer]) -> list:
+        "Futures of the face id per image, None without face"
+        return burst(self._executor, self._detect_face_id, images)
+
+    def _detect_face_id(self, image: ImageBuffer) -> Optional[str]:
+        return detect_face_id(
+            self.face_client, image, detection_model=self.detection_model
+        )
+
+    def detect(self, image: ImageBuffer) -> Optional[str]:
+        "Face id of the first face in image, in a micro-batch with a batcher"
+        if self.batcher is None:
+            return self._detect_face_id(image)
+        return self.batcher(image)
+
+    def register(self, img_reference: bytes, passenger_key: str = None) -> str:
+        "Detects and stores the reference face, returns its face id"
+        passenger_key = passenger_key or cache_key("passenger", img_reference)
+        face_id = self.detect(img_reference)
+        if face_id is not None:
+            now = time.monotonic()
+            with self._lock:
+                self._prune(now)
+                self._faces[passenger_key] = (face_id, now + self.ttl)
+            logging.info(f"Registered reference face {face_id}")
+
+        return face_id
+
+    def reference_face_id(
+        self, img_reference: bytes, passenger_key: str = None
+    ) -> Optional[str]:
+        "Stored reference face id, detected on first use or after expiry"
+        passenger_key = passenger_key or cache_key("passenger", img_reference)
+        with self._key_lock(passenger_key):
+            face_id, expires_at = self._faces.get(passenger_key, (None, 0))
+            if face_id is not None and expires_at > time.monotonic():
+                return face_id
+
+            return self.register(img_reference, passenger_key=passenger_key)
+
+    def _verify(self, face_id_reference: str, img_compare: bytes) -> Optional[dict]:
+        face_id_compare = self.detect(img_compare)
+        if face_id_compare is None:
+            return None
+
+        face_verify = self.face_client.face.verify_face_to_face(
+            face_id_reference, face_id_compare
+        )
+
+        logging.info(
+            f"Faces:\n\tReference: {face_id_reference}\n\tComparing: {face_id_compare}\n\tidentical: {face_verify.is_identical}\n\tconfidence: {face_verify.confidence}"
+        )
+
+        return {
+            "faceid_reference": face_id_reference,
+            "faceid_comparison": face_id_compare,
+            "face_is_identical": face_verify.is_identical,
+            "confidence": face_verify.confidence,
+        }
+
+    def verify(
+        self, face_id_reference: str, img_reference: bytes, img_compare: bytes
+    ) -> Optional[dict]:
+        "Verifies one thumbnail against the reference face, cached by content"
+        if self.cache is None:
+            return self._verify(face_id_reference, img_compare)
+
+        return self.cache.get_or_call(
+            cache_key(
+                "compare_faces", self.detection_model, img_reference, img_compare
+            ),
+            lambda: self._verify(face_id_reference, img_compare),
+        )
+
+    def compare(
+        self,
+        img_reference: bytes,
+        images_compare: List[bytes],
+        passenger_key: str = None,
+    ) -> List[Optional[dict]]:
+        """Compares the passenger's reference face with several thumbnails.
+
+        Each thumbnail needs one detection, thumbnails are verified in
+        parallel. Returns one result per thumbnail, None where no face was
+        found.
+        """
+        face_id_reference = self.reference_face_id(
+            img_reference, passenger_key=passenger_key
+        )
+        if face_id_reference is None:
+            logging.warning("No face detected in reference image")
+            return [None for _ in images_compare]
+
+        if len(images_compare) == 1:
+            return [self.verify(face_id_reference, img_reference, images_compare[0])]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(
+                executor.map(
+                    lambda img: self.verify(face_id_reference, img_reference, img),
+                    images_compare,
+                )
+            )
+
+    def best_match(
+        self,
+        img_reference: bytes,
+        images_compare: List[bytes],
+        passenger_key: str = None,
+    ) -> Optional[dict]:
+        "Result of the thumbnail matching the reference face most confidently"
+        results = [
+            r
+            for r in self.compare(img_reference, images_compare, passenger_key)
+            if r is not None
+        ]
+        if not results:
+            return None
+
+        return max(results, key=match_score)
+
+
+def get_face_registry(
+    config: dict, face_client, cache: ResultCache = None
+) -> FaceRegistry:
+    "Creates the face registry, detecting in micro-batches under kiosk.batching"
+    registry = FaceRegistry(
+        face_client, max_workers=burst_size(config, "face"), cache=cache
+    )
+    registry.batcher = get_batcher(config, "face", registry.detect_face_ids)
+
+    return registry
+
+
+def match_score(result: dict) -> tuple:
+    "Orders face comparisons, identical faces first, then by confidence"
+    return (bool(result["face_is_identical"]), result["confidence"])
+
+
+def frame_quality(image: ImageBuffer, min_size: int = 48, max_side: int = 256) -> float:
+    """Cheap local quality score of a thumbnail, higher is better.
+
+    Variance of the Laplacian of the downscaled grayscale frame (sharpness)
+    weighted by frame size. Frames smaller than min_size pixels or that
+    cannot be decoded score None and are skipped.
+    """
+    try:
+        with Image.open(image_stream(image)) as img:
+            width, height = img.size
+            if min(width, height) < min_size:
+                return None
+            img = img.convert("L")
+            img.thumbnail((max_side, max_side))
+            gray = np.asarray(img, dtype=np.float32)
+    except (UnidentifiedImageError, OSError):
+        logging.warning("Cannot decode thumbnail, skip it")
+        return None
+
+    laplacian = (
+        gray[:-2, 1:-1]
+        + gray[2:, 1:-1]
+        + gray[1:-1, :-2]
+        + gray[1:-1, 2:]
+        - 4 * gray[1:-1, 1:-1]
+    )
+
+    return float(laplacian.var()) * min(1.0, (width * height) / max_side**2)
+
+
+async def iterate_in_thread(iterator: Iterator) -> AsyncIterator:
+    "Yields from a blocking iterator, advancing it in the loop's executor"
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterator)
+    done = object()
+    while (item := await loop.run_in_executor(None, next, iterator, done)) is not done:
+        yield item
+
+
+async def verify_frames(
+    registry: FaceRegistry,
+    img_reference: bytes,
+    frames: Union[Iterable[bytes], AsyncIterator[bytes]],
+    confidence_min: float = 0.6,
+    max_in_flight: int = 2,
+    passenger_key: str = None,
+) -> Optional[dict]:
+    """Verifies video thumbnails against the ID face, best frames first.
+
+    frames is a list or an async iterator yielding thumbnails as they become
+    available. Frames are ranked by frame_quality before any API call and up
+    to max_in_flight of them are verified concurrently. Stops as soon as one
+    frame passes validate_face with confidence_min, otherwise returns the
+    best comparison or None.
+    """
+    loop = asyncio.get_running_loop()
+    # API calls run in the passenger's context, e.g. for its rate limits
+    face_id_reference = await loop.run_in_executor(
+        None,
+        contextvars.copy_context().run,
+        registry.reference_face_id,
+        img_reference,
+        passenger_key,
+    )
+    if face_id_reference is None:
+        logging.warning("No face detected in reference image")
+        return None
+
+    pending, order = [], itertools.count()
+    in_flight, best = set(), None
+
+    async def score(frame: bytes):
+        quality = await loop.run_in_executor(None, frame_quality, frame)
+        if quality is not None:
+            heapq.heappush(pending, (-quality, next(order), frame))
+
+    if hasattr(frames, "__aiter__"):
+        frames = frames.__aiter__()
+        next_frame = asyncio.ensure_future(frames.__anext__())
+    else:
+        # all frames are known, rank them before spending API calls
+        await asyncio.gather(*[score(frame) for frame in frames])
+        next_frame = None
+
+    try:
+        while True:
+            while pending and len(in_flight) < max_in_flight:
+                frame = heapq.heappop(pending)[2]
+                in_flight.add(
+                    loop.run_in_executor(
+                        None,
+                        contextvars.copy_context().run,
+                        registry.verify,
+                        face_id_reference,
+                        img_reference,
+                        frame,
+                    )
+                )
+            waiting = in_flight | ({next_frame} if next_frame else set())
+            if not waiting:
+                break
+
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is next_frame:
+                    try:
+                        await score(task.result())
+                        next_frame = asyncio.ensure_future(frames.__anext__())
+                    except StopAsyncIteration:
+                        next_frame = None
+                    continue
+
+                in_flight.discard(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logging.warning(f"Face verification of a frame failed: {e!r}")
+                    continue
+                if result is None:
+                    continue
+                if best is None or match_score(result) > match_score(best):
+                    best = result
+                if validate_face(result, confidence_min=confidence_min):
+                    return result
+    finally:
+        # early exit: don't start or wait for the remaining frames
+        for task in in_flight | ({next_frame} if next_frame else set()):
+            task.cancel()
+
+    return best
@@ -0,0 +1,113 @@
+"""
+Shared HTTP client for the cognitive service endpoints.
+
+One long-lived requests session with a keep-alive connection pool, request
+timeouts and a retry policy. The raw REST calls use it directly and the
+Azure SDK clients are configured to reuse it or to keep their connections
+alive, so a passenger does not pay a TCP and TLS handshake per request.
+"""
+
+import logging
+import threading
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpClient:
+    """requests session with pooled keep-alive connections.
+
+    GETs are retried on connection errors and 5xx responses with
+    exponential backoff. POSTs are only retried when the connection could
+    not be established, since analyze requests are not idempotent. HTTP 429
+    is left to the caller, which honours Retry-After.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 16,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 30.0,
+        retries: int = 3,
+        backoff_factor: float = 0.25,
+    ):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=self.retry
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def __enter__(self) -> "HttpClient":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def azure_transport(self) -> RequestsTransport:
+        "azure-core transport on the shared session, e.g. for FormRecognizerClient"
+        return RequestsTransport(
+            session=self.session,
+            session_owner=False,
+            connection_timeout=self.timeout[0],
+            read_timeout=self.timeout[1],
+        )
+
+    def configure_msrest(self, client) -> None:
+        """Keeps connections of an msrest based client (Face, Custom Vision) alive.
+
+        msrest holds one session per thread and closes it after every
+        response unless keep_alive is set. Timeouts and retries follow this
+        client's configuration.
+        """
+        client.config.keep_alive = True
+        client.config.connection.timeout = self.timeout
+        client.config.retry_policy.retries = self.retries
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def default_http_client() -> HttpClient:
+    "Process-wide client used when no client is passed explicitly"
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = HttpClient()
+
+    return _default_client
+
+
+def get_http_client(config: dict) -> HttpClient:
+    "Creates the HTTP client configured under kiosk.http in config.yaml"
+    http_config = config["kiosk"]["http"]
+    logging.info(f"HTTP client: {http_config}")
+
+    return HttpClient(**http_config)
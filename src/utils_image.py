@@ -0,0 +1,174 @@
+"""
+Zero-copy image sources.
+
+Images are memory-mapped read-only and passed around as memoryviews. Uploads
+and decoders read from the mapping through `image_stream` instead of copying
+the file into bytes and again into BytesIO. Mapped pages belong to the page
+cache and are shared between passengers reading the same file.
+"""
+
+import asyncio
+import io
+import logging
+import mmap
+import os
+import resource
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Union
+from src.utils_metrics import metrics
+
+ImageBuffer = Union[bytes, bytearray, memoryview]
+
+
+def map_image(filepath: str) -> memoryview:
+    "Read-only memoryview of the file, mapped instead of read"
+    with open(filepath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return memoryview(b"")
+        # the mapping outlives the file descriptor and is unmapped with the view
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class ImageStream(io.RawIOBase):
+    """Seekable binary reader over a buffer, reads do not copy the buffer.
+
+    Works as upload body for requests and the Azure SDKs and as input for
+    PIL.Image.open.
+    """
+
+    def __init__(self, image: ImageBuffer):
+        self._view = memoryview(image).cast("B")
+        self._position = 0
+
+    def __len__(self) -> int:
+        return self._view.nbytes
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = min(len(buffer), self._view.nbytes - self._position)
+        buffer[:n] = self._view[self._position : self._position + n]
+        self._position += n
+        return n
+
+    def read(self, size: int = -1) -> bytes:
+        end = self._view.nbytes if size is None or size < 0 else self._position + size
+        data = self._view[self._position : end].tobytes()
+        self._position += len(data)
+        return data
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self)}
+        self._position = max(0, base[whence] + offset)
+        return self._position
+
+
+def image_stream(image: ImageBuffer) -> ImageStream:
+    "File-like view of image for uploads and decoders"
+    return ImageStream(image)
+
+
+class ImageCache:
+    """LRU of mapped images for files that are read by many passengers.
+
+    Entries are keyed by path, size and modification time so that a changed
+    file is mapped again. At most `max_bytes` of mappings are kept.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024**2):
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def load(self, filepath: str) -> memoryview:
+        stat = os.stat(filepath)
+        key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.counters["hits"] += 1
+                return image
+
+        image = map_image(filepath)
+        with self._lock:
+            self.counters["misses"] += 1
+            if image.nbytes <= self.max_bytes:
+                self._images[key] = image
+                self._bytes += image.nbytes
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._images.popitem(last=False)
+                    self._bytes -= evicted.nbytes
+
+        return image
+
+
+def rss_bytes() -> int:
+    "Current resident set size of this process"
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # peak instead of current RSS where /proc is missing, kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget:
+    """Caps the image bytes of passengers in flight.
+
+    A passenger reserves the size of its input files before loading them and
+    waits while the budget is used up. A passenger larger than the whole
+    budget runs alone. The budget is in file bytes, as mapped, the decoded
+    pixels of preprocessing are not counted.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024**2):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.peak = 0
+        self._condition = None
+
+    @asynccontextmanager
+    async def reserve(self, n_bytes: int):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        n_bytes = min(n_bytes, self.max_bytes)
+        async with self._condition:
+            with metrics.span("memory_wait"):
+                await self._condition.wait_for(
+                    lambda: self.in_use + n_bytes <= self.max_bytes
+                )
+            self.in_use += n_bytes
+            self.peak = max(self.peak, self.in_use)
+            metrics.set_gauge("kiosk_inflight_image_bytes", self.in_use)
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_use -= n_bytes
+                metrics.set_gauge("kiosk_inflight_image_bytes", self.in_use)
+                self._condition.notify_all()
+
+
+def files_size(filepaths: list) -> int:
+    "Total size in bytes of the files that exist"
+    size = 0
+    for filepath in filepaths:
+        try:
+            size += os.path.getsize(filepath)
+        except OSError:
+            logging.warning(f"Cannot stat {filepath}")
+
+    return size
@@ -7,9 +7,35 @@ from azure.cognitiveservices.vision.customvision.prediction import (
 from azure.cognitiveservices.vision.customvision.training.models import (
     CustomVisionErrorException,
 )
-import time
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import threading
+from typing import List, NamedTuple
+import numpy as np
+from PIL import Image
+from src.utils_batch import MicroBatcher
+from src.utils_batch import burst
+from src.utils_batch import burst_size
+from src.utils_batch import get_batcher
+from src.utils_cache import ResultCache
+from src.utils_cache import cache_key
+from src.utils_image import ImageBuffer
+from src.utils_image import image_stream
+from src.utils_metrics import metrics
+from src.utils_poller import OperationTimeout
+from src.utils_poller import fetch_with
+from src.utils_poller import poll
+from src.utils_resilience import ServiceError
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+# final statuses of a training iteration
+TRAINING_DONE = {"Completed", "Failed"}
 
 
 def train_cv_model(
@@ -18,19 +44,28 @@ def train_cv_model(
     training_time_expected: int = 540,
     sleep_interval: int = 30,
 ):
+    "Trains project, raises ServiceError if the iteration does not complete"
     try:
         iteration = trainer.train_project(project.id)
         logging.info(f"Start training. Expected time: {training_time_expected} seconds")
-        for i in range(round(training_time_expected / sleep_interval)):
-            iteration = trainer.get_iteration(project.id, iteration.id)
-            logging.info(f"Training status: {iteration.status}. Sleep for 30s.")
-
-            if iteration.status == "Completed":
-                break
+        iteration = poll(
+            fetch_with(trainer.get_iteration, project.id, iteration.id),
+            lambda i: i.status in TRAINING_DONE,
+            deadline=training_time_expected,
+            initial_delay=min(5, sleep_interval),
+            max_delay=sleep_interval,
+        )
+        if iteration.status != "Completed":
+            raise ServiceError(
+                f"Training of {iteration.name} ended with status {iteration.status}"
+            )
 
-            time.sleep(sleep_interval)
+        logging.info(f"Training completed. Status: {iteration.status}")
 
-        logging.info(f"Training expected to be completed. Status: {iteration.status}")
+    except OperationTimeout:
+        logging.warning(
+            f"Training not completed after {training_time_expected} seconds."
+        )
 
     except CustomVisionErrorException as e:
         logging.warning(f"{e}. Skip training.")
@@ -98,10 +133,15 @@ def publish_last_iteration_endpoint(
         logging.warning(f"{e}")
 
 
-def get_published_iteration(trainer, project):
-    # get prediction endpoint
+def get_published_iteration(trainer, project, publish_name: str = None):
+    # get prediction endpoint, the one published as publish_name if given
     iteration_published = next(
-        i for i in trainer.get_iterations(project.id) if i.publish_name
+        (
+            i
+            for i in trainer.get_iterations(project.id)
+            if i.publish_name and publish_name in (None, i.publish_name)
+        ),
+        None,
     )
     if iteration_published:
         logging.info(
@@ -113,9 +153,320 @@ def get_published_iteration(trainer, project):
     return iteration_published
 
 
-def detect_image(predictor, project, publish_iteration_name: str, image: bytes):
+class LighterModel:
+    """Resolved handle on the published lighter detection model.
+
+    Project and the iteration published as publish_name are looked up once
+    and reused for every prediction. A background thread can refresh the
+    handle to pick up the iteration publish_name is moved to.
+    """
+
+    def __init__(
+        self,
+        trainer: CustomVisionTrainingClient,
+        project_name: str,
+        publish_name: str,
+    ):
+        self.trainer = trainer
+        self.project_name = project_name
+        self.project = get_project(trainer, project_name)
+        self.iteration = None
+        self.publish_name = publish_name
+        self._stop_refresh = threading.Event()
+        self._refresh_thread = None
+        self.refresh()
+
+    @property
+    def iteration_id(self) -> str:
+        return self.iteration.id if self.iteration else None
+
+    def refresh(self) -> bool:
+        "Looks up the published iteration again, True if the iteration changed"
+        iteration = get_published_iteration(
+            self.trainer, self.project, self.publish_name
+        )
+        changed = iteration is not None and iteration.id != self.iteration_id
+
+        if changed:
+            self.iteration = iteration
+            logging.info(
+                f"Lighter model uses {iteration.publish_name} ({iteration.id})."
+            )
+
+        return changed
+
+    def start_refresh(self, interval: float = 300) -> None:
+        "Refreshes the handle every interval seconds in a daemon thread"
+        if self._refresh_thread is not None:
+            return
+
+        def run():
+            while not self._stop_refresh.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logging.warning(f"Could not refresh lighter model: {e}")
+
+        self._refresh_thread = threading.Thread(
+            target=run, name="LighterModelRefresh", daemon=True
+        )
+        self._refresh_thread.start()
+
+    def stop_refresh(self) -> None:
+        "Stops the refresh thread, waits for a refresh in progress"
+        self._stop_refresh.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+            self._refresh_thread = None
+
+
+def detect_image(
+    predictor,
+    project,
+    publish_iteration_name: str,
+    image: ImageBuffer,
+    cache: ResultCache = None,
+    iteration_id: str = None,
+):
+    if cache is not None:
+        return cache.get_or_call(
+            cache_key(
+                "detect_image",
+                project.id,
+                publish_iteration_name,
+                iteration_id,
+                image,
+            ),
+            lambda: detect_image(predictor, project, publish_iteration_name, image),
+        )
+
     logging.info("Detecting lighters")
-    return predictor.detect_image(project.id, publish_iteration_name, BytesIO(image))
+    return predictor.detect_image(
+        project.id, publish_iteration_name, image_stream(image)
+    )
+
+
+class LocalPrediction(NamedTuple):
+    "Prediction of a local backend, same attributes as Custom Vision's"
+
+    tag_name: str
+    probability: float
+    bounding_box: dict
+
+
+class LocalImagePrediction(NamedTuple):
+    "Predictions for one image of a local backend"
+
+    predictions: List[LocalPrediction]
+    iteration: str
+
+
+class LighterDetector:
+    """Interface of lighter detection backends.
+
+    detect returns one result per image, each with a `predictions` list of
+    objects with `tag_name` and `probability` sorted by probability.
+    detect_each returns the exception instead of the result of an image
+    that failed, or a Future of the result, so that a batch of passengers'
+    images fails and completes image by image.
+    """
+
+    def detect(self, images: List[bytes]) -> list:
+        raise NotImplementedError
+
+    def detect_each(self, images: List[bytes]) -> list:
+        try:
+            return self.detect(images)
+        except Exception as e:
+            return [e] * len(images)
+
+    def close(self) -> None:
+        "Stops the backend's threads"
+
+
+class AzureLighterDetector(LighterDetector):
+    """Custom Vision prediction endpoint, one request per image.
+
+    Images are sent in parallel from a persistent thread pool, whose threads
+    keep their msrest sessions and connections alive between images.
+    """
+
+    def __init__(
+        self,
+        predictor: CustomVisionPredictionClient,
+        model: LighterModel,
+        cache: ResultCache = None,
+        max_workers: int = 4,
+    ):
+        self.predictor = predictor
+        self.model = model
+        self.cache = cache
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="customvision"
+        )
+
+    def _detect_one(self, image: bytes):
+        return detect_image(
+            self.predictor,
+            self.model.project,
+            self.model.publish_name,
+            image,
+            cache=self.cache,
+            iteration_id=self.model.iteration_id,
+        )
+
+    def detect(self, images: List[bytes]) -> list:
+        if len(images) == 1:
+            return [self._detect_one(images[0])]
+        return [future.result() for future in self.detect_each(images)]
+
+    def detect_each(self, images: List[bytes]) -> list:
+        return burst(self._executor, self._detect_one, images)
+
+    def close(self) -> None:
+        if self.model is not None:
+            self.model.stop_refresh()
+        self._executor.shutdown()
+
+
+class OnnxLighterDetector(LighterDetector):
+    """Exported Custom Vision object detection model run in-process on CPU.
+
+    Expects the ONNX export of a compact object detection domain with the
+    outputs detected_boxes, detected_classes and detected_scores and its
+    labels.txt. The session is created once and kept warm, images are
+    stacked into one forward pass if the model has a dynamic batch axis.
+    A session with the same inputs and outputs may be given instead.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        labels_path: str,
+        prob_threshold: float = 0.01,
+        providers: List[str] = None,
+        session=None,
+    ):
+        if session is None and onnxruntime is None:
+            raise ImportError("OnnxLighterDetector requires onnxruntime")
+
+        self.session = session or onnxruntime.InferenceSession(
+            model_path, providers=providers or ["CPUExecutionProvider"]
+        )
+        with open(labels_path) as f:
+            self.labels = [line.strip() for line in f if line.strip()]
+        self.prob_threshold = prob_threshold
+        self.iteration = os.path.basename(model_path)
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.batch_size, _, self.height, self.width = model_input.shape
+        self.dynamic_batch = not isinstance(self.batch_size, int)
+        outputs = {o.name for o in self.session.get_outputs()}
+        if not {"detected_boxes", "detected_classes", "detected_scores"} <= outputs:
+            raise ValueError(f"Unsupported ONNX outputs {outputs} in {model_path}")
+
+        # warm up so that the first passenger does not pay for initialization
+        self._forward(np.zeros((1, 3, self.height, self.width), dtype=np.float32))
+        logging.info(f"Loaded local lighter model {model_path}")
+
+    def _preprocess(self, image: ImageBuffer) -> np.ndarray:
+        "Resized image as float32 BGR array in CHW layout"
+        with Image.open(image_stream(image)) as img:
+            img = img.convert("RGB").resize((self.width, self.height))
+            array = np.asarray(img, dtype=np.float32)[:, :, ::-1]
+
+        return np.ascontiguousarray(array.transpose(2, 0, 1))
+
+    def _forward(self, batch: np.ndarray) -> list:
+        return self.session.run(
+            ["detected_boxes", "detected_classes", "detected_scores"],
+            {self.input_name: batch},
+        )
+
+    def _to_result(self, boxes, classes, scores) -> LocalImagePrediction:
+        order = np.argsort(-scores)
+        return LocalImagePrediction(
+            predictions=[
+                LocalPrediction(
+                    tag_name=self.labels[int(classes[i])],
+                    probability=float(scores[i]),
+                    bounding_box={
+                        "left": float(boxes[i][0]),
+                        "top": float(boxes[i][1]),
+                        "width": float(boxes[i][2] - boxes[i][0]),
+                        "height": float(boxes[i][3] - boxes[i][1]),
+                    },
+                )
+                for i in order
+                if scores[i] >= self.prob_threshold
+            ],
+            iteration=self.iteration,
+        )
+
+    def detect(self, images: List[bytes]) -> list:
+        logging.info(f"Detecting lighters locally in {len(images)} images")
+        inputs = [self._preprocess(image)[np.newaxis] for image in images]
+        batches = [np.concatenate(inputs)] if self.dynamic_batch else inputs
+
+        results = []
+        for batch in batches:
+            boxes, classes, scores = self._forward(batch)
+            results.extend(
+                self._to_result(boxes[i], classes[i], scores[i])
+                for i in range(len(batch))
+            )
+
+        return results
+
+
+class BatchingLighterDetector(LighterDetector):
+    """Lighter detection of concurrent passengers in micro-batches.
+
+    Images are collected by batcher, whose dispatch is detect_each of the
+    wrapped backend: one forward pass of the ONNX model, a burst of
+    requests to Custom Vision.
+    """
+
+    def __init__(self, detector: LighterDetector, batcher: MicroBatcher):
+        self.detector = detector
+        self.batcher = batcher
+
+    def detect(self, images: List[bytes]) -> list:
+        return self.batcher.map(images)
+
+    def close(self) -> None:
+        self.batcher.close()
+        self.detector.close()
+
+
+def get_lighter_detector(
+    config: dict,
+    predictor: CustomVisionPredictionClient = None,
+    model: LighterModel = None,
+    cache: ResultCache = None,
+) -> LighterDetector:
+    """Creates the backend configured under kiosk.lighter_detector in config.yaml,
+    in micro-batches if kiosk.batching is enabled"""
+    detector_config = config["kiosk"]["lighter_detector"]
+    if detector_config["backend"] == "onnx":
+        detector = OnnxLighterDetector(
+            detector_config["model_path"], detector_config["labels_path"]
+        )
+    else:
+        detector = AzureLighterDetector(
+            predictor,
+            model,
+            cache=cache,
+            max_workers=burst_size(config, "lighter"),
+        )
+
+    batcher = get_batcher(config, "lighter", detector.detect_each)
+    if batcher is None:
+        return detector
+
+    return BatchingLighterDetector(detector, batcher)
 
 
 def get_prediction_result(result, top_n: int = 3) -> dict:
@@ -143,16 +494,16 @@ def pipeline_training_lighterdetection(
 
 
 def pipeline_prediction_lighterdetection(
-    trainer: CustomVisionTrainingClient,
-    predictor: CustomVisionPredictionClient,
-    project_name: str,
-    publish_name: str,
+    detector: LighterDetector,
     image: bytes,
     top_n: int = 3,
 ):
-    project = get_project(trainer, project_name)
-    result = detect_image(predictor, project, publish_name, image)
+    "Predicts lighters in image with the configured detection backend"
+    with metrics.span("lighter_detection"):
+        result = detector.detect([image])[0]
     probabilities = get_prediction_result(result, top_n=top_n)
+    # backends drop predictions below their threshold, none is a clean bag
+    probabilities.setdefault("lighter", [0.0])
 
     logging.info(f"Prediction probabilities: {probabilities}")
 
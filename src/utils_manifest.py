@@ -0,0 +1,503 @@
+"""
+Indexed in-memory flight manifest.
+
+Wraps the manifest DataFrame with hash indices on normalized name,
+on (name, date of birth) and on (flight number, seat) so that a passenger
+lookup does not scan the whole manifest. Names without exact match are
+looked up in a fuzzy NameIndex.
+
+ManifestSource parses the manifest CSV once per version of the file into
+a compact frame, categorical flight columns and datetime64 dates, and
+keeps the parsed frame in a pickle next to it. In service mode it watches
+the file and applies added, changed and removed passengers to the live
+store, validation flags of a passenger are kept across reloads.
+"""
+
+import asyncio
+import logging
+import os
+import pickle
+import tempfile
+import unicodedata
+from collections import defaultdict
+from datetime import date
+from datetime import datetime
+from typing import Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from src.utils_metrics import metrics
+from src.utils_names import NameIndex
+from src.utils_names import NameMatch
+
+# repeat for every passenger of a flight
+CATEGORY_COLUMNS = [
+    "flight_number",
+    "flight_time",
+    "origin",
+    "destination",
+    "gate",
+    "sex",
+]
+DATE_COLUMNS = ["flight_date", "birthdate"]
+# set by the kiosk, not by the manifest file
+STATE_COLUMNS = ["pending_review"]
+
+
+def normalize_name(name: str) -> str:
+    "Unicode-normalized, case-folded name with collapsed whitespace"
+    if name is None:
+        return ""
+
+    return " ".join(unicodedata.normalize("NFKC", str(name)).casefold().split())
+
+
+def normalize_names(names: pd.Series) -> pd.Series:
+    "Vectorized normalize_name over a Series of names"
+    return (
+        names.fillna("")
+        .astype(str)
+        .str.normalize("NFKC")
+        .str.casefold()
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+
+
+def to_date(value) -> Optional[date]:
+    "Returns value as datetime.date, None if missing"
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if pd.isna(value):
+        return None
+
+    return pd.Timestamp(value).date()
+
+
+def compact_manifest(flight_manifest: pd.DataFrame) -> pd.DataFrame:
+    "Manifest with categorical flight columns and datetime64 dates"
+    columns = {
+        column: flight_manifest[column].astype("category")
+        for column in CATEGORY_COLUMNS
+        if column in flight_manifest
+    }
+    columns.update(
+        {
+            column: pd.to_datetime(flight_manifest[column], errors="coerce")
+            for column in DATE_COLUMNS
+            if column in flight_manifest
+        }
+    )
+
+    return flight_manifest.assign(**columns)
+
+
+def is_state_column(column: str) -> bool:
+    "Columns kept for a passenger when the manifest is reloaded"
+    return column.startswith("valid_") or column in STATE_COLUMNS
+
+
+def passenger_keys(flight_manifest: pd.DataFrame, name_keys: pd.Series) -> pd.Index:
+    """Identity of manifest rows across versions of the file.
+
+    Flight, normalized name and date of birth, numbered if they repeat.
+    A seat change keeps the key, so the row counts as changed.
+    """
+    dobs = pd.to_datetime(flight_manifest["birthdate"], errors="coerce")
+    keys = (
+        flight_manifest["flight_number"].astype(str).to_numpy()
+        + "|"
+        + name_keys.to_numpy()
+        + "|"
+        + dobs.dt.strftime("%Y-%m-%d").fillna("").to_numpy()
+    )
+    keys = pd.Series(keys, index=flight_manifest.index)
+
+    return pd.Index(keys + "|" + keys.groupby(keys).cumcount().astype(str))
+
+
+def union_categories(df: pd.DataFrame, other: pd.DataFrame) -> None:
+    "Gives categorical columns of df and other the same categories, in place"
+    for column in CATEGORY_COLUMNS:
+        if column not in df or column not in other:
+            continue
+        if not isinstance(df[column].dtype, pd.CategoricalDtype):
+            continue
+        categories = df[column].cat.categories.union(
+            pd.Index(other[column].astype(object).dropna().unique())
+        )
+        df[column] = df[column].cat.set_categories(categories)
+        other[column] = pd.Categorical(other[column], categories=categories)
+
+
+class ManifestStore:
+    """Flight manifest with O(1) passenger lookups.
+
+    The DataFrame is kept as is and updated in place, lookups return its
+    index labels. Index labels must be unique. With min_name_score set,
+    find_passenger accepts fuzzy name matches of at least that score.
+    """
+
+    def __init__(self, flight_manifest: pd.DataFrame, min_name_score: float = None):
+        if not flight_manifest.index.is_unique:
+            raise ValueError("Flight manifest index must be unique")
+
+        self.df = flight_manifest
+        self.min_name_score = min_name_score
+        self._names: Optional[NameIndex] = None
+        self._by_name = defaultdict(list)
+        self._by_name_dob = defaultdict(list)
+        self._by_seat = defaultdict(list)
+
+        # normalized names on the manifest index, reused by batch validation
+        self.name_keys = normalize_names(flight_manifest["name"])
+        dobs = pd.to_datetime(flight_manifest["birthdate"], errors="coerce")
+        for label, key, dob, flight_number, seat in zip(
+            flight_manifest.index,
+            self.name_keys,
+            dobs.dt.date.where(dobs.notna(), None),
+            flight_manifest["flight_number"],
+            flight_manifest["seat"],
+        ):
+            self._add_to_index(label, key, dob, flight_number, seat)
+        if min_name_score is not None:
+            self._index_names()
+
+        metrics.set_gauge("kiosk_manifest_passengers", len(self))
+        logging.info(f"Indexed flight manifest with {len(self)} passengers.")
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def _add_to_index(self, label, key: str, dob: date, flight_number, seat):
+        if self._names is not None and key not in self._by_name:
+            self._names.add(key)
+        self._by_name[key].append(label)
+        self._by_name_dob[(key, dob)].append(label)
+        self._by_seat[(flight_number, seat)].append(label)
+
+    def _remove_from_index(self, label):
+        row = self.df.loc[label]
+        key = self.name_keys[label]
+        for index, index_key in [
+            (self._by_name, key),
+            (self._by_name_dob, (key, to_date(row["birthdate"]))),
+            (self._by_seat, (row["flight_number"], row["seat"])),
+        ]:
+            index[index_key].remove(label)
+            if not index[index_key]:
+                del index[index_key]
+        if self._names is not None and key not in self._by_name:
+            self._names.remove(key)
+
+    def _index_names(self):
+        with metrics.span("name_index"):
+            self._names = NameIndex()
+            for key in self._by_name:
+                self._names.add(key)
+        logging.info(f"Indexed {len(self._names)} name tokens for fuzzy lookups.")
+
+    def _index_rows(self, labels: pd.Index):
+        for label in labels:
+            row = self.df.loc[label]
+            self._add_to_index(
+                label,
+                self.name_keys[label],
+                to_date(row["birthdate"]),
+                row["flight_number"],
+                row["seat"],
+            )
+
+    def apply(
+        self,
+        flight_manifest: pd.DataFrame,
+        first_label: int = None,
+        label_step: int = 1,
+    ) -> Dict[str, int]:
+        """Updates the store to a new version of the manifest.
+
+        Rows are matched by passenger_keys. Only added, changed and removed
+        rows are re-indexed. Matched rows keep their index label and their
+        validation flags, added rows start with the flags of the new
+        version or False. Added rows are labeled from first_label in steps
+        of label_step, by default after the largest label. Returns the
+        number of rows per kind of change.
+        """
+        new = flight_manifest.reset_index(drop=True)
+        new_name_keys = normalize_names(new["name"])
+        new.index = passenger_keys(new, new_name_keys)
+        new_name_keys.index = new.index
+        labels = pd.Series(self.df.index, index=passenger_keys(self.df, self.name_keys))
+
+        removed = labels.index.difference(new.index, sort=False)
+        added = new.index.difference(labels.index, sort=False)
+        common = new.index.intersection(labels.index, sort=False)
+
+        source = [c for c in new.columns if c in self.df and not is_state_column(c)]
+        before = self.df.loc[labels[common], source].astype(object)
+        after = new.loc[common, source].astype(object)
+        before.index = common
+        same = (before == after) | (before.isna() & after.isna())
+        changed = common[~same.all(axis=1).to_numpy()]
+
+        union_categories(self.df, new)
+        for label in labels[removed.append(changed)]:
+            self._remove_from_index(label)
+        self.df = self.df.drop(index=labels[removed])
+        self.name_keys = self.name_keys.drop(index=labels[removed])
+
+        changed_labels = pd.Index(labels[changed])
+        if len(changed):
+            self.df.loc[changed_labels, source] = new.loc[changed, source].to_numpy()
+            self.name_keys[changed_labels] = new_name_keys[changed].to_numpy()
+            self._index_rows(changed_labels)
+
+        if len(added):
+            if first_label is None:
+                first_label = self.df.index.max() + 1 if len(self.df) else 0
+            rows = new.loc[added].set_axis(
+                pd.RangeIndex(
+                    first_label, first_label + label_step * len(added), label_step
+                )
+            )
+            for column in self.df.columns.difference(rows.columns):
+                rows[column] = "" if column in STATE_COLUMNS else False
+            self.df = pd.concat([self.df, rows[self.df.columns]])
+            self.name_keys = pd.concat(
+                [self.name_keys, new_name_keys[added].set_axis(rows.index)]
+            )
+            self._index_rows(rows.index)
+
+        counts = {"added": len(added), "changed": len(changed), "removed": len(removed)}
+        for change, n in counts.items():
+            metrics.inc("kiosk_manifest_changes_total", n, change=change)
+        metrics.set_gauge("kiosk_manifest_passengers", len(self))
+        logging.info(f"Applied flight manifest changes {counts}, {len(self)} rows.")
+
+        return counts
+
+    def find_name(self, name: str, flight_number: str = None) -> List[Hashable]:
+        "Index labels of passengers with name, optionally on flight_number only"
+        labels = self._by_name.get(normalize_name(name), [])
+        if flight_number is not None:
+            labels = [
+                label
+                for label in labels
+                if self.df.at[label, "flight_number"] == flight_number
+            ]
+
+        return list(labels)
+
+    def find_name_dob(self, name: str, dob) -> List[Hashable]:
+        "Index labels of passengers with name and date of birth"
+        return list(self._by_name_dob.get((normalize_name(name), to_date(dob)), []))
+
+    def match_name(
+        self, name: str, dob=None, flight_number: str = None, top_k: int = 5
+    ) -> List[NameMatch]:
+        """Passengers with the names closest to name, best first.
+
+        Of passengers with the same score, those born on dob come first.
+        """
+        if self._names is None:
+            self._index_names()
+
+        dob = to_date(dob)
+        matches = [
+            NameMatch(label, key, score, label in self._by_name_dob.get((key, dob), ()))
+            for key, score in self._names.search(normalize_name(name), top_k)
+            for label in self._by_name[key]
+            if flight_number is None
+            or self.df.at[label, "flight_number"] == flight_number
+        ]
+        matches.sort(key=lambda match: (match.score, match.dob_match), reverse=True)
+
+        return matches[:top_k]
+
+    def find_passenger(
+        self, name: str, dob=None, flight_number: str = None
+    ) -> List[Hashable]:
+        """Index labels of the passenger named name, told apart by date of birth.
+
+        Namesakes are narrowed down to those born on dob, if any is. Without
+        exact match and with min_name_score set, the best fuzzy match is
+        taken if it scores at least min_name_score, is born on dob and no
+        other such match scores the same.
+        """
+        labels = self.find_name(name, flight_number)
+        if len(labels) > 1 and dob is not None:
+            born = self._by_name_dob.get((normalize_name(name), to_date(dob)), ())
+            labels = [label for label in labels if label in born] or labels
+        if labels or self.min_name_score is None or dob is None:
+            return labels
+
+        matches = [
+            match
+            for match in self.match_name(name, dob, flight_number)
+            if match.score >= self.min_name_score and match.dob_match
+        ]
+        if not matches:
+            result = "none"
+        elif len(matches) > 1 and matches[1].score == matches[0].score:
+            logging.warning(f"Name {name} matches several passengers: {matches}")
+            result = "ambiguous"
+        else:
+            logging.info(f"Name {name} matched {matches[0]}")
+            result = "match"
+        metrics.inc("kiosk_name_matches_total", result=result)
+
+        return [matches[0].label] if result == "match" else []
+
+    def find_seat(self, flight_number: str, seat: str) -> List[Hashable]:
+        "Index labels of passengers holding seat on flight_number"
+        return list(self._by_seat.get((flight_number, seat), []))
+
+    def record(self, label: Hashable) -> dict:
+        "Manifest row of label as dict"
+        return self.df.loc[label].to_dict()
+
+    def rows(self, labels: List[Hashable]) -> pd.DataFrame:
+        "Manifest rows of labels"
+        return self.df.loc[labels]
+
+
+# store of the DataFrame last passed to as_manifest_store and its index
+_last_store: Tuple[Optional[pd.Index], Optional[ManifestStore]] = (None, None)
+
+
+def as_manifest_store(
+    flight_manifest: Union[pd.DataFrame, ManifestStore],
+) -> ManifestStore:
+    """Returns flight_manifest as ManifestStore, indexing a DataFrame if needed.
+
+    The store of the last DataFrame is reused as long as its index is the
+    same, so callers passing the same DataFrame per passenger index it once.
+    Rows added to it replace the index and it is indexed again.
+    """
+    global _last_store
+    if isinstance(flight_manifest, ManifestStore):
+        return flight_manifest
+
+    index, store = _last_store
+    if store is None or store.df is not flight_manifest or index is not store.df.index:
+        store = ManifestStore(flight_manifest)
+        _last_store = (flight_manifest.index, store)
+
+    return store
+
+
+class ManifestSource:
+    """Flight manifest CSV, parsed once per version of the file.
+
+    A version is identified by size and mtime. With `cache_path` set the
+    parsed frame is pickled with its version and reused by the next start
+    as long as the CSV is unchanged.
+    """
+
+    def __init__(
+        self,
+        filepath: str = "data/raw/flight_manifest.csv",
+        cache_path: str = None,
+        reload_interval: float = 10.0,
+    ):
+        self.filepath = filepath
+        self.cache_path = cache_path
+        self.reload_interval = reload_interval
+        self.version = None
+
+    def current_version(self) -> Tuple[int, int]:
+        stat = os.stat(self.filepath)
+        return stat.st_size, stat.st_mtime_ns
+
+    def changed(self) -> bool:
+        "Whether the file differs from the last loaded version"
+        try:
+            return self.current_version() != self.version
+        except FileNotFoundError:
+            return False
+
+    def load(self) -> pd.DataFrame:
+        "Compact manifest of the current version of the file"
+        version = self.current_version()
+        flight_manifest = self._read_cache(version)
+        if flight_manifest is None:
+            flight_manifest = compact_manifest(pd.read_csv(self.filepath))
+            if self.current_version() != version:
+                raise RuntimeError(f"{self.filepath} changed while it was read")
+            self._write_cache(version, flight_manifest)
+        self.version = version
+
+        return flight_manifest
+
+    def _read_cache(self, version: Tuple[int, int]) -> Optional[pd.DataFrame]:
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, "rb") as f:
+                cached_version, flight_manifest = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            logging.warning(f"Ignore unreadable manifest cache {self.cache_path}: {e}")
+            return None
+
+        return flight_manifest if tuple(cached_version) == version else None
+
+    def _write_cache(self, version: Tuple[int, int], flight_manifest: pd.DataFrame):
+        if not self.cache_path:
+            return
+        directory = os.path.dirname(self.cache_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # write to a temp file and rename so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((version, flight_manifest), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+
+    async def watch(
+        self,
+        store,
+        stop: asyncio.Event,
+        on_load: Callable[[pd.DataFrame], None] = None,
+    ) -> None:
+        """Applies new versions of the file to store until stop is set.
+
+        store is a ManifestStore or a PartitionedManifest.
+        The file is parsed off the loop, changes are applied on the loop
+        thread, where validation updates the store as well. on_load is
+        called with every new version, e.g. for the flights' departures.
+        """
+        loop = asyncio.get_event_loop()
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.reload_interval)
+            except asyncio.TimeoutError:
+                pass
+            if stop.is_set() or not self.changed():
+                continue
+
+            try:
+                flight_manifest = await loop.run_in_executor(None, self.load)
+            except Exception as e:
+                # e.g. a file still being written, retried on the next check
+                logging.warning(f"Could not reload {self.filepath}: {e!r}")
+                continue
+            if on_load is not None:
+                on_load(flight_manifest)
+            counts = store.apply(flight_manifest)
+            # a PartitionedManifest applies the changes in its workers
+            if asyncio.iscoroutine(counts):
+                await counts
+
+
+def get_manifest_source(config: dict) -> ManifestSource:
+    "ManifestSource configured under kiosk.manifest"
+    manifest_config = config["kiosk"]["manifest"]
+
+    return ManifestSource(
+        manifest_config["path"],
+        cache_path=manifest_config.get("cache"),
+        reload_interval=manifest_config["reload_interval"],
+    )
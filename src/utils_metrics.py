@@ -0,0 +1,390 @@
+"""
+Latency instrumentation of the validation pipeline.
+
+Stages are timed with `span`, which records a latency histogram, an
+in-flight gauge and a failure counter per stage. Counters and gauges take
+labels as keyword arguments. Everything lives in one process-wide registry
+and is exported in Prometheus text format, to a file and optionally over
+HTTP, by a MetricsExporter.
+
+Recording takes a lock and a bisect over fixed buckets, a few microseconds
+per span, so stages of remote calls can be timed freely.
+"""
+
+import bisect
+import logging
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+# upper bounds in seconds, from local validation to slow analyze operations
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.15,
+    0.25,
+    0.35,
+    0.5,
+    0.75,
+    1.0,
+    1.5,
+    2.0,
+    2.5,
+    3.5,
+    5.0,
+    7.5,
+    10.0,
+    15.0,
+    30.0,
+    60.0,
+)
+
+HELP = {
+    "kiosk_stage_seconds": ("histogram", "Latency of pipeline stages"),
+    "kiosk_stage_inflight": ("gauge", "Pipeline stages currently running"),
+    "kiosk_stage_failures_total": ("counter", "Pipeline stages that raised"),
+    "kiosk_polls_total": ("counter", "GETs of long-running operations"),
+    "kiosk_retries_total": ("counter", "Remote calls that are retried"),
+    "kiosk_hedges_total": ("counter", "Hedged attempts of slow remote calls"),
+    "kiosk_hedges_skipped_total": ("counter", "Slow calls not hedged, no slot free"),
+    "kiosk_breaker_state": ("gauge", "Circuit state, 0 closed, 1 half open, 2 open"),
+    "kiosk_breaker_rejections_total": ("counter", "Calls rejected by open circuits"),
+    "kiosk_pending_review_total": ("counter", "Checks left for manual review"),
+    "kiosk_passengers_total": ("counter", "Processed passengers by result"),
+    "kiosk_queued_passengers": ("gauge", "Submissions waiting for a worker"),
+    "kiosk_sink_rows_total": ("counter", "Validated rows written by the sink"),
+    "kiosk_inflight_image_bytes": ("gauge", "Reserved input bytes of passengers"),
+    "kiosk_validations_total": ("counter", "Validation checks by outcome"),
+    "kiosk_manifest_passengers": ("gauge", "Passengers in the flight manifest"),
+    "kiosk_manifest_changes_total": ("counter", "Manifest rows changed by reloads"),
+    "kiosk_boardingpass_local_total": ("counter", "Boarding passes read locally"),
+    "kiosk_barcodes_total": ("counter", "Documents by barcode decoding outcome"),
+    "kiosk_name_matches_total": ("counter", "Fuzzy name lookups by outcome"),
+    "kiosk_batches_total": ("counter", "Micro-batches dispatched"),
+    "kiosk_batch_items_total": ("counter", "Items dispatched in micro-batches"),
+    "kiosk_ratelimit_wait_seconds": ("histogram", "Wait for a rate limit token"),
+    "kiosk_throttled_total": ("counter", "HTTP 429 responses by service"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Tuple[str, str] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    "Counts of observations per bucket with sum, min and max"
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimates quantile q by linear interpolation within its bucket,
+        like Prometheus' histogram_quantile, clamped to the observed range."""
+        if self.count == 0:
+            return float("nan")
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            if n and cumulative + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                value = lower + (upper - lower) * (rank - cumulative) / n
+                return min(max(value, self.min), self.max)
+            cumulative += n
+
+        return self.max
+
+
+class Span:
+    "Times one stage, use as context manager"
+
+    __slots__ = ("metrics", "labels", "start")
+
+    def __init__(self, metrics: "Metrics", labels: Labels):
+        self.metrics = metrics
+        self.labels = labels
+
+    def __enter__(self) -> "Span":
+        self.metrics._add("kiosk_stage_inflight", self.labels, 1)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics._finish_span(
+            self.labels, time.perf_counter() - self.start, exc_type is not None
+        )
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and latency histograms.
+
+    Metric names follow the Prometheus conventions, known names are
+    described in HELP.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+    def span(self, stage: str) -> Span:
+        "Context manager timing stage, failures are the exceptions raised in it"
+        return Span(self, (("stage", stage),))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self._add(name, _labels(labels), value)
+
+    def add_gauge(self, name: str, delta: float, **labels) -> None:
+        self._add(name, _labels(labels), delta)
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._values.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._histogram(name, _labels(labels)).observe(value)
+
+    def _add(self, name: str, labels: Labels, value: float) -> None:
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[labels] = values.get(labels, 0) + value
+
+    def _histogram(self, name: str, labels: Labels) -> Histogram:
+        histograms = self._histograms.setdefault(name, {})
+        if labels not in histograms:
+            histograms[labels] = Histogram(self.buckets)
+        return histograms[labels]
+
+    def _finish_span(self, labels: Labels, seconds: float, failed: bool) -> None:
+        with self._lock:
+            inflight = self._values.setdefault("kiosk_stage_inflight", {})
+            inflight[labels] = inflight.get(labels, 0) - 1
+            self._histogram("kiosk_stage_seconds", labels).observe(seconds)
+            if failed:
+                failures = self._values.setdefault("kiosk_stage_failures_total", {})
+                failures[labels] = failures.get(labels, 0) + 1
+
+    def value(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._values.get(name, {}).get(_labels(labels), 0)
+
+    def quantiles(
+        self,
+        name: str = "kiosk_stage_seconds",
+        qs: Tuple[float, ...] = (0.5, 0.95, 0.99),
+    ) -> Dict[str, dict]:
+        "count, mean and quantiles per label set of a histogram, in seconds"
+        with self._lock:
+            histograms = self._histograms.get(name, {})
+            return {
+                ",".join(v for _, v in labels): {
+                    "count": h.count,
+                    "mean": round(h.sum / h.count, 4),
+                    **{f"p{round(q * 100)}": round(h.quantile(q), 4) for q in qs},
+                }
+                for labels, h in sorted(histograms.items())
+                if h.count
+            }
+
+    def render(self) -> str:
+        "All metrics in Prometheus text exposition format"
+        lines: List[str] = []
+        with self._lock:
+            for name in sorted(set(self._values) | set(self._histograms)):
+                kind, description = HELP.get(name, ("untyped", name))
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+                for labels, value in sorted(self._values.get(name, {}).items()):
+                    lines.append(
+                        f"{name}{_format_labels(labels)} {_format_value(value)}"
+                    )
+                for labels, h in sorted(self._histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for bound, n in zip(self.buckets + ("+Inf",), h.counts):
+                        cumulative += n
+                        le = ("le", str(bound))
+                        lines.append(
+                            f"{name}_bucket{_format_labels(labels, le)} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{_format_labels(labels)} {h.sum!r}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def take_counters(self) -> Dict[str, Dict[Labels, float]]:
+        "Removes and returns all counters, to be merged into another registry"
+        with self._lock:
+            counters = {
+                name: self._values.pop(name)
+                for name in list(self._values)
+                if name.endswith("_total")
+            }
+        return counters
+
+    def merge_counters(self, counters: Dict[str, Dict[Labels, float]]) -> None:
+        "Adds counters taken from another registry, e.g. of a worker process"
+        for name, values in counters.items():
+            for labels, value in values.items():
+                self._add(name, labels, value)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+
+# process-wide registry used by all pipeline stages
+metrics = Metrics()
+
+
+class MetricsExporter:
+    """Writes the registry to a Prometheus text file every `interval` seconds.
+
+    The file is replaced atomically, so it can be read by the node exporter's
+    textfile collector. If `port` is set, the same text is served on
+    http://`host`:`port`/metrics.
+    """
+
+    def __init__(
+        self,
+        registry: Metrics = metrics,
+        path: str = None,
+        interval: float = 15.0,
+        port: int = None,
+        host: str = "127.0.0.1",
+    ):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if port is not None:
+            self._server = ThreadingHTTPServer((host, port), self._handler())
+            self._server.daemon_threads = True
+
+    def __enter__(self) -> "MetricsExporter":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _handler(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MetricsExporter":
+        if self._server is not None:
+            threading.Thread(
+                target=self._server.serve_forever, name="MetricsServer", daemon=True
+            ).start()
+            logging.info(
+                f"Serving metrics on http://{self._server.server_address[0]}:"
+                f"{self._server.server_address[1]}/metrics"
+            )
+        if self.path:
+            self._thread = threading.Thread(
+                target=self._run, name="MetricsExporter", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def write(self) -> None:
+        "Writes the current metrics to path"
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(self.registry.render())
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.warning(f"Could not write metrics to {self.path}: {e}")
+
+    def close(self) -> None:
+        "Writes the final metrics and stops exporting"
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.path:
+            try:
+                self.write()
+            except OSError as e:
+                logging.warning(f"Could not write metrics to {self.path}: {e}")
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def get_metrics_exporter(config: dict) -> MetricsExporter:
+    "Creates the exporter configured under kiosk.metrics in config.yaml"
+    metrics_config = config["kiosk"]["metrics"]
+
+    return MetricsExporter(
+        path=metrics_config.get("path"),
+        interval=metrics_config["interval"],
+        port=metrics_config.get("port"),
+    )
@@ -0,0 +1,240 @@
+"""
+Fuzzy name index over the names of the flight manifest.
+
+OCR drops or swaps letters, IDs print diacritics the manifest leaves out and
+list middle names the booking does not. The index maps the distinct name
+tokens of the manifest to their trigrams and Soundex code, so a name without
+exact match is compared only with the names sharing similar tokens. Tokens
+are compared by the Dice coefficient of their trigrams, a name by the mean
+of its best token matches, so word order and extra names cost little.
+"""
+
+import math
+import re
+import unicodedata
+from collections import Counter
+from collections import defaultdict
+from functools import lru_cache
+from itertools import chain
+from itertools import combinations
+from typing import Dict, FrozenSet, Hashable, List, NamedTuple, Set, Tuple
+
+# tokens below are not taken as similar when drawing candidates
+TOKEN_MIN_SCORE = 0.3
+# similar tokens per token of a name the candidates are drawn from
+MAX_SIMILAR = 8
+# names compared when no candidate shares two similar tokens
+MAX_FALLBACK = 256
+# share of the trigram difference made up by the same Soundex code, so that
+# Meyer and Maier are similar but OCR errors are not taken for sounds
+PHONETIC_WEIGHT = 0.25
+# per token one name has more than the other, e.g. a middle name
+EXTRA_TOKEN_PENALTY = 0.95
+SOUNDEX_CODES = {
+    **dict.fromkeys("bfpv", "1"),
+    **dict.fromkeys("cgjkqsxz", "2"),
+    **dict.fromkeys("dt", "3"),
+    "l": "4",
+    **dict.fromkeys("mn", "5"),
+    "r": "6",
+}
+
+
+class NameMatch(NamedTuple):
+    "Manifest row of a fuzzy name match with its normalized name"
+
+    label: Hashable
+    name_key: str
+    score: float
+    dob_match: bool
+
+
+@lru_cache(maxsize=65536)
+def name_tokens(name_key: str) -> Tuple[str, ...]:
+    "Tokens of a normalized name without diacritics and punctuation"
+    decomposed = unicodedata.normalize("NFKD", name_key)
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c))
+    # Smith-Jones and Smith Jones are the same name, O'Brien and OBrien too
+    return tuple(re.sub(r"[^\w\s]", "", folded.replace("-", " ")).split())
+
+
+def soundex(token: str) -> str:
+    "American Soundex code of a token, empty if it has no letters"
+    letters = [c for c in token if "a" <= c <= "z"]
+    if not letters:
+        return ""
+
+    code, last = letters[0], SOUNDEX_CODES.get(letters[0], "")
+    for c in letters[1:]:
+        digit = SOUNDEX_CODES.get(c, "")
+        if digit and digit != last:
+            code += digit
+        # h and w do not separate letters of the same code, vowels do
+        if c not in "hw":
+            last = digit
+
+    return (code + "000")[:4]
+
+
+def trigrams(token: str) -> FrozenSet[str]:
+    "Trigrams of a token padded at both ends"
+    padded = f"  {token} "
+    return frozenset(padded[i : i + 3] for i in range(len(padded) - 2))
+
+
+def pair_key(a: str, b: str) -> Tuple[str, str]:
+    return (a, b) if a <= b else (b, a)
+
+
+def token_pairs(tokens: Tuple[str, ...]) -> Set[Tuple[str, str]]:
+    return {pair_key(a, b) for a, b in combinations(tokens, 2)}
+
+
+def discard(index: Dict[Hashable, set], index_key: Hashable, value) -> None:
+    "Removes value from the set of index_key, and the key once it is empty"
+    values = index.get(index_key)
+    if values is not None:
+        values.discard(value)
+        if not values:
+            del index[index_key]
+
+
+class NameIndex:
+    """Trigram and Soundex index over normalized names.
+
+    Names are added and removed by their normalize_name key. Lookups return
+    keys with a score in [0, 1], 1 for the same tokens in any order.
+    """
+
+    def __init__(self):
+        self._keys_by_token: Dict[str, Set[str]] = defaultdict(set)
+        # unordered token pairs, first and last name of most names
+        self._keys_by_pair: Dict[Tuple[str, str], Set[str]] = defaultdict(set)
+        self._tokens_by_gram: Dict[str, Set[str]] = defaultdict(set)
+        self._tokens_by_code: Dict[str, Set[str]] = defaultdict(set)
+        self._grams: Dict[str, FrozenSet[str]] = {}
+        # similar tokens of indexed tokens, valid until tokens change
+        self._similar: Dict[str, Dict[str, float]] = {}
+
+    def __len__(self) -> int:
+        "Number of distinct tokens"
+        return len(self._grams)
+
+    def add(self, name_key: str) -> None:
+        tokens = name_tokens(name_key)
+        for token in tokens:
+            if token not in self._grams:
+                self._similar.clear()
+                self._grams[token] = trigrams(token)
+                for gram in self._grams[token]:
+                    self._tokens_by_gram[gram].add(token)
+                self._tokens_by_code[soundex(token)].add(token)
+            self._keys_by_token[token].add(name_key)
+        for pair in token_pairs(tokens):
+            self._keys_by_pair[pair].add(name_key)
+
+    def remove(self, name_key: str) -> None:
+        tokens = name_tokens(name_key)
+        for pair in token_pairs(tokens):
+            discard(self._keys_by_pair, pair, name_key)
+        for token in tokens:
+            discard(self._keys_by_token, token, name_key)
+            if token in self._keys_by_token or token not in self._grams:
+                continue
+            # last name with the token
+            self._similar.clear()
+            for gram in self._grams.pop(token):
+                discard(self._tokens_by_gram, gram, token)
+            discard(self._tokens_by_code, soundex(token), token)
+
+    def similar_tokens(self, token: str) -> Dict[str, float]:
+        "Indexed tokens scoring at least TOKEN_MIN_SCORE against token"
+        if token in self._similar:
+            return self._similar[token]
+
+        grams = trigrams(token)
+        phonetic = self._tokens_by_code.get(soundex(token), ())
+        # shared trigrams, tokens of one letter have the fewest, two
+        shared = Counter(chain(*(self._tokens_by_gram.get(g, ()) for g in grams)))
+        min_shared = max(1, math.ceil(TOKEN_MIN_SCORE * (len(grams) + 2) / 2))
+        similar = {}
+        for candidate, n in shared.items():
+            if n < min_shared:
+                continue
+            score = 2 * n / (len(grams) + len(self._grams[candidate]))
+            if candidate in phonetic:
+                score += (1 - score) * PHONETIC_WEIGHT
+            if score >= TOKEN_MIN_SCORE:
+                similar[candidate] = score
+        # most names read have some tokens right, misread tokens are not kept
+        if token in self._grams:
+            self._similar[token] = similar
+
+        return similar
+
+    def split_token(self, token: str) -> Tuple[str, ...]:
+        """Two indexed tokens token is made of, with the space between them
+        lost or read as another character, else token alone"""
+        if token in self._grams:
+            return (token,)
+        for i in range(2, len(token) - 1):
+            for rest in [token[i:], token[i + 1 :]]:
+                if token[:i] in self._grams and rest in self._grams:
+                    return token[:i], rest
+
+        return (token,)
+
+    def search(self, name_key: str, top_k: int = 5) -> List[Tuple[str, float]]:
+        """Indexed names closest to name_key with their scores, best first.
+
+        Candidates hold similar tokens for two tokens of name_key. Up to
+        MAX_FALLBACK names holding one similar token are added, rarest
+        tokens first, for names of one token or a token without match.
+        """
+        tokens = tuple(
+            t for token in name_tokens(name_key) for t in self.split_token(token)
+        )
+        similar = [self.similar_tokens(token) for token in tokens]
+        closest = [
+            sorted(tokens_similar, key=tokens_similar.get, reverse=True)[:MAX_SIMILAR]
+            for tokens_similar in similar
+        ]
+        candidates = set()
+        for i, j in combinations(range(len(tokens)), 2):
+            for a in closest[i]:
+                for b in closest[j]:
+                    candidates.update(self._keys_by_pair.get(pair_key(a, b), ()))
+        # rarest tokens first, common first names may have thousands of names
+        fallback = sorted(
+            {t for tokens_closest in closest for t in tokens_closest},
+            key=lambda t: len(self._keys_by_token[t]),
+        )
+        for token in fallback if not candidates else []:
+            if len(candidates) >= MAX_FALLBACK:
+                break
+            candidates.update(self._keys_by_token[token])
+
+        scored = [(key, self.score(tokens, similar, key)) for key in candidates]
+        scored.sort(key=lambda item: (-item[1], item[0]))
+
+        return scored[:top_k]
+
+    def score(
+        self, tokens: Tuple[str, ...], similar: List[Dict[str, float]], key: str
+    ) -> float:
+        "Mean best token score over the shorter name, less the extra tokens"
+        key_tokens = name_tokens(key)
+        if not tokens or not key_tokens:
+            return 0.0
+
+        scores = [
+            [tokens_similar.get(t, 0.0) for t in key_tokens]
+            for tokens_similar in similar
+        ]
+        if len(tokens) <= len(key_tokens):
+            best = [max(row) for row in scores]
+        else:
+            best = [max(column) for column in zip(*scores)]
+        penalty = EXTRA_TOKEN_PENALTY ** abs(len(tokens) - len(key_tokens))
+
+        return round(sum(best) / len(best) * penalty, 4)
@@ -0,0 +1,281 @@
+"""
+Flight manifest partitioned by flight across worker processes.
+
+Each partition is a single worker process that owns the manifest rows of
+its flights, including their validation flags, and validates passengers
+one after the other. A router in the kiosk process sends every passenger
+to the partition of its flight, so partitions validate in parallel and no
+DataFrame is shared between them.
+
+The flight of a passenger is the one on the boarding pass if it is in
+the manifest, otherwise the flight the name is booked on. Names not booked
+are matched fuzzily on the flight of the boarding pass.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Union
+
+import pandas as pd
+
+from src.utils_manifest import ManifestStore
+from src.utils_manifest import normalize_name
+from src.utils_manifest import normalize_names
+from src.utils_metrics import metrics
+from src.utils_sink import ResultSink
+from src.utils_validate import pending_checks
+from src.utils_validate import passenger_name
+from src.utils_validate import pipeline_validate
+from src.utils_validate import review_unidentified
+
+# manifest slice of the worker process
+_store: ManifestStore = None
+
+
+def partition_of(flight_number: str, n_partitions: int) -> int:
+    "Partition of flight_number, stable across processes and restarts"
+    return zlib.crc32(str(flight_number).encode()) % n_partitions
+
+
+def _init_partition(
+    flight_manifest: pd.DataFrame, log_level: int, min_name_score: float
+) -> None:
+    global _store
+    # spawned workers do not inherit the level set in the kiosk process
+    logging.basicConfig(format="%(asctime)s - %(processName)s - %(message)s")
+    logging.getLogger().setLevel(log_level)
+    _store = ManifestStore(flight_manifest, min_name_score=min_name_score)
+
+
+def _validate(dict_id, dict_boardingpass, dict_face, dict_lighter, flight_number):
+    "Runs in a worker: validated rows and the counters of the validation"
+    rows = pipeline_validate(
+        _store,
+        dict_id,
+        dict_boardingpass,
+        dict_face,
+        dict_lighter,
+        flight_number=flight_number,
+    )
+    return rows, metrics.take_counters()
+
+
+def _apply(flight_manifest: pd.DataFrame, first_label: int, label_step: int):
+    "Runs in a worker: changes applied to its slice and their counters"
+    counts = _store.apply(flight_manifest, first_label, label_step)
+    return counts, metrics.take_counters()
+
+
+def _rows() -> pd.DataFrame:
+    "Runs in a worker: its manifest slice"
+    return _store.df
+
+
+def _portable(result):
+    "Drops SDK objects of a detection result that validation does not read"
+    if isinstance(result, dict) and "result_object" in result:
+        return {k: v for k, v in result.items() if k != "result_object"}
+    return result
+
+
+class PartitionedManifest:
+    """Router over `n_partitions` worker processes owning a manifest slice each.
+
+    Validation and manifest reloads of one partition run in its worker in
+    the order they are submitted.
+    """
+
+    def __init__(
+        self,
+        flight_manifest: pd.DataFrame,
+        n_partitions: int = 2,
+        min_name_score: float = None,
+    ):
+        self.n_partitions = max(1, n_partitions)
+        self.min_name_score = min_name_score
+        # added passengers are labeled in turn by the partitions
+        self._next_label = int(flight_manifest.index.max()) + 1
+        self._flights_by_name = self._index_flights(flight_manifest)
+        self._flight_numbers = set(flight_manifest["flight_number"])
+        # spawn, the kiosk process runs threads that must not be forked
+        context = multiprocessing.get_context("spawn")
+        partitions = self._partitions(flight_manifest)
+        self._pools = [
+            ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=context,
+                initializer=_init_partition,
+                initargs=(
+                    flight_manifest[partitions == i],
+                    logging.getLogger().getEffectiveLevel(),
+                    min_name_score,
+                ),
+            )
+            for i in range(self.n_partitions)
+        ]
+        logging.info(
+            f"Partitioned flight manifest with {len(flight_manifest)} passengers "
+            f"over {self.n_partitions} workers."
+        )
+
+    def __enter__(self) -> "PartitionedManifest":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        for pool in self._pools:
+            pool.shutdown()
+
+    def _partitions(self, flight_manifest: pd.DataFrame) -> pd.Series:
+        "Partition per manifest row"
+        return (
+            flight_manifest["flight_number"]
+            .map(lambda f: partition_of(f, self.n_partitions))
+            .astype(int)
+        )
+
+    @staticmethod
+    def _index_flights(flight_manifest: pd.DataFrame) -> Dict[str, List[str]]:
+        flights_by_name = defaultdict(list)
+        for key, flight_number in zip(
+            normalize_names(flight_manifest["name"]), flight_manifest["flight_number"]
+        ):
+            if flight_number not in flights_by_name[key]:
+                flights_by_name[key].append(flight_number)
+        return dict(flights_by_name)
+
+    def flight_of(self, dict_id, dict_boardingpass) -> Optional[str]:
+        "Flight the passenger is validated on, None if the name is not booked"
+        flights = self._flights_by_name.get(
+            normalize_name(passenger_name(dict_id, dict_boardingpass)), []
+        )
+        if isinstance(dict_boardingpass, dict):
+            flight_number = (
+                f"{dict_boardingpass.get('airline')}-"
+                f"{dict_boardingpass.get('flight_number')}"
+            )
+            if flight_number in flights:
+                return flight_number
+            # a misread name is matched fuzzily in the partition of the flight
+            if (
+                not flights
+                and self.min_name_score is not None
+                and flight_number in self._flight_numbers
+            ):
+                return flight_number
+
+        return flights[0] if flights else None
+
+    async def validate(
+        self,
+        dict_id: dict,
+        dict_boardingpass: dict,
+        dict_face: dict,
+        dict_lighter: dict,
+        sink: ResultSink = None,
+        passenger_key: str = None,
+    ) -> Optional[pd.DataFrame]:
+        "pipeline_validate in the worker owning the passenger's flight"
+        if not isinstance(dict_id, dict) and not isinstance(dict_boardingpass, dict):
+            return review_unidentified(
+                passenger_key,
+                pending_checks(dict_id, dict_boardingpass, dict_face, dict_lighter),
+                dict_face,
+                dict_lighter,
+                sink=sink,
+            )
+
+        name = passenger_name(dict_id, dict_boardingpass)
+        flight_number = self.flight_of(dict_id, dict_boardingpass)
+        if flight_number is None:
+            logging.error(f"{name} not found in manifest.")
+            metrics.inc("kiosk_validations_total", check="manifest", valid=False)
+            return None
+
+        loop = asyncio.get_running_loop()
+        with metrics.span("validate_partition"):
+            passenger_manifest, counters = await loop.run_in_executor(
+                self._pools[partition_of(flight_number, self.n_partitions)],
+                _validate,
+                _portable(dict_id),
+                _portable(dict_boardingpass),
+                _portable(dict_face),
+                _portable(dict_lighter),
+                flight_number,
+            )
+        metrics.merge_counters(counters)
+
+        if sink is not None and passenger_manifest is not None:
+            sink.write(passenger_manifest)
+            logging.info(f"Queued validated manifest for {name}")
+
+        return passenger_manifest
+
+    async def apply(self, flight_manifest: pd.DataFrame) -> Dict[str, int]:
+        "Applies a new version of the manifest, each partition to its slice"
+        partitions = self._partitions(flight_manifest)
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    pool,
+                    _apply,
+                    flight_manifest[partitions == i],
+                    self._next_label + i,
+                    self.n_partitions,
+                )
+                for i, pool in enumerate(self._pools)
+            ]
+        )
+        self._flights_by_name = self._index_flights(flight_manifest)
+        self._flight_numbers = set(flight_manifest["flight_number"])
+
+        self._next_label += self.n_partitions * max(r["added"] for r, _ in results)
+        for _, counters in results:
+            metrics.merge_counters(counters)
+        counts = {
+            change: sum(r[change] for r, _ in results) for change in results[0][0]
+        }
+        metrics.set_gauge("kiosk_manifest_passengers", len(flight_manifest))
+        logging.info(f"Applied flight manifest changes {counts} to all partitions.")
+
+        return counts
+
+    async def rows(self) -> pd.DataFrame:
+        "Manifest with the validation flags of all partitions"
+        loop = asyncio.get_running_loop()
+        return pd.concat(
+            await asyncio.gather(
+                *[loop.run_in_executor(pool, _rows) for pool in self._pools]
+            )
+        )
+
+
+# the manifest the pipeline validates against
+Manifest = Union[ManifestStore, PartitionedManifest]
+
+
+def get_manifest(config: dict, flight_manifest: pd.DataFrame) -> Manifest:
+    "Partitioned manifest with the workers of kiosk.partitions, in-process if 0"
+    workers = config["kiosk"]["partitions"]["workers"]
+    min_name_score = config["kiosk"]["names"]["min_score"]
+    # one partition validates serially like the store, plus the IPC round trip
+    if workers == 1 or (workers and (os.cpu_count() or 1) == 1):
+        logging.info(
+            f"Validating in the kiosk process, {workers} partitions "
+            f"on {os.cpu_count()} cores would be slower."
+        )
+        workers = 0
+    if not workers:
+        return ManifestStore(flight_manifest, min_name_score=min_name_score)
+
+    return PartitionedManifest(
+        flight_manifest, n_partitions=workers, min_name_score=min_name_score
+    )
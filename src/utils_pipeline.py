@@ -0,0 +1,415 @@
+"""
+Concurrent passenger pipeline.
+
+The four checks of one passenger (ID, boarding pass, face, lighter) are
+independent remote calls and run at the same time. Several passengers are
+kept in flight at once, bounded by a concurrency limit.
+"""
+
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator, List
+
+import pandas as pd
+
+from src.utils_data import load_img
+from src.utils_data import get_id_details
+from src.utils_data import get_boardingpass_async
+from src.utils_data import compare_faces
+from src.utils_partition import Manifest
+from src.utils_partition import PartitionedManifest
+from src.utils_barcode import BarcodeDecoder
+from src.utils_boardingpass import BoardingPassReader
+from src.utils_cache import ResultCache
+from src.utils_http import HttpClient
+from src.utils_image import ImageCache
+from src.utils_image import MemoryBudget
+from src.utils_image import files_size
+from src.utils_image import rss_bytes
+from src.utils_preprocess import Preprocessor
+from src.utils_ratelimit import DEADLINE
+from src.utils_ratelimit import Deadline
+from src.utils_ratelimit import RateLimiter
+from src.utils_resilience import Resilience
+from src.utils_face import FaceRegistry
+from src.utils_face import iterate_in_thread
+from src.utils_face import verify_frames
+from src.utils_sink import ResultSink
+from src.utils_lighterdetection import LighterDetector
+from src.utils_lighterdetection import pipeline_prediction_lighterdetection
+from src.utils_metrics import metrics
+from src.utils_validate import pipeline_validate
+from src.utils_validate import message_to_passenger
+
+# blocking remote calls per passenger that run concurrently
+N_CHECKS = 4
+
+
+@dataclass
+class KioskClients:
+    "Authenticated clients and model identifiers shared by all passengers"
+
+    form_recognizer_client: object
+    face_client: object
+    lighter_detector: LighterDetector
+    form_recognizer_key: str
+    form_recognizer_endpoint: str
+    form_recognizer_model_id: str
+    cache: ResultCache = None
+    face_registry: FaceRegistry = None
+    http: HttpClient = None
+    images: ImageCache = None
+    memory: MemoryBudget = None
+    preprocessor: Preprocessor = None
+    resilience: Resilience = None
+    boardingpass_reader: BoardingPassReader = None
+    barcodes: BarcodeDecoder = None
+    rate_limiter: RateLimiter = None
+
+
+def use_executor(concurrency: int, resilience: Resilience = None) -> None:
+    """Sizes the default executor of the running loop for concurrency
+    passengers and the hedged attempts of resilience"""
+    max_hedges = 0 if resilience is None else resilience.max_hedges
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max(1, concurrency) * N_CHECKS + max_hedges)
+    )
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """Runs blocking func in the default executor of the running loop, in
+    the context of the caller, e.g. its passenger's deadline"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None,
+        contextvars.copy_context().run,
+        functools.partial(func, *args, **kwargs),
+    )
+
+
+async def guarded(clients: KioskClients, check: str, make_call):
+    """Awaits make_call() in a span of check, including the wait for a thread.
+
+    With resilience set the call runs under the check's policy and returns
+    PendingReview instead of raising in degraded mode.
+    """
+    with metrics.span(check):
+        if clients.resilience is None:
+            return await make_call()
+        return await clients.resilience.call(check, make_call)
+
+
+async def compare_face(clients: KioskClients, img_id: bytes, frames) -> dict:
+    "Verifies video thumbnails against the ID face, stops at the first match"
+    if clients.face_registry is not None:
+        return await verify_frames(clients.face_registry, img_id, frames)
+
+    # without registry only the first thumbnail is compared
+    async for img_thumb in frames:
+        return await run_in_thread(
+            compare_faces,
+            clients.face_client,
+            img_reference=img_id,
+            img_compare=img_thumb,
+            cache=clients.cache,
+        )
+
+
+async def read_barcode(
+    clients: KioskClients, document: str, filepath: str = None
+) -> dict:
+    "Fields of the document's barcode, None without decoder, filepath or barcode"
+    if clients.barcodes is None or filepath is None:
+        return None
+
+    with metrics.span(f"barcode_{document}"):
+        return await clients.barcodes.decode(document, filepath)
+
+
+async def read_id(clients: KioskClients, img_id: bytes, filepath: str = None) -> dict:
+    "ID details from the card's barcode, from Form Recognizer otherwise"
+    dict_id = await read_barcode(clients, "id", filepath)
+    if dict_id is not None:
+        return dict_id
+
+    return await guarded(
+        clients,
+        "id_ocr",
+        lambda: run_in_thread(
+            get_id_details,
+            clients.form_recognizer_client,
+            img_id,
+            cache=clients.cache,
+        ),
+    )
+
+
+def set_departure(clients: KioskClients, dict_boardingpass: dict) -> None:
+    "Serves the passenger's remote calls by the departure of its flight"
+    if clients.rate_limiter is not None:
+        clients.rate_limiter.set_departure(dict_boardingpass)
+
+
+async def read_boardingpass_local(
+    clients: KioskClients, img_boarding: bytes, filepath: str = None
+) -> dict:
+    "Boarding pass fields from the PDF text layer or the barcode, None otherwise"
+    if clients.boardingpass_reader is not None:
+        with metrics.span("boardingpass_local"):
+            dict_boardingpass = await run_in_thread(
+                clients.boardingpass_reader.read, img_boarding
+            )
+        if dict_boardingpass is not None:
+            return dict_boardingpass
+
+    return await read_barcode(clients, "boardingpass", filepath)
+
+
+async def read_boardingpass(
+    clients: KioskClients, img_boarding: bytes, filepath: str = None
+) -> dict:
+    """Boarding pass fields from the PDF text layer or the barcode, from the
+    custom model otherwise. The passenger's remote calls are served by the
+    departure of its flight once it is read."""
+    dict_boardingpass = None
+    try:
+        dict_boardingpass = await read_boardingpass_local(
+            clients, img_boarding, filepath
+        )
+    finally:
+        # calls waiting for the local read go on, also if it failed
+        set_departure(clients, dict_boardingpass)
+    if dict_boardingpass is not None:
+        return dict_boardingpass
+
+    dict_boardingpass = await guarded(
+        clients,
+        "boardingpass",
+        lambda: get_boardingpass_async(
+            img_boarding,
+            apikey=clients.form_recognizer_key,
+            endpoint=clients.form_recognizer_endpoint,
+            model_id=clients.form_recognizer_model_id,
+            cache=clients.cache,
+            http=clients.http,
+            limiter=clients.rate_limiter,
+        ),
+    )
+    set_departure(clients, dict_boardingpass)
+
+    return dict_boardingpass
+
+
+async def run_checks(
+    clients: KioskClients,
+    img_boarding: bytes,
+    img_id: bytes,
+    img_lighter: bytes,
+    frames: AsyncIterator[bytes],
+    img_face: bytes = None,
+    passenger: dict = None,
+) -> tuple:
+    """Runs ID, boarding pass, face and lighter check of one passenger concurrently.
+
+    img_face is the ID image used for face comparison, img_id if not given.
+    Barcodes are decoded from the files of passenger if given.
+    """
+    passenger = passenger or {}
+    return await asyncio.gather(
+        read_id(clients, img_id, passenger.get("id")),
+        read_boardingpass(clients, img_boarding, passenger.get("boarding")),
+        # frames are consumed once, so face verification is never hedged
+        guarded(
+            clients,
+            "face_verify",
+            lambda: compare_face(
+                clients, img_face if img_face is not None else img_id, frames
+            ),
+        ),
+        guarded(
+            clients,
+            "lighter",
+            lambda: run_in_thread(
+                pipeline_prediction_lighterdetection,
+                clients.lighter_detector,
+                img_lighter,
+            ),
+        ),
+    )
+
+
+async def process_passenger(
+    clients: KioskClients,
+    flight_manifest: Manifest,
+    passenger: dict,
+    sink: ResultSink = None,
+) -> pd.DataFrame:
+    """Runs all checks for one passenger and validates against the manifest.
+
+    passenger holds the filepaths under the keys 'boarding', 'id',
+    'lighter' and a list of video thumbnails under 'thumbs'. Waits for the
+    memory budget of its input files if one is set.
+    """
+    # its checks and their threads copy the context with the deadline
+    DEADLINE.set(Deadline(pending=clients.rate_limiter is not None))
+    with metrics.span("passenger"):
+        if clients.memory is None:
+            return await check_passenger(clients, flight_manifest, passenger, sink)
+
+        n_bytes = files_size([passenger[key] for key in ["boarding", "id", "lighter"]])
+        async with clients.memory.reserve(n_bytes):
+            return await check_passenger(clients, flight_manifest, passenger, sink)
+
+
+async def check_passenger(
+    clients: KioskClients,
+    flight_manifest: Manifest,
+    passenger: dict,
+    sink: ResultSink = None,
+) -> pd.DataFrame:
+    # images are memory-mapped, read once per passenger, only the thumbnails
+    # that are reused across passengers go through the image cache
+    load_thumb = load_img if clients.images is None else clients.images.load
+    with metrics.span("load"):
+        img_boarding, img_id, img_lighter = [
+            await run_in_thread(load_img, passenger[key])
+            for key in ["boarding", "id", "lighter"]
+        ]
+    img_face = img_id
+
+    if clients.preprocessor is None:
+        # thumbnails are loaded as they are needed
+        frames = iterate_in_thread(load_thumb(p) for p in passenger["thumbs"])
+    else:
+        with metrics.span("preprocess"):
+            img_id, img_face, img_lighter = await asyncio.gather(
+                clients.preprocessor.preprocess("id", passenger["id"], img_id),
+                clients.preprocessor.preprocess("face", passenger["id"], img_id),
+                clients.preprocessor.preprocess(
+                    "lighter", passenger["lighter"], img_lighter
+                ),
+            )
+        frames = preprocessed_frames(clients.preprocessor, passenger["thumbs"])
+
+    # identifies the passenger for manual review if no document can be read
+    passenger_key = passenger.get("passenger_id", passenger["id"])
+    dict_id, dict_boardingpass, dict_face, dict_lighter = await run_checks(
+        clients,
+        img_boarding,
+        img_id,
+        img_lighter,
+        frames,
+        img_face=img_face,
+        passenger=passenger,
+    )
+
+    if isinstance(flight_manifest, PartitionedManifest):
+        passenger_manifest = await flight_manifest.validate(
+            dict_id,
+            dict_boardingpass,
+            dict_face,
+            dict_lighter,
+            sink=sink,
+            passenger_key=passenger_key,
+        )
+    else:
+        # validation mutates the shared manifest and runs on the loop thread only
+        passenger_manifest = pipeline_validate(
+            flight_manifest,
+            dict_id,
+            dict_boardingpass,
+            dict_face,
+            dict_lighter,
+            sink=sink,
+            passenger_key=passenger_key,
+        )
+
+    if passenger_manifest is not None:
+        message_to_passenger(passenger_manifest)
+
+    return passenger_manifest
+
+
+async def preprocessed_frames(
+    preprocessor: Preprocessor, filepaths: List[str]
+) -> AsyncIterator[bytes]:
+    "Video thumbnails prepared for face verification, one at a time"
+    for filepath in filepaths:
+        yield await preprocessor.preprocess("face", filepath, shared=True)
+
+
+def log_stats(clients: KioskClients) -> None:
+    """Logs RSS, peak image bytes in flight, preprocessing, local reads, batch
+    sizes and latencies"""
+    message = f"RSS {rss_bytes() / 1024**2:.1f} MB"
+    if clients.memory is not None:
+        message += f", peak in-flight images {clients.memory.peak / 1024**2:.1f} MB"
+    if clients.images is not None:
+        message += f", image cache {clients.images.counters}"
+    logging.info(message)
+    if clients.preprocessor is not None:
+        logging.info(f"Image preprocessing: {clients.preprocessor.stats()}")
+    stages = metrics.quantiles()
+    remote = {
+        document: stages.get(stage, {}).get("mean")
+        for document, stage in [("id", "id_ocr"), ("boardingpass", "boardingpass")]
+    }
+    if clients.boardingpass_reader is not None:
+        logging.info(
+            "Local boarding passes: "
+            f"{clients.boardingpass_reader.stats(remote['boardingpass'])}"
+        )
+    if clients.barcodes is not None:
+        logging.info(f"Barcodes: {clients.barcodes.stats(remote)}")
+    for component in [clients.lighter_detector, clients.face_registry]:
+        batcher = getattr(component, "batcher", None)
+        if batcher is not None:
+            logging.info(f"Micro-batches of {batcher.name}: {batcher.stats()}")
+    if clients.rate_limiter is not None:
+        logging.info(
+            "Rate limiter waits in seconds: "
+            f"{metrics.quantiles('kiosk_ratelimit_wait_seconds')}"
+        )
+    logging.info(f"Stage latencies in seconds: {stages}")
+
+
+async def run_passengers(
+    clients: KioskClients,
+    flight_manifest: Manifest,
+    passengers: List[dict],
+    concurrency: int = 4,
+    sink: ResultSink = None,
+) -> list:
+    """Processes passengers with at most `concurrency` of them in flight.
+
+    A failing passenger is logged and returned as its exception,
+    it does not stop the others.
+    """
+    use_executor(concurrency, clients.resilience)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def bounded(passenger: dict):
+        async with semaphore:
+            return await process_passenger(
+                clients, flight_manifest, passenger, sink=sink
+            )
+
+    results = await asyncio.gather(
+        *[bounded(p) for p in passengers], return_exceptions=True
+    )
+    log_stats(clients)
+
+    for passenger, result in zip(passengers, results):
+        if isinstance(result, Exception):
+            logging.error(f"Passenger {passenger} failed: {result!r}")
+            metrics.inc("kiosk_passengers_total", result="failed")
+        elif result is None:
+            metrics.inc("kiosk_passengers_total", result="not_found")
+        else:
+            metrics.inc("kiosk_passengers_total", result="processed")
+
+    return results
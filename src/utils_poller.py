@@ -0,0 +1,158 @@
+"""
+Adaptive poller for long-running operations.
+
+Polls until an operation is done, honouring Retry-After hints and otherwise
+backing off exponentially with jitter, bounded by an overall deadline.
+The async variant waits without blocking the event loop so many
+operation-locations can be polled from one loop.
+"""
+
+import asyncio
+import contextvars
+import functools
+import itertools
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime
+from datetime import timezone
+from typing import Callable, Iterator, List, Optional, Tuple
+from src.utils_metrics import metrics
+
+
+class OperationTimeout(TimeoutError):
+    "Operation did not complete within its deadline"
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    "Returns Retry-After header (delta-seconds or HTTP date) in seconds or None"
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logging.warning(f"Cannot parse Retry-After header: {value}")
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delays(
+    initial_delay: float = 0.25,
+    max_delay: float = 4.0,
+    multiplier: float = 2.0,
+    jitter: float = 0.5,
+) -> Iterator[float]:
+    """Yields exponentially growing delays capped at max_delay.
+
+    Each delay is reduced by a random share of up to `jitter` so that
+    concurrent pollers do not hit the endpoint in lockstep.
+    """
+    delay = initial_delay
+    while True:
+        yield delay * (1 - jitter * random.random())
+        delay = min(delay * multiplier, max_delay)
+
+
+def _next_wait(
+    retry_after: Optional[float], delays: Iterator[float], deadline_at: float
+) -> float:
+    "Returns seconds to wait before the next poll, raises if past deadline"
+    remaining = deadline_at - time.monotonic()
+    if remaining <= 0:
+        raise OperationTimeout("Deadline exceeded while polling operation")
+    wait = retry_after if retry_after is not None else next(delays)
+
+    return min(wait, remaining)
+
+
+def poll(
+    fetch: Callable[[], Tuple[object, Optional[float]]],
+    is_done: Callable[[object], bool],
+    deadline: float = 30.0,
+    initial_delay: float = 0.25,
+    max_delay: float = 4.0,
+    multiplier: float = 2.0,
+    jitter: float = 0.5,
+    name: str = "operation",
+):
+    """Calls fetch until is_done(result) and returns that result.
+
+    fetch returns (result, retry_after) where retry_after is the server's
+    hint in seconds or None. Raises OperationTimeout after `deadline` seconds.
+    Polls are counted in kiosk_polls_total under name.
+    """
+    deadline_at = time.monotonic() + deadline
+    delays = backoff_delays(initial_delay, max_delay, multiplier, jitter)
+    for attempt in itertools.count(1):
+        result, retry_after = fetch()
+        metrics.inc("kiosk_polls_total", operation=name)
+        if is_done(result):
+            logging.info(f"Operation done after {attempt} polls.")
+            return result
+        time.sleep(_next_wait(retry_after, delays, deadline_at))
+
+
+async def poll_async(
+    fetch: Callable[[], Tuple[object, Optional[float]]],
+    is_done: Callable[[object], bool],
+    deadline: float = 30.0,
+    initial_delay: float = 0.25,
+    max_delay: float = 4.0,
+    multiplier: float = 2.0,
+    jitter: float = 0.5,
+    name: str = "operation",
+):
+    """Same as poll, but runs the blocking fetch in the loop's executor, in
+    the caller's context, and waits with asyncio.sleep between polls."""
+    loop = asyncio.get_running_loop()
+    deadline_at = time.monotonic() + deadline
+    delays = backoff_delays(initial_delay, max_delay, multiplier, jitter)
+    for attempt in itertools.count(1):
+        result, retry_after = await loop.run_in_executor(
+            None, contextvars.copy_context().run, fetch
+        )
+        metrics.inc("kiosk_polls_total", operation=name)
+        if is_done(result):
+            logging.info(f"Operation done after {attempt} polls.")
+            return result
+        await asyncio.sleep(_next_wait(retry_after, delays, deadline_at))
+
+
+async def poll_many(
+    fetches: List[Callable[[], Tuple[object, Optional[float]]]],
+    is_done: Callable[[object], bool],
+    **kwargs,
+) -> list:
+    """Polls several operations concurrently in the running loop.
+
+    Returns results in the order of fetches, a failed or timed out
+    operation is returned as its exception.
+    """
+    return await asyncio.gather(
+        *[poll_async(fetch, is_done, **kwargs) for fetch in fetches],
+        return_exceptions=True,
+    )
+
+
+def poll_many_sync(
+    fetches: List[Callable[[], Tuple[object, Optional[float]]]],
+    is_done: Callable[[object], bool],
+    **kwargs,
+) -> list:
+    "Runs poll_many in a new event loop for callers outside of asyncio"
+    return asyncio.run(poll_many(fetches, is_done, **kwargs))
+
+
+def fetch_with(func: Callable, *args, **kwargs) -> Callable:
+    "Wraps an SDK getter without Retry-After information as fetch callable"
+    call = functools.partial(func, *args, **kwargs)
+
+    return lambda: (call(), None)
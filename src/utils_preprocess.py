@@ -0,0 +1,177 @@
+"""
+Client-side image preprocessing before uploads.
+
+Images are rotated upright from their EXIF orientation, downscaled to the
+largest size a service makes use of and re-encoded as JPEG, in grayscale for
+OCR. The work runs in a process pool that reads the files itself, so neither
+the event loop nor the GIL is blocked and only the smaller result is sent
+back to the kiosk process.
+"""
+
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from PIL import Image
+from PIL import ImageOps
+from PIL import UnidentifiedImageError
+
+from src.utils_image import ImageBuffer
+from src.utils_image import image_stream
+from src.utils_image import map_image
+
+# EXIF tag of the orientation, 1 is upright
+EXIF_ORIENTATION = 0x0112
+
+
+class PreprocessProfile(NamedTuple):
+    "Target of one service, max_side in pixels and JPEG quality 1-95"
+
+    max_side: int
+    quality: int = 85
+    grayscale: bool = False
+
+
+def preprocess_image(
+    image: ImageBuffer, max_side: int, quality: int = 85, grayscale: bool = False
+) -> Optional[bytes]:
+    """Upright, downscaled JPEG of image.
+
+    Returns None if the image cannot be decoded or the result is neither
+    smaller than image nor needed to fix the orientation, then the original
+    should be sent.
+    """
+    try:
+        with Image.open(image_stream(image)) as img:
+            rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+            # decode JPEGs at a reduced scale where that still covers max_side
+            scale = max_side / max(img.size)
+            if scale < 1:
+                img.draft(
+                    "L" if grayscale else "RGB",
+                    (math.ceil(img.width * scale), math.ceil(img.height * scale)),
+                )
+            img = ImageOps.exif_transpose(img).convert("L" if grayscale else "RGB")
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+            output = BytesIO()
+            img.save(output, "JPEG", quality=quality, optimize=True)
+    except (UnidentifiedImageError, OSError) as e:
+        logging.warning(f"Cannot preprocess image, send original: {e}")
+        return None
+
+    data = output.getvalue()
+    if rotated or len(data) < len(image):
+        return data
+
+    return None
+
+
+def preprocess_file(filepath: str, profile: PreprocessProfile) -> Tuple[bytes, int]:
+    "Runs in a worker: preprocessed image of filepath or None, and original size"
+    image = map_image(filepath)
+    return preprocess_image(image, *profile), image.nbytes
+
+
+class Preprocessor:
+    """Process pool preparing images per service profile.
+
+    Keeps per profile counters of images, bytes before and after and the
+    time spent, including waiting for a worker. Results of files shared by
+    many passengers, like video thumbnails, are kept for `max_shared` files.
+    """
+
+    def __init__(
+        self,
+        profiles: Dict[str, PreprocessProfile],
+        max_workers: int = 2,
+        max_shared: int = 256,
+    ):
+        self.profiles = profiles
+        self.max_shared = max_shared
+        self._shared = OrderedDict()
+        # spawn, the kiosk process runs threads that must not be forked
+        self._pool = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.counters = {
+            name: {"images": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0}
+            for name in profiles
+        }
+
+    def __enter__(self) -> "Preprocessor":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    async def preprocess(
+        self,
+        profile_name: str,
+        filepath: str,
+        image: ImageBuffer = None,
+        shared: bool = False,
+    ) -> ImageBuffer:
+        """Preprocessed image of filepath for the service of profile_name.
+
+        Falls back to image, or the mapped file, where preprocessing does not
+        help. With shared the result is reused until the file changes.
+        """
+        if shared:
+            stat = os.stat(filepath)
+            key = (profile_name, filepath, stat.st_size, stat.st_mtime_ns)
+            if key in self._shared:
+                self._shared.move_to_end(key)
+                return self._shared[key]
+            data = await self.preprocess(profile_name, filepath, image)
+            self._shared[key] = data
+            if len(self._shared) > self.max_shared:
+                self._shared.popitem(last=False)
+            return data
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        data, size = await loop.run_in_executor(
+            self._pool, preprocess_file, filepath, self.profiles[profile_name]
+        )
+        if data is None:
+            data = image if image is not None else map_image(filepath)
+
+        counters = self.counters[profile_name]
+        counters["images"] += 1
+        counters["bytes_in"] += size
+        counters["bytes_out"] += len(data)
+        counters["seconds"] += time.perf_counter() - start
+
+        return data
+
+    def stats(self) -> dict:
+        "Counters per profile with bytes saved"
+        return {
+            name: {**c, "bytes_saved": c["bytes_in"] - c["bytes_out"]}
+            for name, c in self.counters.items()
+        }
+
+
+def get_preprocessor(config: dict) -> Optional[Preprocessor]:
+    "Creates the preprocessor configured under kiosk.preprocess, None if disabled"
+    preprocess_config = config["kiosk"]["preprocess"]
+    if not preprocess_config["enabled"]:
+        return None
+
+    return Preprocessor(
+        {
+            name: PreprocessProfile(**profile)
+            for name, profile in preprocess_config["profiles"].items()
+        },
+        max_workers=preprocess_config["max_workers"],
+    )
@@ -0,0 +1,298 @@
+"""
+Quota-aware rate limiting of the cognitive service calls.
+
+Form Recognizer, Face and Custom Vision allow a number of transactions per
+second per resource and answer HTTP 429 above it. Every call takes a token
+of its service's bucket first, refilled at the configured rate. A 429 stops
+the bucket for the Retry-After of the response and the call is repeated.
+
+When the kiosk is throttled, waiting calls are served by the departure of
+the passenger's flight, earliest first, so that passengers close to gate
+closure go first. The departure is looked up in the flight manifest once
+the boarding pass is read from its PDF text layer or barcode, concurrently
+with the passenger's other checks. Until then a call that finds no token
+waits for the local read instead of queueing, one that finds a token goes
+right away. Boarding passes read only by the custom model give the
+departure after their analysis, calls of such a passenger before that wait
+behind the passengers with a known departure in the order they arrived.
+"""
+
+import contextvars
+import itertools
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from src.utils_metrics import metrics
+from src.utils_poller import parse_retry_after
+from src.utils_resilience import ServiceError
+
+# seconds a throttled bucket stops without Retry-After in the response
+DEFAULT_RETRY_AFTER = 1.0
+
+
+class RateLimitTimeout(ServiceError):
+    "No token of the service's bucket within the limiter's max_wait"
+
+
+class Deadline:
+    """Departure of a passenger's flight in epoch seconds, inf until known.
+
+    A pending deadline is looked up yet, `known` is set once it has been.
+    """
+
+    __slots__ = ["at", "known"]
+
+    def __init__(self, at: float = math.inf, pending: bool = False):
+        self.at = at
+        self.known = threading.Event()
+        if not pending:
+            self.known.set()
+
+
+# deadline of the passenger whose checks run in this context
+DEADLINE = contextvars.ContextVar("deadline", default=None)
+
+
+def retry_after_of(error: Exception) -> Optional[float]:
+    """Seconds to wait if error is an HTTP 429 response, else None.
+
+    azure-core errors carry the status code, msrest errors the response.
+    """
+    response = getattr(error, "response", None)
+    status_code = getattr(error, "status_code", None) or getattr(
+        response, "status_code", None
+    )
+    if status_code != 429:
+        return None
+
+    retry_after = parse_retry_after(getattr(response, "headers", {}).get("Retry-After"))
+
+    return DEFAULT_RETRY_AFTER if retry_after is None else retry_after
+
+
+class TokenBucket:
+    """`rate` tokens per second, at most `burst` of them saved up.
+
+    Waiting threads are served by their deadline, the one arrived first
+    among equal deadlines. Deadlines may change while their threads wait.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float = 1.0):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._waiting: List[Tuple[Deadline, int]] = []
+        # waiter sleeping until the next token, the others wait to be notified
+        self._head = None
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        # a paused bucket is refilled from the end of the pause on
+        if now > self._updated:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+
+    def acquire(self, deadline: Deadline, timeout: float = None) -> float:
+        "Takes a token, returns the seconds waited for it"
+        start = time.monotonic()
+        with self._condition:
+            waiter = (deadline, next(self._seq))
+            self._waiting.append(waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    first = min(self._waiting, key=lambda w: (w[0].at, w[1]))
+                    if first is not self._head:
+                        # a deadline became known or the head took its token
+                        self._head = first
+                        self._condition.notify_all()
+                    ready_at = max(now, self._updated) + max(
+                        0.0, (1 - self.tokens) / self.rate
+                    )
+                    if first is waiter and ready_at <= now:
+                        self.tokens -= 1
+                        return now - start
+                    if timeout is not None and now - start >= timeout:
+                        raise RateLimitTimeout(
+                            f"No {self.name} token within {timeout}s"
+                        )
+                    wait = ready_at - now if first is waiter else None
+                    if timeout is not None:
+                        remaining = start + timeout - now
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                self._waiting.remove(waiter)
+                if self._head is waiter:
+                    self._head = None
+                self._condition.notify_all()
+
+    def try_acquire(self) -> bool:
+        "Takes a token if one is ready and no thread waits, without waiting"
+        with self._condition:
+            self._refill(time.monotonic())
+            if self._waiting or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def pause(self, seconds: float) -> None:
+        "Hands out no token for seconds, the service answered 429"
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = min(self.tokens, 0.0)
+            self._updated = max(self._updated, now + seconds)
+
+
+class RateLimiter:
+    """Token buckets per service and the departures of the manifest's flights.
+
+    call runs a blocking SDK or REST call with a token of its service and
+    repeats it up to `max_retries` times while it is throttled. A call
+    waits at most `max_wait` seconds for a token.
+    """
+
+    def __init__(
+        self,
+        buckets: Dict[str, TokenBucket],
+        max_retries: int = 3,
+        max_wait: float = 30.0,
+    ):
+        self.buckets = buckets
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.departures: Dict[Tuple[str, str], float] = {}
+
+    def acquire(self, service: str) -> None:
+        """Waits for a token of service, served by the deadline of this context.
+        A pending deadline is waited for first if no token is ready."""
+        deadline = DEADLINE.get() or Deadline()
+        bucket = self.buckets[service]
+        start = time.monotonic()
+        if not deadline.known.is_set():
+            if bucket.try_acquire():
+                metrics.observe("kiosk_ratelimit_wait_seconds", 0.0, service=service)
+                return
+            deadline.known.wait(self.max_wait)
+
+        bucket.acquire(deadline, max(0.0, self.max_wait - (time.monotonic() - start)))
+        waited = time.monotonic() - start
+        metrics.observe("kiosk_ratelimit_wait_seconds", waited, service=service)
+
+    def throttled(self, service: str, retry_after: float) -> None:
+        "Stops the bucket of service after a 429 with retry_after seconds"
+        logging.warning(f"{service} throttled, pausing for {retry_after:.2f}s")
+        metrics.inc("kiosk_throttled_total", service=service)
+        self.buckets[service].pause(retry_after)
+
+    def call(self, service: str, func: Callable, *args, **kwargs):
+        "func(*args, **kwargs) with a token of service, repeated while throttled"
+        for attempt in itertools.count(1):
+            self.acquire(service)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                retry_after = retry_after_of(e)
+                if retry_after is None or attempt > self.max_retries:
+                    raise
+                self.throttled(service, retry_after)
+
+    def update_departures(self, flight_manifest: pd.DataFrame) -> None:
+        "Departures of the manifest's flights by flight number and day"
+        flights = flight_manifest[
+            ["flight_number", "flight_date", "flight_time"]
+        ].drop_duplicates()
+        flight_dates = pd.to_datetime(flights["flight_date"], errors="coerce")
+        departures = flight_dates + pd.to_timedelta(
+            flights["flight_time"].astype(str) + ":00", errors="coerce"
+        )
+        # boarding passes print the day as dd.mm
+        self.departures = {
+            (flight_number, day): departure.timestamp()
+            for flight_number, day, departure in zip(
+                flights["flight_number"].astype(str),
+                flight_dates.dt.strftime("%d.%m"),
+                departures,
+            )
+            if not pd.isna(departure)
+        }
+        logging.info(f"Departures of {len(self.departures)} flights")
+
+    def departure_of(self, dict_boardingpass: dict) -> Optional[float]:
+        "Departure of the flight on the boarding pass, None if not in the manifest"
+        flight_number = (
+            f"{dict_boardingpass.get('airline')}-"
+            f"{dict_boardingpass.get('flight_number')}"
+        )
+        return self.departures.get((flight_number, dict_boardingpass.get("date")))
+
+    def set_departure(self, dict_boardingpass) -> None:
+        """Serves the calls of this context's passenger by its flight's
+        departure, waiting calls are reordered with the next token. Marks
+        the deadline known, also if dict_boardingpass is None."""
+        deadline = DEADLINE.get()
+        if deadline is None:
+            return
+
+        if isinstance(dict_boardingpass, dict):
+            departure = self.departure_of(dict_boardingpass)
+            if departure is not None:
+                deadline.at = departure
+        deadline.known.set()
+
+
+class RateLimitedClient:
+    """SDK client whose method calls take a token of service first.
+
+    Methods of the operation groups named in groups, e.g. `face` of
+    FaceClient, are limited as well. Other attributes are the client's.
+    """
+
+    def __init__(
+        self, client, limiter: RateLimiter, service: str, groups: List[str] = ()
+    ):
+        self._client = client
+        self._limiter = limiter
+        self._service = service
+        self._groups = groups
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if name in self._groups:
+            return RateLimitedClient(attr, self._limiter, self._service)
+        if callable(attr) and not name.startswith("_"):
+            return lambda *args, **kwargs: self._limiter.call(
+                self._service, attr, *args, **kwargs
+            )
+
+        return attr
+
+
+def get_rate_limiter(config: dict) -> Optional[RateLimiter]:
+    "Creates the buckets configured under kiosk.rate_limits, None if disabled"
+    rate_limits_config = config["kiosk"]["rate_limits"]
+    if not rate_limits_config["enabled"]:
+        return None
+
+    logging.info(f"Rate limits: {rate_limits_config['services']}")
+
+    return RateLimiter(
+        {
+            service: TokenBucket(service, **options)
+            for service, options in rate_limits_config["services"].items()
+        },
+        max_retries=rate_limits_config["max_retries"],
+        max_wait=rate_limits_config["max_wait"],
+    )
@@ -0,0 +1,269 @@
+"""
+Circuit breakers, timeouts and hedged retries for the remote checks.
+
+Every check of a passenger (ID OCR, boarding pass, face, lighter) runs
+under a policy with a deadline and optionally a hedge: if the first attempt
+is slow, a second one is started and the first result wins. Checks of one
+service share a circuit breaker that fails fast after repeated failures
+and lets a single trial call through once `reset_timeout` has passed.
+
+A cancelled blocking call keeps its executor thread until it returns, so a
+hedge is only started while one of `max_hedges` slots is free and holds it
+until its call returns. The executor has a thread per slot set aside.
+
+In degraded mode a failed check does not fail the passenger. It returns
+PendingReview, pipeline_validate marks the check for manual review and the
+remaining checks are validated as usual.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+
+from src.utils_metrics import metrics
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class ServiceError(RuntimeError):
+    "Remote call returned an error response"
+
+
+class CircuitOpenError(RuntimeError):
+    "Call rejected without trying, the service failed repeatedly"
+
+
+class PendingReview(NamedTuple):
+    "Result of a check that could not be done and needs manual review"
+
+    check: str
+    reason: str
+
+
+class CircuitBreaker:
+    """Fails fast after `failure_threshold` consecutive failures.
+
+    Stays open for `reset_timeout` seconds, then lets one trial call
+    through (half open). Its success closes the circuit, its failure opens
+    it again.
+    """
+
+    def __init__(
+        self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        # token of the trial call in flight while half open
+        self._trial = None
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logging.warning(f"Circuit of {self.name} is {state}")
+        self.state = state
+        metrics.set_gauge("kiosk_breaker_state", STATE_VALUES[state], service=self.name)
+
+    def allow(self) -> Optional[object]:
+        """Raises CircuitOpenError if a call must not be tried now, returns a
+        token if the call is the trial call, None otherwise"""
+        with self._lock:
+            if (
+                self.state == OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                self._set_state(HALF_OPEN)
+                self._trial = None
+            if self.state == HALF_OPEN and self._trial is None:
+                self._trial = object()
+                return self._trial
+            if self.state != CLOSED:
+                metrics.inc("kiosk_breaker_rejections_total", service=self.name)
+                raise CircuitOpenError(f"Circuit of {self.name} is {self.state}")
+            return None
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._set_state(CLOSED)
+
+    def release(self, trial: object) -> None:
+        "Lets another trial call through if the trial call of trial was cancelled"
+        with self._lock:
+            if trial is not None and self._trial is trial:
+                self._trial = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+@dataclass
+class CheckPolicy:
+    """How a check calls its service.
+
+    The check gives up after `timeout` seconds. If `hedge_after` is set and
+    an attempt has not finished by then, another attempt is started, up to
+    `max_attempts` in total. A failed attempt is retried right away while
+    attempts are left.
+    """
+
+    service: str
+    timeout: float = 30.0
+    hedge_after: Optional[float] = None
+    max_attempts: int = 1
+
+
+async def hedged(
+    make_call: Callable[[], Awaitable],
+    hedge_after: Optional[float] = None,
+    max_attempts: int = 1,
+    name: str = "call",
+    slots: threading.Semaphore = None,
+):
+    """Result of the first successful attempt of make_call.
+
+    Attempts still running when one succeeds are cancelled. With slots, a
+    hedge is started only if a slot is free and is left to finish, it holds
+    the slot until then. Raises the last error if all attempts fail.
+    """
+    running, hedges, error, started = set(), set(), None, 0
+    can_hedge = hedge_after is not None
+
+    def release(task: asyncio.Future) -> None:
+        slots.release()
+        if not task.cancelled():
+            task.exception()
+
+    def start(hedge: bool = False):
+        nonlocal started
+        started += 1
+        task = asyncio.ensure_future(make_call())
+        running.add(task)
+        if hedge and slots is not None:
+            hedges.add(task)
+            task.add_done_callback(release)
+
+    start()
+    try:
+        while running:
+            can_hedge = can_hedge and started < max_attempts
+            done, _ = await asyncio.wait(
+                running,
+                timeout=hedge_after if can_hedge else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                if slots is None or slots.acquire(blocking=False):
+                    metrics.inc("kiosk_hedges_total", operation=name)
+                    start(hedge=True)
+                else:
+                    metrics.inc("kiosk_hedges_skipped_total", operation=name)
+                    can_hedge = False
+                continue
+
+            for task in done:
+                running.discard(task)
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+                logging.warning(f"Attempt {started} of {name} failed: {error!r}")
+
+            retry = not isinstance(error, CircuitOpenError)
+            if not running and retry and started < max_attempts:
+                metrics.inc("kiosk_retries_total", operation=name)
+                start()
+    finally:
+        for task in running - hedges:
+            task.cancel()
+
+    raise error
+
+
+class Resilience:
+    """Circuit breakers per service and policies per check.
+
+    With degraded set, a check failing for any reason, including an open
+    circuit and its timeout, returns PendingReview instead of raising.
+    """
+
+    def __init__(
+        self,
+        policies: Dict[str, CheckPolicy],
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        degraded: bool = True,
+        max_hedges: int = 4,
+    ):
+        self.policies = policies
+        self.degraded = degraded
+        self.max_hedges = max_hedges
+        self.hedge_slots = threading.BoundedSemaphore(max_hedges)
+        self.breakers = {
+            service: CircuitBreaker(service, failure_threshold, reset_timeout)
+            for service in {p.service for p in policies.values()}
+        }
+
+    async def call(self, check: str, make_call: Callable[[], Awaitable]):
+        "Runs make_call for check under its policy and its service's breaker"
+        policy = self.policies[check]
+        breaker = self.breakers[policy.service]
+
+        async def attempt():
+            trial = breaker.allow()
+            try:
+                result = await make_call()
+            except asyncio.CancelledError:
+                breaker.release(trial)
+                raise
+            except Exception:
+                breaker.record_failure()
+                raise
+            breaker.record_success()
+            return result
+
+        try:
+            return await asyncio.wait_for(
+                hedged(
+                    attempt,
+                    policy.hedge_after,
+                    policy.max_attempts,
+                    name=check,
+                    slots=self.hedge_slots,
+                ),
+                timeout=policy.timeout,
+            )
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                breaker.record_failure()
+            if not self.degraded:
+                raise
+            logging.error(f"Check {check} failed, pending manual review: {e!r}")
+            metrics.inc("kiosk_pending_review_total", check=check)
+            return PendingReview(check, repr(e))
+
+
+def get_resilience(config: dict) -> Resilience:
+    "Creates breakers and check policies configured under kiosk.resilience"
+    resilience_config = config["kiosk"]["resilience"]
+
+    return Resilience(
+        {
+            check: CheckPolicy(**policy)
+            for check, policy in resilience_config["checks"].items()
+        },
+        failure_threshold=resilience_config["breaker"]["failure_threshold"],
+        reset_timeout=resilience_config["breaker"]["reset_timeout"],
+        degraded=resilience_config["degraded"],
+        max_hedges=resilience_config["max_hedges"],
+    )
@@ -0,0 +1,259 @@
+"""
+Long-running kiosk service.
+
+Passengers are submitted one at a time, either by dropping a submission
+directory into an inbox or by calling `KioskService.submit`. Submissions go
+through a bounded queue to a fixed number of workers, a full queue makes
+producers wait. Results are written as soon as a passenger is done.
+
+A submission directory is named by passenger or session id and holds
+
+    boarding.pdf, id.jpg, lighter.jpg, thumbs/*.jpg (optional), READY
+
+The kiosk front end writes READY last so that incomplete submissions are
+not picked up.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+from glob import glob
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+from src.utils_manifest import ManifestSource
+from src.utils_partition import Manifest
+from src.utils_metrics import metrics
+from src.utils_pipeline import KioskClients
+from src.utils_pipeline import log_stats
+from src.utils_pipeline import process_passenger
+from src.utils_pipeline import use_executor
+from src.utils_sink import ResultSink
+
+SUBMISSION_FILES = {
+    "boarding": "boarding.pdf",
+    "id": "id.jpg",
+    "lighter": "lighter.jpg",
+}
+READY_MARKER = "READY"
+
+
+def read_submission(directory: str) -> dict:
+    "Passenger dict of a submission directory as expected by process_passenger"
+    passenger = {
+        key: os.path.join(directory, filename)
+        for key, filename in SUBMISSION_FILES.items()
+    }
+    missing = [p for p in passenger.values() if not os.path.isfile(p)]
+    if missing:
+        raise FileNotFoundError(f"Submission {directory} misses {missing}")
+
+    passenger["thumbs"] = sorted(glob(os.path.join(directory, "thumbs", "*.jpg")))
+    passenger["passenger_id"] = os.path.basename(directory.rstrip(os.sep))
+    passenger["directory"] = directory
+
+    return passenger
+
+
+class KioskService:
+    """Bounded pipeline of passenger submissions.
+
+    At most `queue_size` submissions wait and `concurrency` are processed at
+    once. on_result is called with the passenger and its validated rows, or
+    the exception if processing failed, as soon as each passenger is done.
+    """
+
+    def __init__(
+        self,
+        clients: KioskClients,
+        flight_manifest: Manifest,
+        sink: ResultSink = None,
+        concurrency: int = 4,
+        queue_size: int = 16,
+        on_result: Callable = None,
+    ):
+        self.clients = clients
+        self.flight_manifest = flight_manifest
+        self.sink = sink
+        self.concurrency = max(1, concurrency)
+        self.on_result = on_result
+        self.counters = {"submitted": 0, "processed": 0, "not_found": 0, "failed": 0}
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = []
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters, "queued": self._queue.qsize()}
+
+    async def submit(self, passenger: dict) -> None:
+        "Queues one passenger, waits while the queue is full"
+        await self._queue.put(passenger)
+        self.counters["submitted"] += 1
+        metrics.set_gauge("kiosk_queued_passengers", self._queue.qsize())
+
+    async def start(self) -> None:
+        use_executor(self.concurrency, self.clients.resilience)
+        self._workers = [
+            asyncio.ensure_future(self._work()) for _ in range(self.concurrency)
+        ]
+
+    async def stop(self) -> None:
+        "Processes all queued passengers, then stops the workers"
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self):
+        while True:
+            passenger = await self._queue.get()
+            metrics.set_gauge("kiosk_queued_passengers", self._queue.qsize())
+            try:
+                result = await process_passenger(
+                    self.clients, self.flight_manifest, passenger, sink=self.sink
+                )
+                # passengers not in the manifest are left for review
+                outcome = "processed" if result is not None else "not_found"
+                self.counters[outcome] += 1
+                metrics.inc("kiosk_passengers_total", result=outcome)
+            except Exception as e:
+                logging.error(f"Passenger {passenger} failed: {e!r}")
+                self.counters["failed"] += 1
+                metrics.inc("kiosk_passengers_total", result="failed")
+                result = e
+            finally:
+                self._queue.task_done()
+
+            if self.on_result is not None:
+                try:
+                    self.on_result(passenger, result)
+                except Exception as e:
+                    logging.error(f"Result handler failed: {e!r}")
+
+
+class DirectoryWatcher:
+    """Polls an inbox for ready submission directories.
+
+    Processed submissions are moved to `archive`/done, those of passengers
+    not found in the manifest to `archive`/review and failed ones to
+    `archive`/failed. Submissions left in the inbox by a stopped service are
+    picked up again on the next start.
+    """
+
+    def __init__(self, inbox: str, archive: str, poll_interval: float = 1.0):
+        self.inbox = inbox
+        self.archive = archive
+        self.poll_interval = poll_interval
+        self._seen = set()
+        for directory in [
+            inbox,
+            *[os.path.join(archive, d) for d in ["done", "review", "failed"]],
+        ]:
+            os.makedirs(directory, exist_ok=True)
+
+    def ready(self) -> List[str]:
+        "New submission directories with a READY marker, oldest first"
+        entries = [
+            entry
+            for entry in os.scandir(self.inbox)
+            if entry.is_dir()
+            and entry.path not in self._seen
+            and os.path.exists(os.path.join(entry.path, READY_MARKER))
+        ]
+
+        return [e.path for e in sorted(entries, key=lambda e: e.stat().st_mtime)]
+
+    async def watch(self, service: KioskService, stop: asyncio.Event) -> None:
+        "Submits ready directories until stop is set"
+        while not stop.is_set():
+            for directory in self.ready():
+                self._seen.add(directory)
+                try:
+                    passenger = read_submission(directory)
+                except FileNotFoundError as e:
+                    logging.error(f"{e}. Skip submission.")
+                    self.archive_submission(directory, "failed")
+                    continue
+                # blocks while the service is saturated
+                await service.submit(passenger)
+
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def archive_submission(self, directory: str, outcome: str = "done") -> None:
+        "Moves a submission to the archive directory of outcome"
+        target = os.path.join(self.archive, outcome, os.path.basename(directory))
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        shutil.move(directory, target)
+        self._seen.discard(directory)
+
+    def on_result(self, passenger: dict, result) -> None:
+        "Archives the submission of a processed passenger"
+        if isinstance(result, Exception):
+            outcome = "failed"
+        elif result is None:
+            outcome = "review"
+        else:
+            outcome = "done"
+        self.archive_submission(passenger["directory"], outcome)
+
+
+def log_result(passenger: dict, result) -> None:
+    if isinstance(result, pd.DataFrame):
+        logging.info(f"Passenger {passenger.get('passenger_id')} done")
+
+
+async def serve(
+    clients: KioskClients,
+    flight_manifest: Manifest,
+    service_config: dict,
+    concurrency: int = 4,
+    sink: ResultSink = None,
+    stop: asyncio.Event = None,
+    manifest_source: ManifestSource = None,
+) -> None:
+    """Runs the kiosk service on the inbox configured under kiosk.service until stop.
+
+    With manifest_source, new versions of the manifest file are applied to
+    flight_manifest while the service runs.
+    """
+    watcher = DirectoryWatcher(
+        service_config["inbox"],
+        service_config["archive"],
+        poll_interval=service_config["poll_interval"],
+    )
+
+    def on_result(passenger: dict, result):
+        log_result(passenger, result)
+        watcher.on_result(passenger, result)
+
+    service = KioskService(
+        clients,
+        flight_manifest,
+        sink=sink,
+        concurrency=concurrency,
+        queue_size=service_config["queue_size"],
+        on_result=on_result,
+    )
+    stop = stop or asyncio.Event()
+
+    logging.info(f"Kiosk service watching {watcher.inbox}")
+    await service.start()
+    watches = [watcher.watch(service, stop)]
+    if manifest_source is not None:
+        on_load = None
+        if clients.rate_limiter is not None:
+            on_load = clients.rate_limiter.update_departures
+        watches.append(manifest_source.watch(flight_manifest, stop, on_load))
+    try:
+        await asyncio.gather(*watches)
+    finally:
+        stop.set()
+        await service.stop()
+        logging.info(f"Kiosk service stopped: {service.stats()}")
+        log_stats(clients)
@@ -0,0 +1,245 @@
+"""
+Result sinks for validated passengers.
+
+Validated manifest rows are buffered and written in bulk by a background
+thread to one append-only file per flight, so the request path only puts
+rows on a queue.
+"""
+
+import csv
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List
+
+import pandas as pd
+
+from src.utils_metrics import metrics
+
+
+class ResultSink:
+    """Buffers validated rows and flushes them off the calling thread.
+
+    Subclasses implement `_append` for a file format. Rows are flushed when
+    `max_buffer` rows are pending or after `flush_interval` seconds. Rows of
+    a flight that could not be written are kept and written with the next
+    flush, flush() and close() raise while any are left.
+    """
+
+    extension = None
+
+    def __init__(
+        self,
+        directory: str = "data/validated",
+        flush_interval: float = 1.0,
+        max_buffer: int = 500,
+    ):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._queue = queue.Queue()
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(
+            target=self._run, name=type(self).__name__, daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self) -> "ResultSink":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def filepath(self, flight_number: str) -> str:
+        return os.path.join(
+            self.directory, f"flight_manifest_{flight_number}.{self.extension}"
+        )
+
+    def write(self, rows: pd.DataFrame) -> None:
+        "Queues validated manifest rows, returns immediately"
+        if self._closed:
+            raise RuntimeError("Cannot write to a closed sink")
+        self._queue.put(rows)
+
+    def flush(self) -> None:
+        "Blocks until all rows written so far are on disk"
+        done = Future()
+        self._queue.put(done)
+        done.result()
+
+    def close(self) -> None:
+        "Flushes pending rows and stops the writer thread"
+        if self._closed:
+            return
+        self._closed = True
+        done = Future()
+        self._queue.put(done)
+        self._queue.put(None)
+        self._thread.join()
+        done.result()
+
+    def _run(self):
+        pending, n_pending = [], 0
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, pd.DataFrame):
+                pending.append(item)
+                n_pending += len(item)
+                if n_pending < self.max_buffer:
+                    continue
+
+            error = None
+            if pending:
+                pending, error = self._flush(pending)
+                n_pending = sum(len(rows) for rows in pending)
+            deadline = time.monotonic() + self.flush_interval
+
+            if isinstance(item, Future):
+                if pending:
+                    item.set_exception(
+                        RuntimeError(f"{n_pending} validated rows not written: {error}")
+                    )
+                else:
+                    item.set_result(None)
+            elif item is None:
+                return
+
+    def _flush(self, pending: List[pd.DataFrame]) -> tuple:
+        """Writes pending rows per flight, returns the rows of the flights that
+        failed and the last error. The writer thread outlives any error,
+        flush() and close() wait for it."""
+        failed, error = [], None
+        try:
+            rows = pd.concat(pending)
+        except Exception as e:
+            logging.error(f"Could not flush validated rows: {e}")
+            return pending, e
+
+        with metrics.span("sink_flush"):
+            # observed: flight_number is categorical in a loaded manifest
+            for flight_number, flight_rows in rows.groupby(
+                "flight_number", sort=False, observed=True
+            ):
+                try:
+                    self._append(self.filepath(flight_number), flight_rows)
+                except Exception as e:
+                    logging.error(
+                        f"Could not flush {len(flight_rows)} validated rows of "
+                        f"{flight_number}, retrying with the next flush: {e}"
+                    )
+                    failed.append(flight_rows)
+                    error = e
+        n_written = len(rows) - sum(len(flight_rows) for flight_rows in failed)
+        metrics.inc("kiosk_sink_rows_total", n_written)
+        logging.info(f"Flushed {n_written} validated rows to {self.directory}")
+
+        return failed, error
+
+    def _append(self, filepath: str, rows: pd.DataFrame):
+        raise NotImplementedError
+
+
+def _truncate_torn_line(f) -> int:
+    """Cuts a torn last line of a crash during a flush from binary file f,
+    returns the size of f"""
+    end = f.seek(0, os.SEEK_END)
+    if end == 0:
+        return end
+    f.seek(end - 1)
+    if f.read(1) == b"\n":
+        return end
+
+    size = start = end
+    while start > 0:
+        start = max(0, size - 64 * 1024)
+        f.seek(start)
+        newline = f.read(size - start).rfind(b"\n")
+        if newline >= 0:
+            start += newline + 1
+            break
+        size = start
+    logging.warning(f"Dropped torn last line of {end - start} bytes in {f.name}")
+    f.truncate(start)
+
+    return start
+
+
+def _fsync_append(filepath: str, data: str, header: str = ""):
+    """Appends data in one write and fsyncs, drops a torn last line first.
+    header is written first if the file is empty."""
+    with open(filepath, "ab+") as f:
+        if _truncate_torn_line(f) == 0:
+            data = header + data
+        f.write(data.encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class JsonlSink(ResultSink):
+    "Appends one JSON record per validated passenger"
+
+    extension = "jsonl"
+
+    def _append(self, filepath: str, rows: pd.DataFrame):
+        _fsync_append(
+            filepath,
+            rows.to_json(orient="records", lines=True, date_format="iso").rstrip("\n")
+            + "\n",
+        )
+
+
+class CsvSink(ResultSink):
+    "Appends validated passengers as CSV rows, header on file creation"
+
+    extension = "csv"
+
+    def _append(self, filepath: str, rows: pd.DataFrame):
+        _fsync_append(
+            filepath,
+            rows.to_csv(index=False, header=False, quoting=csv.QUOTE_MINIMAL),
+            header=rows.head(0).to_csv(index=False),
+        )
+
+
+SINKS: Dict[str, type] = {"jsonl": JsonlSink, "csv": CsvSink}
+
+
+def get_sink(config: dict) -> ResultSink:
+    "Creates the result sink configured under kiosk.sink in config.yaml"
+    sink_config = dict(config["kiosk"]["sink"])
+
+    return SINKS[sink_config.pop("format")](**sink_config)
+
+
+def read_validated(filepath: str) -> pd.DataFrame:
+    """Reads a flight's validation log, latest record per passenger wins.
+
+    A torn last line of a JSONL log from a crash during a flush is skipped.
+    """
+    if filepath.endswith(".csv"):
+        rows = pd.read_csv(filepath)
+    else:
+        records = []
+        with open(filepath, encoding="utf-8") as f:
+            for line in filter(str.strip, f):
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning(f"Skip incomplete record in {filepath}")
+        rows = pd.DataFrame.from_records(records)
+
+    # passengers not identified are keyed by their submission
+    keys = ["passenger_key"] if "passenger_key" in rows.columns else []
+    return rows.drop_duplicates(["name", "birthdate", *keys], keep="last").reset_index(
+        drop=True
+    )
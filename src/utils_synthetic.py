@@ -0,0 +1,497 @@
+"""
+Synthetic flight manifests and passenger documents for load tests.
+
+generate_manifest yields the manifest of many flights in chunks of whole
+flights, so millions of passengers are written with flat memory. Flights,
+seat maps, names and birth dates are drawn with numpy from the faker seed
+in config.yaml, every flight from a generator of its own, so the output
+does not depend on the chunk size.
+
+write_id_card fills the driver license template of data_projectsubmit,
+write_boardingpass writes a one page PDF with the layout and the text of
+the project's boarding passes. Given airport codes, write_documents adds an
+AAMVA PDF417 barcode on the back of the ID card and an IATA BCBP barcode to
+the boarding pass.
+"""
+
+import logging
+import os
+import zlib
+from datetime import datetime
+from datetime import timedelta
+from functools import lru_cache
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+from faker import Faker
+from faker.providers.person.en_US import Provider as PersonProvider
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+try:
+    import zxingcpp
+except ImportError:
+    zxingcpp = None
+
+ID_TEMPLATE = "data_projectsubmit/template/ca-dl-template.png"
+VALIDATION_COLUMNS = [
+    "valid_dob",
+    "valid_person",
+    "valid_luggage",
+    "valid_name",
+    "valid_boardingpass",
+]
+
+
+class SeatMap(NamedTuple):
+    "Seat rows and the seat letters of each row"
+
+    rows: int
+    letters: str
+
+    @property
+    def capacity(self) -> int:
+        return self.rows * len(self.letters)
+
+    def seats(self, positions: np.ndarray) -> np.ndarray:
+        "Seat labels such as 12C of positions in 0..capacity"
+        rows = (positions // len(self.letters) + 1).astype(str)
+        letters = np.array(list(self.letters))[positions % len(self.letters)]
+        return np.char.add(rows, letters).astype(object)
+
+
+@lru_cache(maxsize=None)
+def name_pool(names: str) -> Tuple[np.ndarray, np.ndarray]:
+    "Names of a faker en_US list and their probabilities"
+    weighted = getattr(PersonProvider, names)
+    probabilities = np.fromiter(weighted.values(), dtype=float)
+    return np.array(list(weighted), dtype=object), probabilities / probabilities.sum()
+
+
+def draw_names(rng: np.random.Generator, names: str, n: int) -> np.ndarray:
+    pool, probabilities = name_pool(names)
+    return pool[rng.choice(len(pool), size=n, p=probabilities)]
+
+
+def flight_schedule(synthetic_config: dict, seed: int) -> pd.DataFrame:
+    "One row per flight with number, date, time, route, gate and aircraft"
+    rng = np.random.default_rng([seed, 0])
+    n_flights = synthetic_config["n_flights"]
+    airports = np.array(synthetic_config["airports"], dtype=object)
+    origins = rng.integers(0, len(airports), n_flights)
+    # any airport but the origin
+    destinations = (origins + rng.integers(1, len(airports), n_flights)) % len(airports)
+    carriers = np.array(synthetic_config["carriers"], dtype=object)
+    aircraft = np.array(list(synthetic_config["seat_maps"]), dtype=object)
+    minutes = rng.integers(5 * 12, 23 * 12, n_flights) * 5
+
+    return pd.DataFrame(
+        {
+            "flight_number": carriers[rng.integers(0, len(carriers), n_flights)]
+            + "-"
+            + (100 + np.arange(n_flights)).astype(str),
+            "flight_date": pd.Timestamp(synthetic_config["first_date"])
+            + pd.to_timedelta(
+                rng.integers(0, synthetic_config["n_days"], n_flights), unit="D"
+            ),
+            "flight_time": [f"{m // 60:02d}:{m % 60:02d}" for m in minutes],
+            "origin": airports[origins],
+            "destination": airports[destinations],
+            "gate": [
+                f"{g // 4 + 1}{'ABCD'[g % 4]}"
+                for g in rng.integers(0, synthetic_config["gates"], n_flights)
+            ],
+            "aircraft": aircraft[rng.integers(0, len(aircraft), n_flights)],
+        }
+    )
+
+
+def flight_passengers(
+    flight: dict, seat_map: SeatMap, load_factor: Tuple[float, float], rng
+) -> dict:
+    "Columns of the passengers of one flight, each on a seat of its own"
+    n = int(seat_map.capacity * rng.uniform(*load_factor))
+    female = rng.random(n) < 0.5
+    first_names = np.where(
+        female,
+        draw_names(rng, "first_names_female", n),
+        draw_names(rng, "first_names_male", n),
+    )
+    birth_days = rng.integers(0, 85 * 365, n)
+
+    return {
+        "flight_index": np.full(n, flight["index"]),
+        "name": first_names + " " + draw_names(rng, "last_names", n),
+        "sex": np.where(female, "F", "M").astype(object),
+        "birthdate": flight["flight_date"]
+        - pd.to_timedelta(birth_days + 2 * 365, unit="D"),
+        "seat": seat_map.seats(rng.permutation(seat_map.capacity)[:n]),
+    }
+
+
+def manifest_chunk(schedule: pd.DataFrame, columns: List[dict]) -> pd.DataFrame:
+    "Manifest rows of passenger columns joined with their flights"
+    passengers = {key: np.concatenate([c[key] for c in columns]) for key in columns[0]}
+    flights = schedule.iloc[passengers.pop("flight_index")].reset_index(drop=True)
+    chunk = pd.DataFrame(
+        {
+            **{
+                column: flights[column].to_numpy()
+                for column in [
+                    "flight_number",
+                    "flight_date",
+                    "flight_time",
+                    "origin",
+                    "destination",
+                    "gate",
+                ]
+            },
+            **passengers,
+        }
+    )
+    for column in VALIDATION_COLUMNS:
+        chunk[column] = False
+
+    return chunk
+
+
+def generate_manifest(config: dict, chunk_size: int = None) -> Iterator[pd.DataFrame]:
+    """Manifest of the flights configured under data.synthetic, in chunks.
+
+    A chunk holds whole flights and at least chunk_size passengers, except
+    the last one.
+    """
+    synthetic_config = config["data"]["synthetic"]
+    seed = config["data"]["faker"]["seed"]
+    chunk_size = chunk_size or synthetic_config["chunk_size"]
+    seat_maps = {
+        name: SeatMap(**seat_map)
+        for name, seat_map in synthetic_config["seat_maps"].items()
+    }
+    load_factor = tuple(synthetic_config["load_factor"])
+
+    schedule = flight_schedule(synthetic_config, seed)
+    columns, n_rows = [], 0
+    for flight in schedule.assign(index=np.arange(len(schedule))).to_dict(
+        orient="records"
+    ):
+        rng = np.random.default_rng([seed, 1, flight["index"]])
+        columns.append(
+            flight_passengers(flight, seat_maps[flight["aircraft"]], load_factor, rng)
+        )
+        n_rows += len(columns[-1]["name"])
+        if n_rows >= chunk_size:
+            yield manifest_chunk(schedule, columns)
+            columns, n_rows = [], 0
+
+    if columns:
+        yield manifest_chunk(schedule, columns)
+
+
+def write_manifest(filepath: str, chunks: Iterator[pd.DataFrame]) -> int:
+    "Writes manifest chunks to one CSV as read by get_flight_manifest, returns rows"
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    n_rows = 0
+    with open(filepath, "w", newline="") as f:
+        for chunk in chunks:
+            chunk.to_csv(f, header=n_rows == 0, index=False, date_format="%Y-%m-%d")
+            n_rows += len(chunk)
+            logging.info(f"Wrote {n_rows} passengers to {filepath}")
+
+    return n_rows
+
+
+def boardingpass_fields(passenger: dict) -> dict:
+    "Text of a passenger's boarding pass, as the custom model extracts it"
+    airline, flight_number = passenger["flight_number"].split("-", 1)
+    flight_date = pd.Timestamp(passenger["flight_date"])
+
+    return {
+        "name": passenger["name"],
+        "seat": passenger["seat"],
+        "airline": airline,
+        "flight_number": flight_number,
+        "origin": passenger["origin"],
+        "destination": passenger["destination"],
+        "date": flight_date.strftime("%d.%m"),
+        "flight_boarding": (
+            datetime.strptime(passenger["flight_time"], "%H:%M") - timedelta(minutes=30)
+        ).strftime("%H:%M"),
+        "gate": passenger.get("gate", ""),
+    }
+
+
+def _pdf_text(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def pdf_page(
+    width: float, height: float, content: str, images: Dict[str, Image.Image] = None
+) -> bytes:
+    """One page PDF with Helvetica as /F1, content is the page's drawing operators.
+
+    images are grayscale XObjects under their names, drawn with Do.
+    """
+    stream = content.encode("latin-1", errors="replace")
+    images = images or {}
+    xobjects = " ".join(f"/{name} {6 + i} 0 R" for i, name in enumerate(images))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] "
+        f"/Resources << /Font << /F1 5 0 R >> /XObject << {xobjects} >> >> "
+        f"/Contents 4 0 R >>".encode(),
+        b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica "
+        b"/Encoding /WinAnsiEncoding >>",
+    ]
+    for image in images.values():
+        data = zlib.compress(image.convert("L").tobytes())
+        objects.append(
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+            b"/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode "
+            b"/Length %d >>\nstream\n" % (*image.size, len(data))
+            + data
+            + b"\nendstream"
+        )
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1)
+    pdf += b"startxref\n%d\n%%%%EOF\n" % xref
+
+    return bytes(pdf)
+
+
+def bcbp_text(passenger: dict, pnr: str, airport_codes: Dict[str, str]) -> str:
+    "Mandatory items of a one leg IATA BCBP barcode for passenger"
+    fields = boardingpass_fields(passenger)
+    first_name, _, last_name = fields["name"].rpartition(" ")
+    name = f"{last_name}/{first_name}".upper()[:20]
+    day = pd.Timestamp(passenger["flight_date"]).dayofyear
+
+    return (
+        f"M1{name:<20}E{pnr:<7}"
+        f"{airport_codes[fields['origin']]}{airport_codes[fields['destination']]}"
+        f"{fields['airline']:<3}{fields['flight_number']:0>4} {day:03d}Y"
+        f"{fields['seat']:0>4}00001100"
+    )
+
+
+def aamva_text(passenger: dict, license_number: str) -> str:
+    "AAMVA PDF417 data of a California driver license of passenger"
+    first_name, _, last_name = passenger["name"].rpartition(" ")
+    birthdate = pd.Timestamp(passenger["birthdate"])
+    elements = [
+        f"DAQ{license_number}",
+        f"DCS{last_name.upper()}",
+        f"DAC{first_name.upper()}",
+        "DADNONE",
+        f"DBB{birthdate.strftime('%m%d%Y')}",
+        f"DBC{1 if passenger['sex'] == 'M' else 2}",
+        "DAJCA",
+        "DCGUSA",
+        "DDEN",
+        "DDFN",
+    ]
+    subfile = "DL" + "\n".join(elements) + "\r"
+    # header, one subfile designator with offset and length, then the subfile
+    offset = 21 + 10
+
+    return f"@\n\x1e\rANSI 636014080001DL{offset:04d}{len(subfile):04d}{subfile}"
+
+
+def barcode_image(text: str, scale: int = 2) -> Image.Image:
+    "PDF417 barcode of text, scale pixels per module"
+    if zxingcpp is None:
+        raise ImportError("barcodes require zxing-cpp")
+
+    barcode = Image.fromarray(
+        np.asarray(zxingcpp.write_barcode(zxingcpp.BarcodeFormat.PDF417, text))
+    )
+    return barcode.resize(
+        (barcode.width * scale, barcode.height * scale), Image.NEAREST
+    )
+
+
+def boardingpass_pdf(passenger: dict, ticket: str, barcode: str = None) -> bytes:
+    """Boarding pass on an A4 landscape page, laid out like the project's passes.
+
+    barcode is printed below the pass as PDF417 if given.
+    """
+    fields = boardingpass_fields(passenger)
+    # cells as (x, y, text) in points from the top left corner
+    cells = [
+        (145, 144, "Passenger Name"),
+        (331, 144, "Carrier"),
+        (417, 144, "Flight No."),
+        (508, 144, "Class"),
+        (573, 144, "Passenger Name"),
+        (145, 161, fields["name"]),
+        (331, 161, fields["airline"]),
+        (417, 161, fields["flight_number"]),
+        (508, 161, "Economy"),
+        (573, 178, "From"),
+        (623, 178, fields["origin"]),
+        (573, 195, "To"),
+        (623, 195, fields["destination"]),
+        (145, 212, f"From:  {fields['origin']}"),
+        (331, 212, "Date"),
+        (417, 212, "Baggage"),
+        (508, 212, "Seat"),
+        (573, 212, "Seat"),
+        (623, 212, "Date"),
+        (145, 229, f"To: {fields['destination']}"),
+        (331, 229, fields["date"]),
+        (417, 229, "Hand"),
+        (508, 229, fields["seat"]),
+        (573, 229, fields["seat"]),
+        (623, 229, fields["date"]),
+        (145, 262, "GATE"),
+        (232, 262, "Boarding Time"),
+        (573, 262, "GATE"),
+        (623, 262, "Boarding Time"),
+        (145, 279, fields["gate"]),
+        (232, 279, fields["flight_boarding"]),
+        (573, 279, fields["gate"]),
+        (623, 279, fields["flight_boarding"]),
+    ]
+    height = 595
+    ops = [
+        # black bars above and below the pass
+        f"0 g 73 {height - 135} 658 33 re f 73 {height - 376} 658 34 re f",
+        f"1 g BT /F1 12 Tf 600 {height - 130} Td ({_pdf_text(ticket)}) Tj ET",
+        f"0.35 0.6 0.85 rg BT /F1 16 Tf 0 1 -1 0 120 {height - 330} Tm "
+        "(UDACITY AIRLINES) Tj ET",
+        "0 G 0.5 w",
+    ]
+    # grid lines as (x0, y0, x1, y1) in points from the top left corner
+    lines = [(140, y, 731, y) for y in [135, 152, 169, 203, 253]]
+    lines += [(567, 186, 731, 186), (140, 236, 325, 236)]
+    lines += [(x0, y, x1, y) for y in [220, 270] for x0, x1 in [(140, 325), (567, 731)]]
+    lines += [(x, 135, x, 342) for x in [140, 567, 731]]
+    lines += [
+        (x, y0, x, y1) for x in [325, 411, 503] for y0, y1 in [(135, 169), (203, 253)]
+    ]
+    lines += [(617, 169, 617, 342), (226, 253, 226, 342)]
+    ops += [f"{x0} {height - y0} m {x1} {height - y1} l S" for x0, y0, x1, y1 in lines]
+    ops.append("0 g")
+    ops += [
+        f"BT /F1 11 Tf {x} {height - y} Td ({_pdf_text(str(text))}) Tj ET"
+        for x, y, text in cells
+    ]
+    images = {}
+    if barcode is not None:
+        images["Im1"] = barcode_image(barcode)
+        # 2 pixels per point, below the bar under the pass
+        width, bar_height = (side / 2 for side in images["Im1"].size)
+        ops.append(f"q {width} 0 0 {bar_height} 140 {height - 390 - bar_height} cm")
+        ops.append("/Im1 Do Q")
+
+    return pdf_page(842, height, "\n".join(ops), images)
+
+
+def write_boardingpass(
+    filepath: str, passenger: dict, ticket: str, barcode: str = None
+) -> None:
+    with open(filepath, "wb") as f:
+        f.write(boardingpass_pdf(passenger, ticket, barcode))
+
+
+def _font(size: int) -> ImageFont.ImageFont:
+    try:
+        return ImageFont.truetype("DejaVuSans-Bold.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def write_id_card(
+    filepath: str,
+    passenger: dict,
+    fake: Faker,
+    template: str = ID_TEMPLATE,
+    photo: str = None,
+    barcode: bool = False,
+) -> None:
+    """Driver license of passenger on the template, with photo if given.
+
+    fake provides license number and address, seed it per passenger to get
+    the same card again. With barcode the back of the card with the AAMVA
+    PDF417 is scanned below the front.
+    """
+    first_name, _, last_name = passenger["name"].rpartition(" ")
+    birthdate = pd.Timestamp(passenger["birthdate"])
+    with Image.open(template) as img:
+        card = img.convert("RGB")
+    if photo is not None:
+        with Image.open(photo) as face:
+            card.paste(face.convert("RGB").resize((148, 198)), (25, 45))
+
+    draw = ImageDraw.Draw(card)
+    red, black = (220, 30, 30), (20, 20, 20)
+    license_number = f"D{fake.random_number(digits=7, fix_len=True)}"
+    for xy, text, color in [
+        ((212, 68), license_number, red),
+        ((212, 90), f"{birthdate.strftime('%m/%d')}/2030", red),
+        ((200, 112), last_name.upper(), black),
+        ((200, 132), first_name.upper(), black),
+        ((181, 152), fake.street_address(), black),
+        ((181, 170), f"{fake.city()}, {fake.state_abbr()} {fake.zipcode()}", black),
+        ((212, 181), birthdate.strftime("%m/%d/%Y"), red),
+        ((262, 241), passenger["sex"], black),
+    ]:
+        draw.text(xy, text, fill=color, font=_font(15))
+
+    if barcode:
+        pdf417 = barcode_image(aamva_text(passenger, license_number))
+        scan = Image.new("RGB", (card.width, card.height * 2), "white")
+        scan.paste(card, (0, 0))
+        scan.paste(
+            pdf417.convert("RGB"),
+            ((card.width - pdf417.width) // 2, card.height + 40),
+        )
+        card = scan
+
+    card.save(filepath, "JPEG", quality=90)
+
+
+def write_documents(
+    directory: str,
+    manifest: pd.DataFrame,
+    seed: int,
+    photo: str = None,
+    airport_codes: Dict[str, str] = None,
+) -> List[dict]:
+    """Writes ID card and boarding pass per manifest row.
+
+    With airport_codes, IATA codes by city, both documents carry barcodes.
+    Returns the passenger dicts with the file paths under 'id' and
+    'boarding', as taken by process_passenger.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fake = Faker()
+    documents = []
+    for label, passenger in zip(manifest.index, manifest.to_dict(orient="records")):
+        fake.seed_instance(seed + int(label))
+        paths = {
+            "id": os.path.join(directory, f"id_{label}.jpg"),
+            "boarding": os.path.join(directory, f"boarding_{label}.pdf"),
+        }
+        write_id_card(
+            paths["id"], passenger, fake, photo=photo, barcode=bool(airport_codes)
+        )
+        ticket = f"ETK-{fake.random_number(digits=12, fix_len=True)}C"
+        barcode = None
+        if airport_codes:
+            barcode = bcbp_text(passenger, ticket[4:10], airport_codes)
+        write_boardingpass(paths["boarding"], passenger, ticket, barcode=barcode)
+        documents.append({**paths, "passenger_id": str(label)})
+
+    return documents
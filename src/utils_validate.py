@@ -1,65 +1,86 @@
 import pandas as pd
+import numpy as np
 import logging
 from datetime import datetime
 from datetime import timedelta
 from typing import Union
+from src.utils_metrics import metrics
+from src.utils_resilience import PendingReview
+from src.utils_manifest import ManifestStore
+from src.utils_manifest import as_manifest_store
+from src.utils_manifest import normalize_name
+from src.utils_manifest import normalize_names
+from src.utils_sink import ResultSink
+from src.utils_manifest import to_date
+
+
+def validate_name_dob(
+    dict_id: dict, flight_manifest: Union[pd.DataFrame, ManifestStore]
+) -> bool:
+    store = as_manifest_store(flight_manifest)
 
-
-def validate_name_dob(dict_id: dict, flight_manifest: pd.DataFrame) -> pd.DataFrame:
-
-    # get idx where name matches, if more than one, check dob
-    idx_name = flight_manifest.query(
-        f"name == '{(name := dict_id.get('full_name'))}'"
-    ).index
+    # get idx where name matches, namesakes are told apart by dob
+    idx_name = store.find_passenger(
+        name := dict_id.get("full_name"), dict_id.get("dob")
+    )
 
     # if idx_match none, raise error
-    if idx_name.empty:
+    if len(idx_name) == 0:
         logging.warning(f"Name {name} not found in flight manifest. Check name.")
         return False
     if len(idx_name) > 1:
         logging.warning(f"Multiple names {name} found in flight manifest.")
-        # TODO: handle multiple matches
         return False
     # validate dob
-    elif len(idx_name) == 1:
-        if (
-            all(
-                (dob_manifest := flight_manifest.loc[idx_name].birthdate.dt.date)
-                == (dob := dict_id.get("dob"))
-            )
-            is True
-        ):
-            logging.info(f"Validated: {name}, {dob}")
-            return True
-        else:
-            logging.warning(
-                f"{dob} does not match {name}'s dob in manifest, {dob_manifest}."
-            )
-            return False
+    if (dob_manifest := to_date(store.df.at[idx_name[0], "birthdate"])) == (
+        dob := dict_id.get("dob")
+    ):
+        logging.info(f"Validated: {name}, {dob}")
+        return True
     else:
-        logging.warning(f"{name} not found in flight manifest.")
+        logging.warning(
+            f"{dob} does not match {name}'s dob in manifest, {dob_manifest}."
+        )
         return False
 
 
 def validate_boardingpass(
-    dict_boardingpass: dict, flight_manifest: pd.DataFrame
+    dict_boardingpass: dict, flight_manifest: Union[pd.DataFrame, ManifestStore]
 ) -> bool:
+    if dict_boardingpass is None:
+        logging.warning("No boarding pass details available.")
+        return False
 
-    # validate boarding pass
-    dict_reference = flight_manifest.query(
-        f"name == '{(dict_boardingpass.get('name'))}'"
-    ).to_dict(orient="records")[0]
+    store = as_manifest_store(flight_manifest)
+    flight_number = (
+        dict_boardingpass.get("airline", "")
+        + "-"
+        + dict_boardingpass.get("flight_number", "")
+    )
 
-    # name
-    valid_boarding_name = dict_reference["name"] == dict_boardingpass.get("name")
+    # validate boarding pass, prefer the passenger booked on that flight
+    idx_name = store.find_name(
+        dict_boardingpass.get("name"), flight_number
+    ) or store.find_name(dict_boardingpass.get("name"))
+
+    if len(idx_name) == 0:
+        logging.warning(
+            f"Name {dict_boardingpass.get('name')} on boarding pass not found in flight manifest."
+        )
+        return False
+
+    dict_reference = store.record(idx_name[0])
+
+    # name, barcodes spell it in upper case
+    valid_boarding_name = normalize_name(dict_reference["name"]) == normalize_name(
+        dict_boardingpass.get("name")
+    )
 
     # seat
     valid_boarding_seat = dict_reference["seat"] == dict_boardingpass.get("seat")
 
     # flight id
-    valid_boarding_flight = dict_reference["flight_number"] == (
-        dict_boardingpass["airline"] + "-" + dict_boardingpass["flight_number"]
-    )
+    valid_boarding_flight = dict_reference["flight_number"] == flight_number
 
     # origin
     valid_boarding_origin = dict_reference["origin"] == dict_boardingpass.get("origin")
@@ -104,6 +125,9 @@ def validate_boardingpass(
 
 
 def validate_face(dict_face: dict, confidence_min: float = 0.6) -> bool:
+    if dict_face is None:
+        logging.warning("No face comparison available.")
+        return False
     if (
         dict_face.get("face_is_identical")
         and dict_face.get("confidence") > confidence_min
@@ -116,7 +140,7 @@ def validate_face(dict_face: dict, confidence_min: float = 0.6) -> bool:
 
 def has_no_lighter(result: dict, detect_threshold: float = 0.2) -> bool:
     if (
-        probability := result.get("probabilities_topn").get("lighter")[0]
+        probability := (result.get("probabilities_topn").get("lighter") or [0.0])[0]
     ) > detect_threshold:
         logging.info(f"Lighter detected with probability {probability}")
         return False
@@ -125,9 +149,191 @@ def has_no_lighter(result: dict, detect_threshold: float = 0.2) -> bool:
         return True
 
 
+def map_unique(values: pd.Series, func) -> np.ndarray:
+    "Applies vectorized func to the unique values only and broadcasts back"
+    codes, uniques = pd.factorize(values)
+    mapped = np.append(np.asarray(func(uniques), dtype=object), None)
+
+    # missing values have code -1 and map to the appended None
+    return mapped[codes]
+
+
+def validate_manifest_batch(
+    extracted: pd.DataFrame, flight_manifest: Union[pd.DataFrame, ManifestStore]
+) -> pd.DataFrame:
+    """Revalidates many passengers against the manifest in one vectorized pass.
+
+    extracted holds one row per passenger with the ID fields `full_name`
+    and `dob` and the boarding pass fields prefixed with `bp_`
+    (`bp_name`, `bp_seat`, `bp_airline`, `bp_flight_number`, `bp_origin`,
+    `bp_destination`, `bp_date`, `bp_flight_boarding`).
+
+    Returns a DataFrame on the index of extracted with the manifest index
+    label matched by `full_name` and the columns valid_name, valid_dob,
+    valid_boardingpass and valid_boarding_time. Results agree with
+    validate_name_dob and validate_boardingpass row by row, names without
+    exact match are looked up one by one if the store matches fuzzy names.
+    """
+    manifest = (
+        flight_manifest.df
+        if isinstance(flight_manifest, ManifestStore)
+        else flight_manifest
+    )
+    reference = manifest[
+        ["name", "seat", "flight_number", "origin", "destination"]
+    ].reset_index(drop=True)
+    reference["manifest_idx"] = pd.Series(manifest.index, dtype=object)
+    reference["position"] = np.arange(len(manifest))
+    reference["name_key"] = (
+        flight_manifest.name_keys
+        if isinstance(flight_manifest, ManifestStore)
+        else normalize_names(manifest["name"])
+    ).to_numpy()
+    reference["birth_date"] = (
+        pd.to_datetime(manifest["birthdate"], errors="coerce").dt.normalize().to_numpy()
+    )
+    # flight columns repeat per flight, so they are formatted once per value
+    reference["flight_date_key"] = map_unique(
+        manifest["flight_date"],
+        lambda dates: pd.to_datetime(dates).strftime("%d.%m"),
+    )
+    # flight time (boarding + 30 min)
+    reference["flight_boarding"] = map_unique(
+        manifest["flight_time"],
+        lambda times: (
+            pd.to_datetime(times, format="%H:%M") - pd.Timedelta(minutes=30)
+        ).strftime("%H:%M"),
+    )
+
+    rows = np.arange(len(extracted))
+    # ID and boarding pass names mostly coincide, normalize each name once
+    name_keys = map_unique(
+        pd.concat([extracted["full_name"], extracted["bp_name"]]).fillna(""),
+        lambda names: normalize_names(pd.Series(names)),
+    )
+
+    # name and dob: name and dob must occur exactly once together
+    ids = pd.DataFrame(
+        {
+            "row": rows,
+            "name_key": name_keys[: len(extracted)],
+            "dob": pd.to_datetime(extracted["dob"], errors="coerce")
+            .dt.normalize()
+            .to_numpy(),
+        }
+    )
+    id_match = ids.merge(
+        reference.drop_duplicates(["name_key", "birth_date"], keep=False)[
+            ["name_key", "birth_date", "manifest_idx"]
+        ],
+        left_on=["name_key", "dob"],
+        right_on=["name_key", "birth_date"],
+        how="left",
+    )
+    valid_name_dob = (
+        id_match["manifest_idx"].notna() & id_match["dob"].notna()
+    ).to_numpy(copy=True)
+    # namesakes of another dob are matched by the first of them
+    manifest_idx = np.where(
+        valid_name_dob,
+        id_match["manifest_idx"].to_numpy(),
+        ids.merge(
+            reference.drop_duplicates("name_key")[["name_key", "manifest_idx"]],
+            on="name_key",
+            how="left",
+        )["manifest_idx"].to_numpy(),
+    )
+    if getattr(flight_manifest, "min_name_score", None) is not None:
+        unmatched = np.flatnonzero(
+            ~ids["name_key"].isin(reference["name_key"]).to_numpy()
+            & ids["dob"].notna().to_numpy()
+        )
+        for row in unmatched:
+            idx = flight_manifest.find_passenger(
+                extracted["full_name"].iloc[row], extracted["dob"].iloc[row]
+            )
+            if idx:
+                manifest_idx[row], valid_name_dob[row] = idx[0], True
+
+    # boarding pass: first passenger with that name, preferring the same flight
+    boarding = pd.DataFrame(
+        {
+            "row": rows,
+            "name_key": name_keys[len(extracted) :],
+            "bp_flight": (
+                extracted["bp_airline"].fillna("")
+                + "-"
+                + extracted["bp_flight_number"].fillna("")
+            ).to_numpy(),
+        }
+    )
+    candidates = boarding.merge(reference, on="name_key", how="inner")
+    candidates["on_flight"] = candidates["flight_number"] == candidates["bp_flight"]
+    chosen = (
+        candidates.sort_values(
+            ["row", "on_flight", "position"], ascending=[True, False, True]
+        )
+        .drop_duplicates("row")
+        .set_index("row")
+        .reindex(rows)
+    )
+
+    def matches(column: str, field: str) -> np.ndarray:
+        return (chosen[column].to_numpy() == extracted[field].to_numpy()) & chosen[
+            column
+        ].notna().to_numpy()
+
+    valid_boarding_time = matches("flight_boarding", "bp_flight_boarding")
+    valid_boardingpass = (
+        # candidates are matched on the normalized name
+        chosen["name"].notna().to_numpy()
+        & matches("seat", "bp_seat")
+        & (chosen["flight_number"] == chosen["bp_flight"]).to_numpy()
+        & matches("origin", "bp_origin")
+        & matches("destination", "bp_destination")
+        & matches("flight_date_key", "bp_date")
+        & valid_boarding_time
+    )
+
+    logging.info(
+        f"Revalidated {len(extracted)} passengers, {valid_boardingpass.sum()} valid boarding passes."
+    )
+
+    return pd.DataFrame(
+        {
+            "manifest_idx": manifest_idx,
+            "valid_name": valid_name_dob,
+            "valid_dob": valid_name_dob,
+            "valid_boardingpass": valid_boardingpass,
+            "valid_boarding_time": valid_boarding_time,
+        },
+        index=extracted.index,
+    )
+
+
+def update_manifest_batch(
+    flight_manifest: Union[pd.DataFrame, ManifestStore], results: pd.DataFrame
+) -> pd.DataFrame:
+    "Sets the flags of validate_manifest_batch results in the manifest"
+    manifest = (
+        flight_manifest.df
+        if isinstance(flight_manifest, ManifestStore)
+        else flight_manifest
+    )
+    matched = results[results["manifest_idx"].notna()]
+
+    for columns, valid in [
+        (["valid_dob", "valid_name"], matched["valid_name"]),
+        ("valid_boardingpass", matched["valid_boardingpass"]),
+    ]:
+        update_manifest(manifest, matched.loc[valid, "manifest_idx"].tolist(), columns)
+
+    return manifest
+
+
 def update_manifest(
     flight_manifest: pd.DataFrame,
-    idx: pd.core.indexes.numeric.Int64Index,
+    idx: Union[pd.Index, list],
     column_update: Union[str, list],
 ) -> pd.DataFrame:
 
@@ -137,47 +343,183 @@ def update_manifest(
     return flight_manifest
 
 
+def passenger_name(dict_id, dict_boardingpass) -> str:
+    "Name from the ID, from the boarding pass if ID details are missing"
+    if isinstance(dict_id, dict) and dict_id.get("full_name"):
+        return dict_id["full_name"]
+    if isinstance(dict_boardingpass, dict):
+        return dict_boardingpass.get("name")
+
+    return None
+
+
+def mark_pending_review(
+    flight_manifest: pd.DataFrame, idx: Union[pd.Index, list], checks: list
+) -> pd.DataFrame:
+    "Sets the checks left for manual review, comma separated, empty if none"
+    if "pending_review" not in flight_manifest.columns:
+        flight_manifest["pending_review"] = ""
+    flight_manifest.loc[idx, "pending_review"] = ",".join(checks)
+    if checks:
+        logging.warning(f"Pending manual review: {checks}")
+
+    return flight_manifest
+
+
+def pending_checks(dict_id, dict_boardingpass, dict_face, dict_lighter) -> list:
+    "Checks left for manual review, failed ones and documents not read"
+    pending = [
+        result.check
+        for result in [dict_id, dict_boardingpass, dict_face, dict_lighter]
+        if isinstance(result, PendingReview)
+    ]
+    # documents that could not be read are checked by hand, not mismatches
+    if dict_id is None:
+        pending.append("id_ocr")
+    if dict_boardingpass is None:
+        pending.append("boardingpass")
+
+    return pending
+
+
+# flight of the rows of passengers who could not be identified
+UNIDENTIFIED = "unidentified"
+
+
+def review_unidentified(
+    passenger_key: str,
+    pending: list,
+    dict_face: dict,
+    dict_lighter: dict,
+    sink: ResultSink = None,
+) -> pd.DataFrame:
+    """Row for manual review of a passenger whose ID and boarding pass could
+    not be read, keyed by passenger_key, with the face and lighter checks"""
+    logging.error(f"Passenger {passenger_key} not identified, pending manual review")
+    metrics.inc("kiosk_validations_total", check="manifest", valid=False)
+    passenger_manifest = pd.DataFrame(
+        [
+            {
+                "passenger_key": passenger_key,
+                "flight_number": UNIDENTIFIED,
+                "name": None,
+                "birthdate": None,
+                "valid_dob": False,
+                "valid_name": False,
+                "valid_boardingpass": False,
+                "valid_person": not isinstance(dict_face, PendingReview)
+                and counted("face", validate_face(dict_face)),
+                "valid_luggage": not isinstance(dict_lighter, PendingReview)
+                and counted("luggage", has_no_lighter(dict_lighter)),
+                "pending_review": ",".join(pending),
+            }
+        ]
+    )
+
+    if sink is not None:
+        sink.write(passenger_manifest)
+        logging.info(f"Queued manual review of {passenger_key}")
+
+    return passenger_manifest
+
+
+def counted(check: str, valid: bool) -> bool:
+    "Counts the outcome of a validation check and returns it"
+    metrics.inc("kiosk_validations_total", check=check, valid=valid)
+    return valid
+
+
 def pipeline_validate(
-    flight_manifest: pd.DataFrame,
+    flight_manifest: Union[pd.DataFrame, ManifestStore],
     dict_id: dict,
     dict_boardingpass: dict,
     dict_face: dict,
     dict_lighter: dict,
+    sink: ResultSink = None,
+    flight_number: str = None,
+    passenger_key: str = None,
 ):
-    """Validation based on detection results"""
-    idx = flight_manifest.loc[flight_manifest.name == dict_id.get("full_name"), :].index
+    """Validation based on detection results.
+
+    A detection result may be PendingReview if its check failed in degraded
+    mode. That check is not validated but listed in the passenger's
+    `pending_review` column, as are the ID and boarding pass if they could
+    not be read (None). Without ID details the passenger's row is found by
+    the name on the boarding pass only to record the pending ID check, with
+    them namesakes are told apart by the date of birth and a misread name
+    may match fuzzily. If neither could be read, a row for manual review
+    keyed by passenger_key is returned instead.
+
+    Validated rows are handed to sink, which writes them off the request
+    thread. Without sink the result is only returned. With flight_number
+    only passengers of that flight are validated.
+    """
+    with metrics.span("validate"):
+        store = as_manifest_store(flight_manifest)
+        pending = pending_checks(dict_id, dict_boardingpass, dict_face, dict_lighter)
+        if not isinstance(dict_id, dict) and not isinstance(dict_boardingpass, dict):
+            return review_unidentified(
+                passenger_key, pending, dict_face, dict_lighter, sink=sink
+            )
 
-    if len(idx) == 0:
-        logging.error(f"{dict_id.get('full_name')} not found in manifest.")
-        return None
+        name = passenger_name(dict_id, dict_boardingpass)
+        dob = dict_id.get("dob") if isinstance(dict_id, dict) else None
+        idx = store.find_passenger(name, dob, flight_number)
 
-    if validate_name_dob(dict_id, flight_manifest):
-        update_manifest(flight_manifest, idx, ["valid_dob", "valid_name"])
+        if len(idx) == 0:
+            logging.error(f"{name} not found in manifest.")
+            metrics.inc("kiosk_validations_total", check="manifest", valid=False)
+            return None
 
-    if validate_boardingpass(dict_boardingpass, flight_manifest):
-        update_manifest(flight_manifest, idx, "valid_boardingpass")
+        if isinstance(dict_id, dict) and counted(
+            "name_dob", validate_name_dob(dict_id, store)
+        ):
+            update_manifest(store.df, idx, ["valid_dob", "valid_name"])
 
-    if validate_face(dict_face):
-        update_manifest(flight_manifest, idx, "valid_person")
+        if isinstance(dict_boardingpass, dict) and counted(
+            "boardingpass", validate_boardingpass(dict_boardingpass, store)
+        ):
+            update_manifest(store.df, idx, "valid_boardingpass")
 
-    if has_no_lighter(dict_lighter):
-        update_manifest(flight_manifest, idx, "valid_luggage")
+        if not isinstance(dict_face, PendingReview) and counted(
+            "face", validate_face(dict_face)
+        ):
+            update_manifest(store.df, idx, "valid_person")
 
-    flight_manifest.loc[idx].to_csv(
-        filepath := f"data/validated/flight_manifest_{idx[0]}.csv", index=False
-    )
+        if not isinstance(dict_lighter, PendingReview) and counted(
+            "luggage", has_no_lighter(dict_lighter)
+        ):
+            update_manifest(store.df, idx, "valid_luggage")
 
-    logging.info(
-        f"Saved validated manifest for {dict_id.get('full_name')} to {filepath}"
-    )
+        # always set, so that every written row has the column
+        mark_pending_review(store.df, idx, pending)
 
-    return flight_manifest.loc[idx]
+        passenger_manifest = store.rows(idx)
+
+    if sink is not None:
+        sink.write(passenger_manifest)
+        logging.info(f"Queued validated manifest for {name}")
+
+    return passenger_manifest
 
 
 def message_to_passenger(passenger_manifest) -> None:
+    "Prints the boarding message, only if no check is left for manual review"
     df = passenger_manifest.iloc[0]
+    pending = df.get("pending_review")
+    # rows never validated by the kiosk have no pending checks
+    pending = pending if isinstance(pending, str) else ""
+    n_valid = (df.filter(like="valid") * 1).sum()
 
-    if (df.filter(like="valid") * 1).sum() >= 3:
+    if pending:
+        print(
+            f"""
+        Dear Sir/Madam,
+        Some of your documents could not be checked automatically ({pending}).
+        Please wait, a customer service representative will check them with you.
+        """
+        )
+    elif n_valid >= 3:
         logging.info("Flight manifest is valid.")
         print(
             f"""
@@ -187,8 +529,7 @@ def message_to_passenger(passenger_manifest) -> None:
         Your identity is verified so please board the plane.
         """
         )
-
-    if (df.filter(like="valid") * 1).sum() < 3:
+    else:
         print(
             """
         Dear Sir/Madam,
@@ -197,7 +538,7 @@ def message_to_passenger(passenger_manifest) -> None:
         """
         )
 
-    if not df.loc["valid_luggage"]:
+    if not df.loc["valid_luggage"] and "lighter" not in pending:
         print(
             """
         CAUTION
@@ -205,7 +546,7 @@ def message_to_passenger(passenger_manifest) -> None:
         """
         )
 
-    if not df.loc["valid_boardingpass"]:
+    if not df.loc["valid_boardingpass"] and not pending:
         print(
             """
         Dear Sir/Madam,
@@ -0,0 +1,68 @@
+import io
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from src.utils_lighterdetection import OnnxLighterDetector
+from src.utils_lighterdetection import pipeline_prediction_lighterdetection
+from src.utils_validate import has_no_lighter
+
+
+class FakeSession:
+    "ONNX session of a compact object detection export returning fixed scores"
+
+    def __init__(self, scores):
+        self.scores = np.asarray(scores, dtype=np.float32)
+
+    def get_inputs(self):
+        return [SimpleNamespace(name="data", shape=["batch", 3, 32, 32])]
+
+    def get_outputs(self):
+        return [
+            SimpleNamespace(name=name)
+            for name in ["detected_boxes", "detected_classes", "detected_scores"]
+        ]
+
+    def run(self, output_names, inputs):
+        n, k = len(inputs["data"]), len(self.scores)
+        return [
+            np.tile(np.array([0.1, 0.1, 0.5, 0.5], dtype=np.float32), (n, k, 1)),
+            np.zeros((n, k), dtype=np.int64),
+            np.tile(self.scores, (n, 1)),
+        ]
+
+
+def detector(tmp_path, scores):
+    labels_path = tmp_path / "labels.txt"
+    labels_path.write_text("lighter\n")
+    return OnnxLighterDetector(
+        "model.onnx", str(labels_path), session=FakeSession(scores)
+    )
+
+
+def jpeg() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), "white").save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def test_onnx_without_detection_is_a_clean_bag(tmp_path):
+    result = pipeline_prediction_lighterdetection(
+        detector(tmp_path, [0.001, 0.0]), jpeg()
+    )
+
+    assert result["probabilities_topn"] == {"lighter": [0.0]}
+    assert has_no_lighter(result)
+
+
+def test_onnx_detection_above_threshold(tmp_path):
+    result = pipeline_prediction_lighterdetection(detector(tmp_path, [0.9]), jpeg())
+
+    assert result["probabilities_topn"]["lighter"] == [pytest.approx(0.9)]
+    assert not has_no_lighter(result)
+
+
+def test_missing_lighter_tag_is_no_lighter():
+    assert has_no_lighter({"probabilities_topn": {}})